@@ -6,6 +6,7 @@ or
 import asyncio
 import sentry_sdk
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
@@ -13,26 +14,53 @@ from fastapi.templating import Jinja2Templates
 from logging import getLogger
 from pydantic import BaseModel
 
-from mathtext.predict_intent import predict_message_intent
+from mathtext_fastapi.cache import get_cache_stats, redis_response_cache
 from mathtext_fastapi.constants import (
     APPROVED_KEYWORDS,
     ERROR_RESPONSE_DICT,
+    NLU_BATCH_MAX_SIZE,
     SENTRY_DSN,
     SENTRY_PROFILES_SAMPLE_RATE,
     SENTRY_TRACES_SAMPLE_RATE,
-    TIMEOUT_RESPONSE_DICT,
-    TIMEOUT_THRESHOLD,
+    WARMUP_ON_STARTUP,
 )
 
+from mathtext_fastapi.admission import (
+    AdmissionControlMiddleware,
+    nlu_admission_controller,
+)
+from mathtext_fastapi.deadline import Deadline, build_deadline_for_request
+from mathtext_fastapi.inference import (
+    get_inference_executor_stats,
+    predict_message_intent_in_executor,
+    shutdown_inference_executor,
+)
+from mathtext_fastapi.json_responses import (
+    build_nlu_json_list_response,
+    build_nlu_json_response,
+)
+from mathtext_fastapi.nlu_evaluations.answer_profile import get_answer_profile_stats
+from mathtext_fastapi.nlu_evaluations.planner import get_planner_stats
+from mathtext_fastapi.request_events import request_events
 from mathtext_fastapi.request_validators import (
+    get_message_text_and_expected_answer,
     truncate_long_message_text,
+    parse_nlu_api_batch_request_for_messages,
     parse_nlu_api_request_for_message,
 )
-from mathtext_fastapi.supabase_logging_async import prepare_message_data_for_logging
+from mathtext_fastapi.response_table import response_table
+from mathtext_fastapi.single_flight import evaluation_single_flight
+from mathtext_fastapi.supabase_logging_async import (
+    drain_request_logging,
+    get_request_logging_stats,
+    prepare_message_data_for_logging,
+    start_request_logging,
+)
 from mathtext_fastapi.v2_nlu import (
     v2_evaluate_message_with_nlu,
     run_keyword_and_intent_evaluations,
 )
+from mathtext_fastapi.warmup import run_warmup, warmup_state
 
 
 log = getLogger(__name__)
@@ -46,7 +74,40 @@ sentry_sdk.init(
     profiles_sample_rate=SENTRY_PROFILES_SAMPLE_RATE,
 )
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Runs worker startup and shutdown tasks
+
+    Warmup runs in the background so the worker can answer liveness checks while it warms up.  Request logs waiting in the batch are written, or spooled to disk, before the worker exits.
+    """
+    start_request_logging()
+    warmup_task = None
+    if WARMUP_ON_STARTUP:
+        warmup_task = asyncio.create_task(run_warmup())
+    else:
+        warmup_state["ready"] = True
+    yield
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+    await redis_response_cache.drain()
+    await redis_response_cache.close()
+    await drain_request_logging()
+    shutdown_inference_executor()
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    AdmissionControlMiddleware,
+    controller=nlu_admission_controller,
+    paths=[
+        "/intent-recognition",
+        "/nlu/intent-recognition",
+        "/v2/nlu",
+        "/v2/nlu/batch",
+    ],
+)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -57,6 +118,35 @@ class Text(BaseModel):
     content: str = ""
 
 
+async def run_v2_nlu_evaluation(message_text, expected_answer, deadline):
+    """Runs the v2 evaluation of one message and converts timeouts and failures to responses
+
+    Pairs in the precomputed response table are answered without evaluating them.  A timeout returns the best result found before the deadline passed, if there is one.
+    """
+    nlu_response = response_table.lookup(message_text, expected_answer)
+    if nlu_response is not None:
+        return nlu_response
+
+    try:
+        nlu_response = await asyncio.wait_for(
+            evaluation_single_flight.run(
+                ("v2_nlu", message_text, expected_answer),
+                v2_evaluate_message_with_nlu,
+                message_text,
+                expected_answer,
+                deadline,
+                deadline=deadline,
+            ),
+            deadline.remaining_seconds(),
+        )
+    except asyncio.TimeoutError:
+        nlu_response = deadline.timeout_response()
+    except Exception as e:
+        nlu_response = ERROR_RESPONSE_DICT
+        log.error(f"V2 NLU Endpoint Exception: {e}")
+    return nlu_response
+
+
 @app.get("/")
 def home(request: Request):
     return templates.TemplateResponse("home.html", {"request": request})
@@ -73,33 +163,65 @@ def topics():
     return JSONResponse(content={"keywords": APPROVED_KEYWORDS})
 
 
+@app.get("/ready")
+def readiness():
+    """Return 200 once the worker has finished warming up, and 503 until then"""
+    status_code = 200 if warmup_state["ready"] else 503
+    return JSONResponse(content=warmup_state, status_code=status_code)
+
+
+@app.get("/metrics")
+def metrics():
+    """Return worker-level runtime statistics"""
+    return JSONResponse(
+        content={
+            "admission": nlu_admission_controller.get_stats(),
+            "answer_profiles": get_answer_profile_stats(),
+            "inference_executor": get_inference_executor_stats(),
+            "planner": get_planner_stats(),
+            "request_events": request_events.get_stats(),
+            "request_logging": get_request_logging_stats(),
+            "response_cache": get_cache_stats(),
+            "response_table": response_table.get_stats(),
+            "single_flight": evaluation_single_flight.get_stats(),
+        }
+    )
+
+
 @app.post("/intent-recognition")
-def intent_recognition_ep(content: Text = None):
-    ml_response = predict_message_intent(content.content)
+async def intent_recognition_ep(content: Text = None):
+    ml_response = await predict_message_intent_in_executor(content.content)
     return JSONResponse(content=ml_response)
 
 
 @app.post("/nlu/intent-recognition")
 async def recognize_keywords_and_intents(request: Request):
     """Attempts to detect approved keywords and intents in a student message"""
+    deadline = build_deadline_for_request(request)
     message_dict = await parse_nlu_api_request_for_message(request)
     if message_dict == ERROR_RESPONSE_DICT:
-        return ERROR_RESPONSE_DICT
+        return build_nlu_json_response(ERROR_RESPONSE_DICT)
 
     message_text = str(message_dict.get("message_body", ""))
     message_text = truncate_long_message_text(message_text)
-    log.info(f"Message text: {message_text}")
+    request_events.log_event("message_parsed", message_text=message_text)
     try:
         nlu_response = await asyncio.wait_for(
-            run_keyword_and_intent_evaluations(message_text),
-            TIMEOUT_THRESHOLD,
+            evaluation_single_flight.run(
+                ("nlu_intent_recognition", message_text),
+                run_keyword_and_intent_evaluations,
+                message_text,
+                deadline,
+                deadline=deadline,
+            ),
+            deadline.remaining_seconds(),
         )
     except asyncio.TimeoutError:
-        nlu_response = TIMEOUT_RESPONSE_DICT
+        nlu_response = deadline.timeout_response()
     except Exception as e:
         nlu_response = ERROR_RESPONSE_DICT
         log.error(f"NLU Intent Recognition Endpoint Exception: {e}")
-    return JSONResponse(content=nlu_response)
+    return build_nlu_json_response(nlu_response)
 
 
 @app.post("/v2/nlu")
@@ -112,24 +234,74 @@ async def v2_evaluate_user_message_with_nlu_api(request: Request):
     Output
     - int_data_dict or sent_data_dict: dict - the type of NLU run and result
     """
+    deadline = build_deadline_for_request(request)
     message_dict = await parse_nlu_api_request_for_message(request)
     if message_dict == ERROR_RESPONSE_DICT:
-        return ERROR_RESPONSE_DICT
+        return build_nlu_json_response(ERROR_RESPONSE_DICT)
 
-    message_text = str(message_dict.get("message_body", ""))
-    message_text = truncate_long_message_text(message_text)
-    expected_answer = str(message_dict.get("expected_answer", ""))
-    log.info(f"Message text: {message_text}, Expected answer: {expected_answer}")
-    try:
-        nlu_response = await asyncio.wait_for(
-            v2_evaluate_message_with_nlu(message_text, expected_answer),
-            TIMEOUT_THRESHOLD,
+    message_text, expected_answer = get_message_text_and_expected_answer(message_dict)
+    request_events.log_event(
+        "message_parsed", message_text=message_text, expected_answer=expected_answer
+    )
+    nlu_response = await run_v2_nlu_evaluation(
+        message_text, expected_answer, deadline
+    )
+    prepare_message_data_for_logging(message_dict, nlu_response)
+
+    return build_nlu_json_response(nlu_response)
+
+
+@app.post("/v2/nlu/batch")
+async def v2_evaluate_user_messages_with_nlu_batch_api(request: Request):
+    """Calls nlu evaluation for a list of messages and returns the nlu_responses in request order
+
+    Identical (message, expected answer) pairs are evaluated once, and the unique evaluations run concurrently so their model calls share micro-batches
+
+    Input
+    - request.body: json - {"message_data": [message data, ...]}
+
+    Output
+    - list of nlu_response dicts, with an error response for each invalid item
+    - a 413 with the error response if the batch has more than NLU_BATCH_MAX_SIZE messages
+    """
+    batch_deadline = build_deadline_for_request(request)
+    message_dicts = await parse_nlu_api_batch_request_for_messages(request)
+    if message_dicts == ERROR_RESPONSE_DICT:
+        return build_nlu_json_response(ERROR_RESPONSE_DICT)
+    if len(message_dicts) > NLU_BATCH_MAX_SIZE:
+        log.error(
+            f"Rejected a batch of {len(message_dicts)} messages, over the limit of {NLU_BATCH_MAX_SIZE}"
         )
-    except asyncio.TimeoutError:
-        nlu_response = TIMEOUT_RESPONSE_DICT
-    except Exception as e:
-        nlu_response = ERROR_RESPONSE_DICT
-        log.error(f"V2 NLU Endpoint Exception: {e}")
-    asyncio.create_task(prepare_message_data_for_logging(message_dict, nlu_response))
+        return build_nlu_json_response(ERROR_RESPONSE_DICT, status_code=413)
+
+    evaluations = {}
+    evaluation_keys = []
+    for message_dict in message_dicts:
+        if message_dict == ERROR_RESPONSE_DICT:
+            evaluation_keys.append(None)
+            continue
+        key = get_message_text_and_expected_answer(message_dict)
+        if key not in evaluations:
+            # Every evaluation tracks its own degraded state within the batch's time budget
+            deadline = Deadline(batch_deadline.remaining_ms())
+            evaluations[key] = asyncio.ensure_future(
+                run_v2_nlu_evaluation(*key, deadline)
+            )
+        evaluation_keys.append(key)
+    request_events.log_event(
+        "batch_planned",
+        batch_size=len(message_dicts),
+        unique_evaluations=len(evaluations),
+    )
+    await asyncio.gather(*evaluations.values())
+
+    nlu_responses = []
+    for message_dict, key in zip(message_dicts, evaluation_keys):
+        if key is None:
+            nlu_responses.append(ERROR_RESPONSE_DICT)
+            continue
+        nlu_response = evaluations[key].result()
+        nlu_responses.append(nlu_response)
+        prepare_message_data_for_logging(message_dict, nlu_response)
 
-    return JSONResponse(content=nlu_response)
+    return build_nlu_json_list_response(nlu_responses)
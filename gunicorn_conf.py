@@ -0,0 +1,72 @@
+"""Gunicorn settings for serving the FastAPI app with uvicorn workers
+
+To run locally use `gunicorn -c gunicorn_conf.py app:app`
+
+With PRELOAD_MODEL enabled, the master process imports the app and loads the intent model before it forks the workers.  gc.freeze() then moves every object created so far into the permanent generation.  The garbage collector never writes to those objects, so the model weights and other read-only structures stay shared between workers (copy-on-write) instead of being copied into each one.
+
+Compare worker memory with `python -m scripts.measure_worker_memory` while the server runs with PRELOAD_MODEL=true and PRELOAD_MODEL=false.
+
+With LOGGING_MODE=sidecar, the master also starts the logging sidecar (mathtext_fastapi/log_sidecar.py), the only process of the instance that connects to the database, and stops it after the workers have exited.
+"""
+import gc
+import os
+import subprocess
+import sys
+
+from mathtext_fastapi.constants import LOG_SIDECAR_SPAWN, LOGGING_MODE
+
+PRELOAD_MODEL = os.environ.get("PRELOAD_MODEL", "true").lower() == "true"
+SIDECAR_STOP_TIMEOUT_SECONDS = 30
+
+log_sidecar_process = None
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 3))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = PRELOAD_MODEL
+
+# Tokenizers must not start their thread pool in the master before forking
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+
+def start_log_sidecar(server):
+    global log_sidecar_process
+    log_sidecar_process = subprocess.Popen(
+        [sys.executable, "-m", "mathtext_fastapi.log_sidecar"]
+    )
+    server.log.info(f"Started the logging sidecar (pid {log_sidecar_process.pid})")
+
+
+def on_starting(server):
+    if LOGGING_MODE == "sidecar" and LOG_SIDECAR_SPAWN:
+        start_log_sidecar(server)
+    if not PRELOAD_MODEL:
+        return
+    # Avoid collections while the model is loading, they would only touch pages that are about to be frozen
+    gc.disable()
+
+    from mathtext_fastapi.inference import load_intent_recognizer_model
+
+    load_intent_recognizer_model()
+    server.log.info("Loaded the intent recognition model in the master process")
+
+
+def when_ready(server):
+    if not PRELOAD_MODEL:
+        return
+    gc.freeze()
+    # The master runs for the life of the instance, so it collects again from here on.  Workers forked later inherit both the frozen objects and the enabled collector.
+    gc.enable()
+    server.log.info(f"Froze {gc.get_freeze_count()} objects before forking workers")
+
+
+def on_exit(server):
+    if log_sidecar_process is None:
+        return
+    # The sidecar writes or spools the rows it still holds when it gets SIGTERM
+    log_sidecar_process.terminate()
+    try:
+        log_sidecar_process.wait(timeout=SIDECAR_STOP_TIMEOUT_SECONDS)
+    except subprocess.TimeoutExpired:
+        log_sidecar_process.kill()
+    server.log.info("Stopped the logging sidecar")
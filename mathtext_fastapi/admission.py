@@ -0,0 +1,145 @@
+""" Caps the number of NLU requests a worker evaluates at once and sheds the excess quickly when the wait queue is full """
+
+import asyncio
+import time
+
+from collections import deque
+
+from fastapi.responses import JSONResponse
+
+from mathtext_fastapi.constants import (
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT_MS,
+    ADMISSION_RETRY_AFTER_SECONDS,
+    TIMEOUT_RESPONSE_DICT,
+)
+from mathtext_fastapi.deadline import ARRIVAL_TIME_SCOPE_KEY
+
+class AdmissionRejected(Exception):
+    """Raised when a request arrives while the wait queue is full"""
+
+
+class AdmissionController:
+    """Admits up to max_in_flight requests at once and queues up to max_queue more
+
+    >>> controller = AdmissionController(max_in_flight=1, max_queue=1)
+    >>> async def hold_slot():
+    ...     await controller.acquire(1)
+    ...     await asyncio.sleep(0.01)
+    ...     controller.release()
+    >>> async def burst():
+    ...     return await asyncio.gather(*[hold_slot() for _ in range(3)], return_exceptions=True)
+    >>> [type(result).__name__ for result in asyncio.run(burst())]
+    ['NoneType', 'NoneType', 'AdmissionRejected']
+    >>> controller.get_stats()
+    {'accepted': 2, 'queued': 1, 'shed': 1, 'queue_timeouts': 0, 'in_flight': 0, 'queue_depth': 0, 'max_in_flight': 1, 'max_queue': 1}
+    """
+
+    def __init__(
+        self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_queue=ADMISSION_MAX_QUEUE
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiters = deque()
+        self.stats = {
+            "accepted": 0,
+            "queued": 0,
+            "shed": 0,
+            "queue_timeouts": 0,
+        }
+
+    async def acquire(self, timeout):
+        """Takes an evaluation slot, waiting up to timeout seconds in the queue
+
+        Raises AdmissionRejected when the queue is full and asyncio.TimeoutError when the wait runs out
+        """
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            self.in_flight += 1
+            self.stats["accepted"] += 1
+            return
+
+        if len(self.waiters) >= self.max_queue:
+            self.stats["shed"] += 1
+            raise AdmissionRejected()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.stats["queued"] += 1
+        try:
+            # release() hands its slot directly to the waiter, so in_flight does not change here
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended, so give it back
+                self.release()
+            else:
+                try:
+                    self.waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["queue_timeouts"] += 1
+            raise
+        self.stats["accepted"] += 1
+
+    def release(self):
+        """Frees a slot, handing it to the longest waiting request if there is one"""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "queue_depth": len(self.waiters),
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+        }
+
+
+def build_overloaded_response():
+    """A 503 that tells the client when to retry, with the timeout response the chatbot already handles"""
+    return JSONResponse(
+        content=TIMEOUT_RESPONSE_DICT,
+        status_code=503,
+        headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)},
+    )
+
+
+class AdmissionControlMiddleware:
+    """ASGI middleware that runs requests to the given paths through an AdmissionController
+
+    Rejected requests are answered before the request body is read.  They are counted in the controller's statistics instead of being logged one by one.  The arrival time is recorded in the scope, so the request's deadline includes the time it waited in the queue.
+    """
+
+    def __init__(self, app, controller, paths):
+        self.app = app
+        self.controller = controller
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        scope[ARRIVAL_TIME_SCOPE_KEY] = time.monotonic()
+        try:
+            await self.controller.acquire(ADMISSION_QUEUE_TIMEOUT_MS / 1000)
+        except (AdmissionRejected, asyncio.TimeoutError):
+            response = build_overloaded_response()
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release()
+
+
+nlu_admission_controller = AdmissionController()
@@ -1,87 +1,424 @@
+""" Caches NLU responses in an in-process LRU in front of Redis so repeated messages skip the evaluation pipeline """
+
+import asyncio
 import functools
+import inspect
 import json
-import redis
+import time
 
-from mathtext_fastapi.constants import REDIS_RESPONSE_CACHE_URL
+import redis
+import redis.asyncio
 
+from collections import OrderedDict
 from logging import getLogger
 
+from mathtext_fastapi.constants import (
+    REDIS_BREAKER_COOL_DOWN_SECONDS,
+    REDIS_BREAKER_FAILURE_THRESHOLD,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_MAX_PENDING_WRITES,
+    REDIS_RESPONSE_CACHE_URL,
+    REDIS_SOCKET_TIMEOUT_MS,
+    REDIS_WRITE_BATCH_SIZE,
+    REDIS_WRITE_INTERVAL_MS,
+    RESPONSE_CACHE_MAX_SIZE,
+    RESPONSE_CACHE_TTL_SECONDS,
+)
+from mathtext_fastapi.fingerprint import PIPELINE_FINGERPRINT
+
 log = getLogger(__name__)
 
-r = redis.StrictRedis.from_url(REDIS_RESPONSE_CACHE_URL)
+UNCACHEABLE_RESPONSE_TYPES = ["error", "timeout"]
+
+
+class ResponseLRU:
+    """Keeps up to max_size entries for ttl_seconds each, evicting the least recently used first
+
+    >>> lru = ResponseLRU(max_size=2, ttl_seconds=60)
+    >>> lru.set("a", "1"); lru.set("b", "2")
+    >>> lru.get("a")
+    '1'
+    >>> lru.set("c", "3")
+    >>> lru.get("b") is None
+    True
+    >>> ResponseLRU(max_size=2, ttl_seconds=0).get("a") is None
+    True
+    """
+
+    def __init__(
+        self, max_size=RESPONSE_CACHE_MAX_SIZE, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (value, time.monotonic() + self.ttl_seconds)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class CircuitBreaker:
+    """Stops calls to a failing service for cool_down_seconds after failure_threshold failures in a row
+
+    After the cool-down, one call is let through to probe the service.  A success closes the breaker and a failure opens it again.
+
+    >>> breaker = CircuitBreaker(failure_threshold=2, cool_down_seconds=60)
+    >>> breaker.record_failure(); breaker.record_failure()
+    >>> breaker.allow_request()
+    False
+    >>> breaker.state
+    'open'
+    """
+
+    def __init__(
+        self,
+        failure_threshold=REDIS_BREAKER_FAILURE_THRESHOLD,
+        cool_down_seconds=REDIS_BREAKER_COOL_DOWN_SECONDS,
+    ):
+        self.failure_threshold = failure_threshold
+        self.cool_down_seconds = cool_down_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.stats = {"opened": 0, "short_circuited": 0}
+
+    def allow_request(self):
+        if self.state == "closed":
+            return True
+        # Probes again if the last probe never reported back (for example, it was cancelled)
+        if time.monotonic() - self.opened_at >= self.cool_down_seconds:
+            self.state = "half_open"
+            self.opened_at = time.monotonic()
+            return True
+        self.stats["short_circuited"] += 1
+        return False
+
+    def record_success(self):
+        self.state = "closed"
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if (
+            self.state == "half_open"
+            or self.consecutive_failures >= self.failure_threshold
+        ):
+            if self.state != "open":
+                self.stats["opened"] += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+def create_redis_client(url=REDIS_RESPONSE_CACHE_URL):
+    """Creates an async Redis client on a bounded connection pool with short timeouts"""
+    timeout_seconds = REDIS_SOCKET_TIMEOUT_MS / 1000
+    pool = redis.asyncio.BlockingConnectionPool.from_url(
+        url,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=timeout_seconds,
+        socket_timeout=timeout_seconds,
+        socket_connect_timeout=timeout_seconds,
+    )
+    return redis.asyncio.Redis(connection_pool=pool)
+
+
+async def close_redis_client(client):
+    try:
+        await client.aclose()
+    except (redis.exceptions.RedisError, OSError, RuntimeError) as e:
+        # RuntimeError: the connections belong to an event loop that has closed
+        log.warning(f"Closing a Redis client failed: {e}")
+
+
+class RedisResponseCache:
+    """Reads responses from Redis with one GET and writes them behind the request in pipelined batches
 
+    redis.asyncio connections belong to the event loop that opened them, so each loop gets its own client from client_factory.  Lookups and writes are skipped while the circuit breaker is open.
 
-def create_hash_key(function_name, function_input):
+    >>> import fakeredis
+    >>> cache = RedisResponseCache(client_factory=fakeredis.FakeAsyncRedis)
+    >>> async def write_then_read():
+    ...     cache.set_later("key", "value")
+    ...     await cache.drain()
+    ...     return await cache.get("key")
+    >>> asyncio.run(write_then_read())
+    b'value'
+    """
+
+    def __init__(
+        self,
+        client_factory=None,
+        breaker=None,
+        ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+        write_interval_ms=REDIS_WRITE_INTERVAL_MS,
+        write_batch_size=REDIS_WRITE_BATCH_SIZE,
+        max_pending_writes=REDIS_MAX_PENDING_WRITES,
+    ):
+        if client_factory is None and REDIS_RESPONSE_CACHE_URL:
+            client_factory = create_redis_client
+        self.client_factory = client_factory
+        self.breaker = breaker or CircuitBreaker()
+        self.ttl_seconds = int(ttl_seconds)
+        self.write_interval_ms = write_interval_ms
+        self.write_batch_size = write_batch_size
+        self.max_pending_writes = max_pending_writes
+        self.clients = {}
+        self.closing_tasks = set()
+        self.pending_writes = {}
+        self.writer_task = None
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "errors": 0,
+            "writes": 0,
+            "write_batches": 0,
+            "dropped_writes": 0,
+        }
+
+    def get_client(self):
+        if self.client_factory is None:
+            return None
+        loop = asyncio.get_running_loop()
+        client = self.clients.get(loop)
+        if client is None:
+            self.close_other_clients(loop)
+            client = self.client_factory()
+            self.clients[loop] = client
+        return client
+
+    def close_other_clients(self, loop):
+        """Closes the clients of other event loops before they are dropped, so their connection pools are released
+
+        A client is closed on its own loop while that loop is open, and on the current loop once its loop has closed
+        """
+        for client_loop, client in list(self.clients.items()):
+            if client_loop is loop:
+                continue
+            del self.clients[client_loop]
+            if client_loop.is_closed():
+                closing_task = loop.create_task(close_redis_client(client))
+                self.closing_tasks.add(closing_task)
+                closing_task.add_done_callback(self.closing_tasks.discard)
+            else:
+                asyncio.run_coroutine_threadsafe(close_redis_client(client), client_loop)
+
+    async def close(self):
+        """Closes the client of the running loop, for worker shutdown"""
+        client = self.clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await close_redis_client(client)
+
+    def record_error(self, action, e):
+        self.stats["errors"] += 1
+        self.breaker.record_failure()
+        log.error(f"Redis failed during {action}: {e}")
+
+    async def get(self, hash_key):
+        """Returns the serialized response for hash_key, or None if it is missing or Redis is unavailable"""
+        client = self.get_client()
+        if client is None or not self.breaker.allow_request():
+            return None
+        try:
+            result = await client.get(hash_key)
+        except (redis.exceptions.RedisError, OSError) as e:
+            self.record_error("look up", e)
+            return None
+        self.breaker.record_success()
+        if result is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return result
+
+    def set_later(self, hash_key, serialized_result):
+        """Queues a write for the background writer, dropping it if the queue is full"""
+        if self.client_factory is None:
+            return
+        if (
+            hash_key not in self.pending_writes
+            and len(self.pending_writes) >= self.max_pending_writes
+        ):
+            self.stats["dropped_writes"] += 1
+            return
+        self.pending_writes[hash_key] = serialized_result
+        loop = asyncio.get_running_loop()
+        if (
+            self.writer_task is None
+            or self.writer_task.done()
+            or self.writer_task.get_loop() is not loop
+        ):
+            self.writer_task = loop.create_task(self.write_pending())
+
+    async def write_pending(self):
+        """Waits one write interval so concurrent requests share a batch, then writes until the queue is empty"""
+        await asyncio.sleep(self.write_interval_ms / 1000)
+        while self.pending_writes:
+            await self.write_batch()
+
+    async def write_batch(self):
+        """Sends up to write_batch_size queued writes as SETEX commands in one pipeline"""
+        batch = []
+        for hash_key in list(self.pending_writes)[: self.write_batch_size]:
+            batch.append((hash_key, self.pending_writes.pop(hash_key)))
+        if not self.breaker.allow_request():
+            self.stats["dropped_writes"] += len(batch)
+            return
+        try:
+            async with self.get_client().pipeline(transaction=False) as pipe:
+                for hash_key, serialized_result in batch:
+                    pipe.setex(hash_key, self.ttl_seconds, serialized_result)
+                await pipe.execute()
+        except (redis.exceptions.RedisError, OSError) as e:
+            self.stats["dropped_writes"] += len(batch)
+            self.record_error("write", e)
+            return
+        self.breaker.record_success()
+        self.stats["writes"] += len(batch)
+        self.stats["write_batches"] += 1
+
+    async def drain(self):
+        """Writes everything still queued, for worker shutdown"""
+        while self.pending_writes:
+            await self.write_batch()
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "pending_writes": len(self.pending_writes),
+            "breaker": self.breaker.get_stats(),
+        }
+
+
+response_lru = ResponseLRU()
+redis_response_cache = RedisResponseCache()
+memory_cache_stats = {"hits": 0, "misses": 0}
+
+
+def create_hash_key(function_name, function_input, namespace=PIPELINE_FINGERPRINT):
     """Creates a hash key describing the object inputs
     https://redis.io/docs/data-types/tutorial/
 
+    The key uses the exact inputs.  Responses echo the raw student message and expected answer, so inputs that only normalize to the same text cannot share a response.
+
+    Keys start with the pipeline fingerprint.  After a deploy that changes mathtext, the model, or the intent settings, the new code reads and writes a fresh namespace, and the old keys are left to expire with their TTL instead of being flushed.
+
     Note: Not all functions use the expected_answer
+
+    >>> create_hash_key("v2_nlu", ["Maybe 5", "5"], namespace="8a61c76761d3")
+    '8a61c76761d3:v2_nlu:given_answer:Maybe 5:expected_answer:5'
+    >>> create_hash_key("nlu_intent_recognition", ["menu"], namespace="8a61c76761d3")
+    '8a61c76761d3:nlu_intent_recognition:given_answer:menu'
     """
     given_answer = function_input[0]
     expected_answer = function_input[1] if len(function_input) == 2 else None
 
     given_answer_str = f"given_answer:{given_answer}"
     expected_answer_str = ""
-    if expected_answer:
-        expected_answer = f":expected_answer:{expected_answer}"
-    hash_key = f"{function_name}:{given_answer_str}{expected_answer_str}"
+    if expected_answer is not None:
+        expected_answer_str = f":expected_answer:{expected_answer}"
+    hash_key = f"{namespace}:{function_name}:{given_answer_str}{expected_answer_str}"
     return hash_key
 
 
-def check_redis(hash_key, input):
-    """Checks if the user input has an existing key in the cache
+def is_cacheable_response(result):
+    """Only complete responses are cached, never degraded, timeout, or error responses
 
-    Returns the cache item if found or None if not found
+    >>> is_cacheable_response({'type': 'correct_answer', 'data': '6', 'confidence': 1.0})
+    True
+    >>> is_cacheable_response({'type': 'out_of_scope', 'data': 'hi', 'confidence': 0.0, 'degraded': True})
+    False
     """
-    try:
-        if r.exists(hash_key):
-            # Gets the result if it exists
-            result = r.get(hash_key)
-            return json.loads(result)
-    except redis.exceptions.RedisError as e:
-        log.error(f"Redis failed during look up: {e}")
-    return None
+    return (
+        bool(result)
+        and not result.get("degraded", False)
+        and result.get("type") not in UNCACHEABLE_RESPONSE_TYPES
+    )
 
 
-def add_to_redis(hash_key, input, result):
-    """Adds the an unstored nlu response object to the cache"""
-    try:
-        r.set(hash_key, json.dumps(result))
-    except redis.exceptions.RedisError as e:
-        log.error(f"Redis failed during write: {e} / {result}")
-        return False
-    return True
+async def check_cache(hash_key):
+    """Looks up a response in the in-process LRU, then in Redis"""
+    serialized_result = response_lru.get(hash_key)
+    if serialized_result is not None:
+        memory_cache_stats["hits"] += 1
+        return json.loads(serialized_result)
+    memory_cache_stats["misses"] += 1
 
+    serialized_result = await redis_response_cache.get(hash_key)
+    if serialized_result is None:
+        return None
+    response_lru.set(hash_key, serialized_result)
+    return json.loads(serialized_result)
 
-def get_or_create_redis_entry(function_name):
+
+def add_to_cache(hash_key, result):
+    """Stores a response in the LRU and queues the Redis write, serializing it once"""
+    serialized_result = json.dumps(result)
+    response_lru.set(hash_key, serialized_result)
+    redis_response_cache.set_later(hash_key, serialized_result)
+
+
+def get_or_create_cache_entry(function_name):
     def decorator(func):
-        """A decorator function that handles using and caching the function result"""
+        """A decorator function that handles using and caching the result of an async evaluation
+
+        The deadline argument is not part of the key.  Responses that the deadline cut short are not cached.
+        """
+        signature = inspect.signature(func)
 
         @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            # args: positional arguments
-            # kwargs: keyword arguments
-            func_input = args
-            hash_key = create_hash_key(function_name, func_input)
+        async def wrapper(*args, **kwargs):
+            func_input = signature.bind(*args, **kwargs).arguments
+            hash_key = create_hash_key(
+                function_name,
+                [value for name, value in func_input.items() if name != "deadline"],
+            )
 
             # Examine the cache and return the result
-            redis_result = check_redis(hash_key, func_input)
-            if redis_result:
-                # print(f"Redis Result: {redis_result}")
-                return redis_result
+            cached_result = await check_cache(hash_key)
+            if cached_result:
+                return cached_result
 
             # Run the actual function
-            result = func(*args, **kwargs)
+            result = await func(*args, **kwargs)
 
             # Update the cache with a new value
-            add_to_redis(hash_key, func_input, result)
-            # print(f"New Result: {result}")
-
-            # Return the decorated function's result
+            if is_cacheable_response(result):
+                add_to_cache(hash_key, result)
             return result
 
-        # Signifies the completion of the decorator itself
-        # Decorator replaces the decorated function
         return wrapper
 
     return decorator
+
+
+def get_cache_stats():
+    return {
+        "namespace": PIPELINE_FINGERPRINT,
+        "memory": {**memory_cache_stats, "size": len(response_lru.entries)},
+        "redis": redis_response_cache.get_stats(),
+    }
@@ -38,14 +38,137 @@ SUPABASE_URL = os.environ.get("SUPABASE_URL")
 
 # Cache for NLU Response
 REDIS_RESPONSE_CACHE_URL = os.environ.get("REDIS_RESPONSE_CACHE_URL", "")
+# In-process LRU in front of Redis (a max size of 0 turns it off)
+RESPONSE_CACHE_MAX_SIZE = int(os.environ.get("RESPONSE_CACHE_MAX_SIZE", 10000))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 3600))
+# Redis connection pool (per uvicorn worker); lookups give up after the socket timeout
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 20))
+REDIS_SOCKET_TIMEOUT_MS = float(os.environ.get("REDIS_SOCKET_TIMEOUT_MS", 100))
+# Cache writes are queued and sent in pipelined batches off the request path
+REDIS_WRITE_INTERVAL_MS = float(os.environ.get("REDIS_WRITE_INTERVAL_MS", 10))
+REDIS_WRITE_BATCH_SIZE = int(os.environ.get("REDIS_WRITE_BATCH_SIZE", 100))
+REDIS_MAX_PENDING_WRITES = int(os.environ.get("REDIS_MAX_PENDING_WRITES", 1000))
+# Stop contacting Redis for a cool-down period after this many failures in a row
+REDIS_BREAKER_FAILURE_THRESHOLD = int(
+    os.environ.get("REDIS_BREAKER_FAILURE_THRESHOLD", 5)
+)
+REDIS_BREAKER_COOL_DOWN_SECONDS = float(
+    os.environ.get("REDIS_BREAKER_COOL_DOWN_SECONDS", 30)
+)
 
-# Cutoff time for NLU endpoint
-TIMEOUT_THRESHOLD = int(os.environ.get("TIMEOUT_THRESHOLD"))
+# Cutoff time for NLU endpoint (TIMEOUT_THRESHOLD is in seconds)
+TIMEOUT_THRESHOLD = float(os.environ.get("TIMEOUT_THRESHOLD"))
+TIMEOUT_THRESHOLD_MS = float(
+    os.environ.get("TIMEOUT_THRESHOLD_MS", TIMEOUT_THRESHOLD * 1000)
+)
+# Optional request header (in milliseconds) that shortens the cutoff time
+TIMEOUT_HEADER = "X-Request-Timeout-Ms"
+# The intent model stage is skipped when less time than this is left
+MODEL_STAGE_MIN_BUDGET_MS = float(os.environ.get("MODEL_STAGE_MIN_BUDGET_MS", 150))
 ERROR_RESPONSE_DICT = build_single_event_nlu_response("error", TOKENS2INT_ERROR_INT, 0)
 TIMEOUT_RESPONSE_DICT = build_single_event_nlu_response(
     "timeout", TOKENS2INT_ERROR_INT, 0
 )
 
+# "direct": each worker writes request logs to the database with its own connection pool
+# "sidecar": workers send request logs to one local logging process (mathtext_fastapi/log_sidecar.py) over a Unix socket
+LOGGING_MODE = os.environ.get("LOGGING_MODE", "direct")
+LOG_DB_POOL_SIZE = int(os.environ.get("LOG_DB_POOL_SIZE", 20))
+# The pool is resized between LOG_DB_POOL_MIN_SIZE and LOG_DB_POOL_SIZE from the connections used at once in each interval
+LOG_DB_POOL_MIN_SIZE = int(os.environ.get("LOG_DB_POOL_MIN_SIZE", 1))
+LOG_DB_POOL_HEADROOM = int(os.environ.get("LOG_DB_POOL_HEADROOM", 1))
+LOG_DB_POOL_RESIZE_INTERVAL_SECONDS = float(
+    os.environ.get("LOG_DB_POOL_RESIZE_INTERVAL_SECONDS", 60)
+)
+LOG_DB_POOL_SHRINK_AFTER_WINDOWS = int(
+    os.environ.get("LOG_DB_POOL_SHRINK_AFTER_WINDOWS", 3)
+)
+# Connections the pool may open beyond its size, as a share of the size, so the ceiling follows each resize
+LOG_DB_POOL_MAX_OVERFLOW_RATIO = float(
+    os.environ.get("LOG_DB_POOL_MAX_OVERFLOW_RATIO", 0.5)
+)
+# Pooled connections are checked with a background SELECT 1 at this interval (0 pings on every checkout instead)
+LOG_DB_LIVENESS_INTERVAL_SECONDS = float(
+    os.environ.get("LOG_DB_LIVENESS_INTERVAL_SECONDS", 30)
+)
+LOG_SIDECAR_DB_POOL_SIZE = int(os.environ.get("LOG_SIDECAR_DB_POOL_SIZE", 4))
+LOG_SIDECAR_SOCKET_PATH = os.environ.get(
+    "LOG_SIDECAR_SOCKET_PATH", "/tmp/mathtext-log-sidecar.sock"
+)
+LOG_SIDECAR_TIMEOUT_MS = float(os.environ.get("LOG_SIDECAR_TIMEOUT_MS", 1000))
+# Whether gunicorn starts the sidecar (turn off when it runs as its own container or service)
+LOG_SIDECAR_SPAWN = os.environ.get("LOG_SIDECAR_SPAWN", "true").lower() == "true"
+
+# Request logs are written when the batch is full or its oldest row is this old
+LOG_FLUSH_MAX_AGE_SECONDS = float(os.environ.get("LOG_FLUSH_MAX_AGE_SECONDS", 5))
+
+# Request logs waiting to be written are capped at LOG_QUEUE_MAX_ROWS per worker
+# When the queue is full, "drop_oldest" drops the oldest rows and "sample" keeps a uniform sample of the rows
+LOG_QUEUE_MAX_ROWS = int(os.environ.get("LOG_QUEUE_MAX_ROWS", 3000))
+LOG_QUEUE_OVERFLOW_POLICY = os.environ.get("LOG_QUEUE_OVERFLOW_POLICY", "drop_oldest")
+
+# Request fields kept in the request log ("*" keeps every field except author_id, the phone number)
+LOG_REQUEST_FIELDS = os.environ.get(
+    "LOG_REQUEST_FIELDS",
+    "author_type,contact_uuid,message_body,expected_answer,message_direction,"
+    "message_id,message_inserted_at,message_updated_at",
+)
+
+# Share of requests whose request-path events are logged at INFO, as comma-separated endpoint=rate pairs
+# Endpoints without a rate use LOG_EVENT_DEFAULT_SAMPLE_RATE
+LOG_EVENT_SAMPLE_RATES = os.environ.get("LOG_EVENT_SAMPLE_RATES", "")
+LOG_EVENT_DEFAULT_SAMPLE_RATE = float(os.environ.get("LOG_EVENT_DEFAULT_SAMPLE_RATE", 1.0))
+
+# Failed request-log writes are retried after exponential backoff with full jitter
+# A write stops retrying after LOG_WRITE_RETRY_LIMIT retries or LOG_WRITE_RETRY_BUDGET_SECONDS of waiting
+LOG_WRITE_RETRY_LIMIT = int(os.environ.get("LOG_WRITE_RETRY_LIMIT", 4))
+LOG_WRITE_BACKOFF_BASE_MS = float(os.environ.get("LOG_WRITE_BACKOFF_BASE_MS", 100))
+LOG_WRITE_BACKOFF_MAX_MS = float(os.environ.get("LOG_WRITE_BACKOFF_MAX_MS", 5000))
+LOG_WRITE_RETRY_BUDGET_SECONDS = float(
+    os.environ.get("LOG_WRITE_RETRY_BUDGET_SECONDS", 10)
+)
+
+# Request logs that cannot be written to the database are spooled to local disk and replayed later
+# On Cloud Run the writable filesystem is held in instance memory, so a full spool costs up to LOG_SPOOL_MAX_BYTES of RAM per instance on top of the workers.  Keep the cap small there, or point LOG_SPOOL_DIR at a mounted volume before raising it.
+LOG_SPOOL_ENABLED = os.environ.get("LOG_SPOOL_ENABLED", "true").lower() == "true"
+LOG_SPOOL_DIR = os.environ.get("LOG_SPOOL_DIR", "/tmp/mathtext-log-spool")
+LOG_SPOOL_SEGMENT_BYTES = int(os.environ.get("LOG_SPOOL_SEGMENT_BYTES", 4 * 2**20))
+LOG_SPOOL_MAX_BYTES = int(os.environ.get("LOG_SPOOL_MAX_BYTES", 32 * 2**20))
+LOG_SPOOL_REPLAY_INTERVAL_SECONDS = float(
+    os.environ.get("LOG_SPOOL_REPLAY_INTERVAL_SECONDS", 10)
+)
+LOG_SPOOL_REPLAY_BATCH_ROWS = int(os.environ.get("LOG_SPOOL_REPLAY_BATCH_ROWS", 5000))
+
+# Run canned messages through the pipeline before the worker reports ready
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "true").lower() == "true"
+
+# Admission control for the NLU endpoints (per worker)
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", 32))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 64))
+ADMISSION_QUEUE_TIMEOUT_MS = float(
+    os.environ.get("ADMISSION_QUEUE_TIMEOUT_MS", TIMEOUT_THRESHOLD_MS)
+)
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get("ADMISSION_RETRY_AFTER_SECONDS", 1))
+
+# A /v2/nlu/batch request holds one admission slot, so its size is capped
+NLU_BATCH_MAX_SIZE = int(os.environ.get("NLU_BATCH_MAX_SIZE", 50))
+
+# Executor for intent model inference ("thread" or "process"), sized per uvicorn worker
+INFERENCE_EXECUTOR_TYPE = os.environ.get("INFERENCE_EXECUTOR_TYPE", "thread")
+INFERENCE_EXECUTOR_WORKERS = int(os.environ.get("INFERENCE_EXECUTOR_WORKERS", 2))
+
+# Micro-batching of concurrent intent predictions (a max batch size of 1 turns it off)
+INTENT_BATCH_WINDOW_MS = float(os.environ.get("INTENT_BATCH_WINDOW_MS", 5))
+INTENT_BATCH_MAX_SIZE = int(os.environ.get("INTENT_BATCH_MAX_SIZE", 16))
+
+# Precomputed responses for common (message, expected answer) pairs (see scripts/build_response_table.py)
+RESPONSE_TABLE_PATH = os.environ.get(
+    "RESPONSE_TABLE_PATH", str(DATA_DIR / "response_table.bin")
+)
+
+# Number of distinct expected answers whose precomputed profiles are kept
+ANSWER_PROFILE_CACHE_SIZE = int(os.environ.get("ANSWER_PROFILE_CACHE_SIZE", 4096))
+
 # Settings for NLU intent recognition
 APPROVED_KEYWORDS = ["help", "menu", "stop", "support"]
 APPROVED_INTENTS = [
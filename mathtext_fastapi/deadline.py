@@ -0,0 +1,131 @@
+""" Tracks the time budget of a request so each evaluation stage can decide whether it still has time to run """
+
+import time
+
+from logging import getLogger
+
+from mathtext_fastapi.constants import (
+    MODEL_STAGE_MIN_BUDGET_MS,
+    TIMEOUT_HEADER,
+    TIMEOUT_RESPONSE_DICT,
+    TIMEOUT_THRESHOLD_MS,
+)
+
+log = getLogger(__name__)
+
+# The ASGI scope key where the admission middleware records when a request arrived, so time spent in the admission queue counts against the deadline
+ARRIVAL_TIME_SCOPE_KEY = "mathtext.arrived_at"
+
+
+class Deadline:
+    """The point in time by which an evaluation must return a response
+
+    Stages that are skipped for lack of time mark the deadline as degraded, and the best result found so far is kept so a timeout does not throw it away
+
+    >>> deadline = Deadline(1000)
+    >>> deadline.has_budget_for(500)
+    True
+    >>> deadline.degraded
+    False
+    >>> deadline = Deadline(0)
+    >>> deadline.has_budget_for(500)
+    False
+    >>> deadline.degraded
+    True
+    """
+
+    def __init__(self, timeout_ms=TIMEOUT_THRESHOLD_MS, started_at=None):
+        self.timeout_ms = timeout_ms
+        if started_at is None:
+            started_at = time.monotonic()
+        self.expires_at = started_at + timeout_ms / 1000
+        self.degraded = False
+        self.best_result = {}
+
+    def remaining_ms(self):
+        return max(0.0, (self.expires_at - time.monotonic()) * 1000)
+
+    def remaining_seconds(self):
+        return self.remaining_ms() / 1000
+
+    def has_budget_for(self, stage_ms):
+        """Checks whether a stage fits in the remaining budget and marks the evaluation degraded if not"""
+        if self.remaining_ms() >= stage_ms:
+            return True
+        self.degraded = True
+        return False
+
+    def record_result(self, result):
+        """Keeps a result that can be returned if the evaluation runs out of time"""
+        if result:
+            self.best_result = result
+
+    def mark_response(self, nlu_response):
+        """Flags a response that was built without running every stage
+
+        >>> deadline = Deadline(1000)
+        >>> deadline.mark_response({'type': 'correct_answer', 'data': '8', 'confidence': 1.0})
+        {'type': 'correct_answer', 'data': '8', 'confidence': 1.0}
+        >>> deadline.degraded = True
+        >>> deadline.mark_response({'type': 'correct_answer', 'data': '8', 'confidence': 1.0})
+        {'type': 'correct_answer', 'data': '8', 'confidence': 1.0, 'degraded': True}
+        """
+        if self.degraded and nlu_response:
+            return {**nlu_response, "degraded": True}
+        return nlu_response
+
+    def timeout_response(self):
+        """Returns the best result found before the deadline passed, or the timeout response if there is none
+
+        >>> deadline = Deadline(0)
+        >>> deadline.timeout_response()["type"]
+        'timeout'
+        >>> deadline.record_result({'type': 'wrong_answer', 'data': 'B', 'confidence': 1.0})
+        >>> deadline.timeout_response()
+        {'type': 'wrong_answer', 'data': 'B', 'confidence': 1.0, 'degraded': True}
+        """
+        if self.best_result:
+            return {**self.best_result, "degraded": True}
+        return TIMEOUT_RESPONSE_DICT
+
+
+def has_budget_for_model_stage(deadline):
+    """Checks whether there is time left for an intent model call
+
+    Evaluations without a deadline always run the model
+    """
+    return deadline is None or deadline.has_budget_for(MODEL_STAGE_MIN_BUDGET_MS)
+
+
+def record_stage_result(deadline, result):
+    """Keeps the result of an evaluation stage on the deadline, so a timeout before the response is sent can still return it
+
+    >>> deadline = Deadline(1000)
+    >>> record_stage_result(deadline, {'type': 'keyword', 'data': 'menu', 'confidence': 1.0})
+    {'type': 'keyword', 'data': 'menu', 'confidence': 1.0}
+    >>> deadline.best_result
+    {'type': 'keyword', 'data': 'menu', 'confidence': 1.0}
+    >>> record_stage_result(None, {})
+    {}
+    """
+    if deadline is not None:
+        deadline.record_result(result)
+    return result
+
+
+def build_deadline_for_request(request):
+    """Starts the deadline of a request from the time it arrived, before any wait for admission
+
+    The TIMEOUT_HEADER header (in milliseconds) can shorten the budget below TIMEOUT_THRESHOLD_MS but not extend it
+    """
+    timeout_ms = TIMEOUT_THRESHOLD_MS
+    header_value = request.headers.get(TIMEOUT_HEADER)
+    if header_value:
+        try:
+            requested_timeout_ms = float(header_value)
+        except ValueError:
+            log.info(f"Ignoring invalid {TIMEOUT_HEADER} header: {header_value}")
+        else:
+            if requested_timeout_ms > 0:
+                timeout_ms = min(timeout_ms, requested_timeout_ms)
+    return Deadline(timeout_ms, started_at=request.scope.get(ARRIVAL_TIME_SCOPE_KEY))
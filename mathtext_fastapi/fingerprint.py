@@ -0,0 +1,42 @@
+""" Fingerprints the parts of the pipeline that decide a response, so cached and precomputed responses from another version are never served """
+
+import hashlib
+import importlib.metadata
+import json
+
+from mathtext.predict_intent import MODEL_BUCKET, MODEL_KEY
+
+from mathtext_fastapi.constants import (
+    APPROVED_INTENT_CONFIDENCE_THRESHOLD,
+    APPROVED_INTENTS,
+    APPROVED_KEYWORDS,
+)
+
+
+def describe_pipeline():
+    """Lists the versions and settings that a response depends on
+
+    The model is identified by its object storage path, which includes the model version
+    """
+    return {
+        "mathtext_version": importlib.metadata.version("mathtext"),
+        "model": str(MODEL_BUCKET / MODEL_KEY),
+        "approved_intent_confidence_threshold": APPROVED_INTENT_CONFIDENCE_THRESHOLD,
+        "approved_intents": APPROVED_INTENTS,
+        "approved_keywords": APPROVED_KEYWORDS,
+    }
+
+
+def compute_pipeline_fingerprint(pipeline_description):
+    """A short hash of a pipeline description
+
+    >>> compute_pipeline_fingerprint({"mathtext_version": "2.0.4"})
+    '8a61c76761d3'
+    >>> compute_pipeline_fingerprint({"mathtext_version": "2.0.4"}) == compute_pipeline_fingerprint({"mathtext_version": "2.0.5"})
+    False
+    """
+    serialized_description = json.dumps(pipeline_description, sort_keys=True)
+    return hashlib.sha256(serialized_description.encode("utf-8")).hexdigest()[:12]
+
+
+PIPELINE_FINGERPRINT = compute_pipeline_fingerprint(describe_pipeline())
@@ -0,0 +1,260 @@
+""" Runs intent model inference in a dedicated executor so that a torch forward pass never blocks the event loop
+
+Concurrent predictions are gathered by a micro-batcher into a single batched forward pass
+"""
+
+import asyncio
+import joblib
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging import getLogger
+
+import mathtext.predict_intent
+from mathtext.predict_intent import (
+    MODEL_BUCKET,
+    MODEL_KEY,
+    download_model,
+    predict_message_intent,
+)
+
+from mathtext_fastapi.constants import (
+    INFERENCE_EXECUTOR_TYPE,
+    INFERENCE_EXECUTOR_WORKERS,
+    INTENT_BATCH_MAX_SIZE,
+    INTENT_BATCH_WINDOW_MS,
+)
+
+log = getLogger(__name__)
+
+model_load_lock = threading.Lock()
+
+# Created lazily so that each uvicorn worker builds its own pool after startup
+inference_executor = None
+
+inference_stats = {
+    "submitted": 0,
+    "completed": 0,
+    "failed": 0,
+    "in_flight": 0,
+}
+
+
+def get_inference_executor():
+    """Returns the worker's inference executor, creating it on first use"""
+    global inference_executor
+    if inference_executor is None:
+        if INFERENCE_EXECUTOR_TYPE == "process":
+            inference_executor = ProcessPoolExecutor(
+                max_workers=INFERENCE_EXECUTOR_WORKERS
+            )
+        else:
+            inference_executor = ThreadPoolExecutor(
+                max_workers=INFERENCE_EXECUTOR_WORKERS,
+                thread_name_prefix="intent-inference",
+            )
+        log.info(
+            f"Started {INFERENCE_EXECUTOR_TYPE} inference executor with {INFERENCE_EXECUTOR_WORKERS} workers"
+        )
+    return inference_executor
+
+
+def shutdown_inference_executor():
+    """Stops the inference executor without waiting on abandoned predictions"""
+    global inference_executor
+    if inference_executor is not None:
+        inference_executor.shutdown(wait=False, cancel_futures=True)
+        inference_executor = None
+
+
+async def run_in_inference_executor(func, *args):
+    """Runs a model call in the inference executor and tracks the executor's load
+
+    Cancelling the awaiting coroutine (ie, asyncio.wait_for timing out) frees the request immediately.  A prediction that already started still finishes in the background.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_inference_executor()
+
+    inference_stats["submitted"] += 1
+    inference_stats["in_flight"] += 1
+    try:
+        result = await loop.run_in_executor(executor, func, *args)
+    except Exception:
+        inference_stats["failed"] += 1
+        raise
+    else:
+        inference_stats["completed"] += 1
+    finally:
+        inference_stats["in_flight"] -= 1
+    return result
+
+
+def load_intent_recognizer_model():
+    """Loads the intent model once and shares it with mathtext.predict_intent"""
+    with model_load_lock:
+        if mathtext.predict_intent.INTENT_RECOGNIZER_MODEL is None:
+            mathtext.predict_intent.INTENT_RECOGNIZER_MODEL = joblib.load(
+                download_model(MODEL_BUCKET / MODEL_KEY)
+            )
+    return mathtext.predict_intent.INTENT_RECOGNIZER_MODEL
+
+
+def format_intent_prediction(pred_probas, label_mapping, min_confidence=0.5):
+    """Builds the predict_message_intent response for one row of model probabilities
+
+    >>> result = format_intent_prediction([0.1, 0.7, 0.2, 0.05], ["yes", "no", "help", "stop"])
+    >>> result["data"], result["confidence"]
+    ('no', 0.7)
+    >>> [intent["data"] for intent in result["intents"]]
+    ['no', 'help', 'yes']
+    >>> format_intent_prediction([0.1, 0.3], ["yes", "no"])["data"]
+    'no_match'
+    """
+    predict_probas = [
+        {"type": "intent", "data": name, "confidence": float(conf)}
+        for name, conf in zip(label_mapping, pred_probas)
+    ]
+    intents = sorted(predict_probas, key=lambda x: x["confidence"], reverse=True)[:3]
+
+    data = intents[0]["data"]
+    confidence = intents[0]["confidence"]
+    if confidence < min_confidence:
+        data = "no_match"
+        confidence = 0
+
+    return {
+        "type": "intent",
+        "data": data,
+        "confidence": confidence,
+        "intents": [intent.copy() for intent in intents],
+        "predict_probas": predict_probas,
+    }
+
+
+def predict_message_intents_batch(messages):
+    """Runs a single forward pass of the intent model over a list of messages
+
+    Returns one predict_message_intent response per message, in the same order
+    """
+    model = load_intent_recognizer_model()
+    pred_probas_batch = model.predict_proba(list(messages))
+    return [
+        format_intent_prediction(pred_probas, model.label_mapping)
+        for pred_probas in pred_probas_batch
+    ]
+
+
+class IntentMicroBatcher:
+    """Gathers intent predictions that arrive within a short window into one batched forward pass
+
+    A batch runs when the window closes or when it reaches max_batch_size messages, whichever happens first.  Identical messages in a batch share one prediction.
+    """
+
+    def __init__(
+        self,
+        window_ms=INTENT_BATCH_WINDOW_MS,
+        max_batch_size=INTENT_BATCH_MAX_SIZE,
+        predict_batch=predict_message_intents_batch,
+    ):
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.predict_batch = predict_batch
+        self.loop = None
+        self.pending = []
+        self.flush_handle = None
+        self.batch_tasks = set()
+        self.stats = {
+            "batches": 0,
+            "messages": 0,
+            "largest_batch": 0,
+        }
+
+    async def predict(self, message):
+        """Queues a message for the next batch and waits for its prediction"""
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # Pending work from a previous event loop can never complete
+            self.loop = loop
+            self.pending = []
+            self.flush_handle = None
+
+        future = loop.create_future()
+        self.pending.append((message, future))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window_ms / 1000, self.flush)
+        return await future
+
+    def flush(self):
+        """Sends every pending message to the inference executor as one batch"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        # Skip requests that were cancelled (ie, timed out) while waiting
+        batch = [
+            (message, future) for message, future in self.pending if not future.done()
+        ]
+        self.pending = []
+        if not batch:
+            return
+
+        task = asyncio.ensure_future(self.run_batch(batch))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+
+    async def run_batch(self, batch):
+        unique_messages = list(dict.fromkeys(message for message, _ in batch))
+        self.stats["batches"] += 1
+        self.stats["messages"] += len(batch)
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+
+        try:
+            results = await run_in_inference_executor(
+                self.predict_batch, unique_messages
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        results_by_message = dict(zip(unique_messages, results))
+        for message, future in batch:
+            if not future.done():
+                future.set_result(results_by_message[message])
+
+
+intent_micro_batcher = IntentMicroBatcher()
+
+
+async def predict_message_intent_in_executor(message):
+    """Runs the intent model for a single message without blocking the event loop
+
+    The message joins the current micro-batch unless batching is turned off with INTENT_BATCH_MAX_SIZE=1
+    """
+    if INTENT_BATCH_MAX_SIZE <= 1:
+        return await run_in_inference_executor(predict_message_intent, message)
+    return await intent_micro_batcher.predict(message)
+
+
+def get_inference_executor_stats():
+    """Reports the executor configuration, load, queue depth, and batching
+
+    >>> sorted(get_inference_executor_stats().keys())
+    ['batching', 'completed', 'executor_type', 'failed', 'in_flight', 'max_workers', 'queue_depth', 'submitted']
+    """
+    return {
+        "executor_type": INFERENCE_EXECUTOR_TYPE,
+        "max_workers": INFERENCE_EXECUTOR_WORKERS,
+        "queue_depth": max(
+            0, inference_stats["in_flight"] - INFERENCE_EXECUTOR_WORKERS
+        ),
+        **inference_stats,
+        "batching": {
+            "window_ms": intent_micro_batcher.window_ms,
+            "max_batch_size": intent_micro_batcher.max_batch_size,
+            **intent_micro_batcher.stats,
+        },
+    }
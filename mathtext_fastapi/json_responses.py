@@ -0,0 +1,96 @@
+""" Fast JSON decoding of NLU requests and encoding of NLU responses, with the constant responses encoded once at startup """
+
+import orjson
+
+from fastapi.responses import Response
+
+from mathtext_fastapi.constants import (
+    APPROVED_KEYWORDS,
+    ERROR_RESPONSE_DICT,
+    TIMEOUT_RESPONSE_DICT,
+)
+from mathtext_fastapi.response_formaters import build_single_event_nlu_response
+
+
+def build_response_key(nlu_response):
+    """A hashable key for a single-event response, or None for any other response
+
+    The types are part of the key so that, for example, a confidence of 1 and of 1.0 are encoded differently
+
+    >>> build_response_key({"type": "keyword", "data": "menu", "confidence": 1.0})
+    ('keyword', 'menu', <class 'str'>, 1.0, <class 'float'>)
+    >>> build_response_key({"type": "keyword", "data": "menu", "confidence": 1.0, "degraded": True}) is None
+    True
+    """
+    if len(nlu_response) != 3:
+        return None
+    try:
+        data = nlu_response["data"]
+        confidence = nlu_response["confidence"]
+        return (nlu_response["type"], data, type(data), confidence, type(confidence))
+    except (KeyError, TypeError):
+        return None
+
+
+def build_pre_encoded_responses():
+    """The error, timeout, and keyword responses, encoded once"""
+    constant_responses = [ERROR_RESPONSE_DICT, TIMEOUT_RESPONSE_DICT] + [
+        build_single_event_nlu_response("keyword", keyword)
+        for keyword in APPROVED_KEYWORDS
+    ]
+    return {
+        build_response_key(nlu_response): orjson.dumps(nlu_response)
+        for nlu_response in constant_responses
+    }
+
+
+PRE_ENCODED_RESPONSES = build_pre_encoded_responses()
+
+
+def encode_nlu_response(nlu_response):
+    """Encodes an NLU response to JSON bytes, reusing the bytes of the constant responses
+
+    >>> encode_nlu_response({"type": "keyword", "data": "menu", "confidence": 1.0})
+    b'{"type":"keyword","data":"menu","confidence":1.0}'
+    >>> encode_nlu_response({"type": "correct_answer", "data": "8", "confidence": 1.0})
+    b'{"type":"correct_answer","data":"8","confidence":1.0}'
+    """
+    try:
+        encoded_response = PRE_ENCODED_RESPONSES.get(build_response_key(nlu_response))
+    except TypeError:
+        # Unhashable data, such as a list
+        encoded_response = None
+    if encoded_response is None:
+        encoded_response = orjson.dumps(nlu_response)
+    return encoded_response
+
+
+def encode_nlu_responses(nlu_responses):
+    """Encodes a list of NLU responses, joining the bytes of each response
+
+    >>> encode_nlu_responses([{"type": "keyword", "data": "stop", "confidence": 1.0}, {"type": "keyword", "data": "help", "confidence": 1.0}])
+    b'[{"type":"keyword","data":"stop","confidence":1.0},{"type":"keyword","data":"help","confidence":1.0}]'
+    """
+    return b"[" + b",".join(map(encode_nlu_response, nlu_responses)) + b"]"
+
+
+def build_nlu_json_response(nlu_response, status_code=200):
+    return Response(
+        content=encode_nlu_response(nlu_response),
+        status_code=status_code,
+        media_type="application/json",
+    )
+
+
+def build_nlu_json_list_response(nlu_responses):
+    return Response(
+        content=encode_nlu_responses(nlu_responses), media_type="application/json"
+    )
+
+
+async def read_json_body(request):
+    """Decodes the request body with orjson
+
+    orjson.JSONDecodeError is a subclass of json.JSONDecodeError, so callers catch the same exception as with request.json()
+    """
+    return orjson.loads(await request.body())
@@ -0,0 +1,173 @@
+""" A local logging sidecar: workers hand request-log rows to one process over a Unix socket, and only that process connects to the database
+
+Run it with `python -m mathtext_fastapi.log_sidecar` (gunicorn_conf.py starts it when LOGGING_MODE=sidecar).  Frames use the spool record format (payload length, CRC-32, JSON list of rows).  The sidecar answers each frame with one byte once the rows are in its queue, and from there its own flusher, writer, and spool take care of them.
+"""
+
+import asyncio
+import os
+import signal
+
+from logging import basicConfig, getLogger
+
+from mathtext_fastapi.constants import LOG_SIDECAR_SOCKET_PATH, LOG_SIDECAR_TIMEOUT_MS
+from mathtext_fastapi.log_spool import RECORD_HEADER, decode_spool_records, encode_spool_record
+
+log = getLogger(__name__)
+
+ACK = b"\x01"
+
+
+class SidecarLogClient:
+    """Sends rows to the logging sidecar, with the same write(rows) -> bool interface as LogWriter
+
+    A failed send returns False right away, so the flusher spools the rows locally instead of waiting on the sidecar
+    """
+
+    def __init__(self, socket_path=LOG_SIDECAR_SOCKET_PATH, timeout_ms=LOG_SIDECAR_TIMEOUT_MS):
+        self.socket_path = socket_path
+        self.timeout_seconds = timeout_ms / 1000
+        # One connection and lock per event loop
+        self.loop = None
+        self.lock = None
+        self.reader = None
+        self.writer = None
+        self.stats = {"sent_rows": 0, "sent_frames": 0, "failed_sends": 0, "connects": 0}
+
+    def use_running_loop(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.lock = asyncio.Lock()
+            self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(self.socket_path), self.timeout_seconds
+        )
+        self.stats["connects"] += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def send(self, frame):
+        if self.writer is None:
+            await self.connect()
+        self.writer.write(frame)
+        await self.writer.drain()
+        await asyncio.wait_for(self.reader.readexactly(1), self.timeout_seconds)
+
+    async def write(self, rows):
+        """Returns False if the sidecar did not confirm that it queued the rows"""
+        self.use_running_loop()
+        frame = encode_spool_record(rows)
+        async with self.lock:
+            # A kept-open connection may have been closed by a sidecar restart, so that failure gets one retry on a new connection
+            is_reused_connection = self.writer is not None
+            try:
+                await self.send(frame)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                self.close()
+                if not is_reused_connection or not await self.resend(frame):
+                    log.error(f"Sending request logs to the logging sidecar failed --- {e}")
+                    self.stats["failed_sends"] += 1
+                    return False
+        self.stats["sent_rows"] += len(rows)
+        self.stats["sent_frames"] += 1
+        return True
+
+    async def resend(self, frame):
+        try:
+            await self.send(frame)
+            return True
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            self.close()
+            return False
+
+    def get_stats(self):
+        return {**self.stats, "socket_path": self.socket_path}
+
+
+class LogSidecarServer:
+    """Accepts rows from the workers and queues them in the sidecar's request batch"""
+
+    def __init__(self, batch, flusher, socket_path=LOG_SIDECAR_SOCKET_PATH):
+        self.batch = batch
+        self.flusher = flusher
+        self.socket_path = socket_path
+        self.server = None
+        self.connections = set()
+        self.stats = {"received_rows": 0, "received_frames": 0, "rejected_frames": 0}
+
+    async def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = await asyncio.start_unix_server(
+            self.handle_connection, path=self.socket_path
+        )
+
+    async def stop(self):
+        self.server.close()
+        # Workers keep their connections open, so they are closed here rather than waited for
+        for writer in list(self.connections):
+            writer.close()
+        await self.server.wait_closed()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    async def handle_connection(self, reader, writer):
+        # Imported here because supabase_logging_async imports this module for the client
+        from mathtext_fastapi.supabase_logging_async import RequestLogRecord
+
+        self.connections.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(RECORD_HEADER.size)
+                length, _ = RECORD_HEADER.unpack(header)
+                frame = header + await reader.readexactly(length)
+                rows, valid_bytes = decode_spool_records(frame)
+                if valid_bytes != len(frame):
+                    self.stats["rejected_frames"] += 1
+                    log.error("Closing a worker connection that sent a damaged frame")
+                    break
+                self.batch.add_requests([RequestLogRecord(*row) for row in rows])
+                self.flusher.notify(new_requests=len(rows))
+                self.stats["received_rows"] += len(rows)
+                self.stats["received_frames"] += 1
+                writer.write(ACK)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+
+async def run_sidecar():
+    """Serves the socket until SIGTERM or SIGINT, then writes or spools what is left"""
+    # Imported here because supabase_logging_async imports this module for the client
+    from mathtext_fastapi import supabase_logging_async
+
+    supabase_logging_async.configure_sidecar_process()
+    server = LogSidecarServer(
+        supabase_logging_async.request_batch, supabase_logging_async.request_log_flusher
+    )
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(signal_number, stopping.set)
+
+    supabase_logging_async.start_request_logging()
+    await server.start()
+    log.info(f"Logging sidecar listening on {server.socket_path}")
+    await stopping.wait()
+    await server.stop()
+    await supabase_logging_async.drain_request_logging()
+    await supabase_logging_async.dispose_async_engine()
+    log.info(f"Logging sidecar stopped after receiving {server.stats['received_rows']} rows")
+
+
+if __name__ == "__main__":
+    basicConfig(level="INFO")
+    asyncio.run(run_sidecar())
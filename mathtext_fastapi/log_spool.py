@@ -0,0 +1,281 @@
+""" Spools request-log rows to local disk while the database is unreachable and replays them once it is back
+
+Segment layout: a sequence of records, each a header (payload length uint32, CRC-32 of the payload uint32, little-endian) followed by the payload, a JSON list of encoded (nlu_response, request_object) rows.  A record cut off by a crash fails its length or CRC check, so reading stops there and the records before it are kept.
+
+Several workers can share one spool directory.  Each worker appends to its own segment and holds an exclusive flock on it.  The replayer only takes segments it can lock, so it never reads a segment that is still being written.  The lock of a crashed worker is released with the process, so its segments are replayed too.
+"""
+
+import asyncio
+import fcntl
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from logging import getLogger
+from pathlib import Path
+
+from mathtext_fastapi.constants import (
+    LOG_SPOOL_DIR,
+    LOG_SPOOL_MAX_BYTES,
+    LOG_SPOOL_REPLAY_BATCH_ROWS,
+    LOG_SPOOL_REPLAY_INTERVAL_SECONDS,
+    LOG_SPOOL_SEGMENT_BYTES,
+)
+
+log = getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".seg"
+
+
+def encode_spool_record(rows):
+    """Frames rows as one length-prefixed, CRC-checked record
+
+    >>> record = encode_spool_record([("{}", "{}")])
+    >>> len(record), record[RECORD_HEADER.size :]
+    (22, b'[["{}", "{}"]]')
+    """
+    payload = json.dumps(rows).encode("utf-8")
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_spool_records(data):
+    """Reads the rows of each complete record, stopping at the first damaged or cut-off record
+
+    Returns the rows and the number of bytes that were read as valid records
+
+    >>> data = encode_spool_record([("{}", "{}")]) + encode_spool_record([("[]", "[]")])
+    >>> decode_spool_records(data)
+    ([('{}', '{}'), ('[]', '[]')], 44)
+    >>> decode_spool_records(data[:-1])
+    ([('{}', '{}')], 22)
+    """
+    rows = []
+    position = 0
+    while position + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, position)
+        start = position + RECORD_HEADER.size
+        payload = data[start : start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        rows.extend(tuple(row) for row in json.loads(payload))
+        position = start + length
+    return rows, position
+
+
+class LogSpool:
+    """An append-only, segment-rotated spool of request-log rows in a local directory
+
+    Appending stops once the directory holds max_bytes, so an outage cannot fill the disk
+
+    >>> import tempfile
+    >>> spool = LogSpool(tempfile.mkdtemp(), segment_bytes=20)
+    >>> spool.append([("{}", "{}")]), spool.append([("[]", "[]")])
+    (True, True)
+    >>> len(spool.list_segments())
+    2
+    >>> spool.rotate()
+    >>> [spool.read_segment(path)[0] for path in spool.list_segments()]
+    [[('{}', '{}')], [('[]', '[]')]]
+    """
+
+    def __init__(
+        self,
+        directory=LOG_SPOOL_DIR,
+        segment_bytes=LOG_SPOOL_SEGMENT_BYTES,
+        max_bytes=LOG_SPOOL_MAX_BYTES,
+    ):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.segment_file = None
+        self.segment_path = None
+        self.segment_numbers = itertools.count()
+        self.lock = threading.Lock()
+        self.stats = {
+            "spooled_rows": 0,
+            "rejected_rows": 0,
+            "segments_written": 0,
+            "damaged_bytes": 0,
+        }
+
+    def list_segments(self):
+        """Segment paths in the order they were started"""
+        if not self.directory.is_dir():
+            return []
+        return sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def get_spooled_bytes(self):
+        total = 0
+        for path in self.list_segments():
+            try:
+                total += path.stat().st_size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def open_segment(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Millisecond start time first, so names sort in the order the segments were started
+        name = f"{time.time_ns() // 1_000_000:013d}-{os.getpid()}-{next(self.segment_numbers)}"
+        self.segment_path = self.directory / f"{name}{SEGMENT_SUFFIX}"
+        self.segment_file = open(self.segment_path, "ab")
+        fcntl.flock(self.segment_file, fcntl.LOCK_EX)
+        self.stats["segments_written"] += 1
+
+    def close_segment(self):
+        if self.segment_file is None:
+            return
+        self.segment_file.flush()
+        os.fsync(self.segment_file.fileno())
+        # Closing the file releases the lock, which lets the replayer take the segment
+        self.segment_file.close()
+        self.segment_file = None
+        self.segment_path = None
+
+    def append(self, rows):
+        """Appends rows as one record, or returns False if the spool is full or cannot be written"""
+        record = encode_spool_record(rows)
+        with self.lock:
+            try:
+                if self.get_spooled_bytes() + len(record) > self.max_bytes:
+                    self.stats["rejected_rows"] += len(rows)
+                    return False
+                if self.segment_file is None:
+                    self.open_segment()
+                self.segment_file.write(record)
+                self.segment_file.flush()
+                if self.segment_file.tell() >= self.segment_bytes:
+                    self.close_segment()
+            except OSError as e:
+                log.error(f"Writing to the request log spool failed --- {e}")
+                self.stats["rejected_rows"] += len(rows)
+                self.close_segment()
+                return False
+        self.stats["spooled_rows"] += len(rows)
+        return True
+
+    def rotate(self):
+        """Closes the segment being written, so it can be replayed"""
+        with self.lock:
+            self.close_segment()
+
+    def read_segment(self, path):
+        """Returns the rows in a segment and whether its end was damaged"""
+        data = Path(path).read_bytes()
+        rows, valid_bytes = decode_spool_records(data)
+        damaged_bytes = len(data) - valid_bytes
+        if damaged_bytes:
+            self.stats["damaged_bytes"] += damaged_bytes
+            log.warning(
+                f"Discarding {damaged_bytes} damaged bytes at the end of {path}"
+            )
+        return rows, damaged_bytes > 0
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "segments": len(self.list_segments()),
+            "spooled_bytes": self.get_spooled_bytes(),
+            "max_bytes": self.max_bytes,
+        }
+
+
+class LogSpoolReplayer:
+    """Streams spooled segments back to the database from a background task
+
+    Each segment is written in batches of batch_rows rows with write_rows, an async function that returns False if the rows could not be written, and deleted once all its rows are written.  A failed write ends the replay until the next interval.  Rows are delivered at least once: a segment that fails partway is retried from its first unwritten batch, but a crash in between replays the whole segment.
+    """
+
+    def __init__(
+        self,
+        spool,
+        write_rows,
+        interval_seconds=LOG_SPOOL_REPLAY_INTERVAL_SECONDS,
+        batch_rows=LOG_SPOOL_REPLAY_BATCH_ROWS,
+    ):
+        self.spool = spool
+        self.write_rows = write_rows
+        self.interval_seconds = interval_seconds
+        self.batch_rows = batch_rows
+        self.task = None
+        # Rows of each segment already written, for retrying a segment that failed partway
+        self.written_rows = {}
+        self.stats = {
+            "replayed_rows": 0,
+            "replayed_segments": 0,
+            "failed_replays": 0,
+        }
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.replay()
+            except Exception as e:
+                self.stats["failed_replays"] += 1
+                log.error(f"Replaying the request log spool failed --- {e}")
+
+    async def replay(self):
+        """Writes every segment that no worker is appending to, oldest first"""
+        if not self.spool.list_segments():
+            return
+        await asyncio.to_thread(self.spool.rotate)
+        for path in self.spool.list_segments():
+            if not await self.replay_segment(path):
+                self.stats["failed_replays"] += 1
+                return
+
+    async def replay_segment(self, path):
+        """Returns False if a write failed, and True if the segment was replayed or skipped"""
+        try:
+            segment_file = open(path, "rb")
+        except FileNotFoundError:
+            return True
+        with segment_file:
+            try:
+                fcntl.flock(segment_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # A worker is still appending to it, or another replayer has it
+                return True
+            if os.fstat(segment_file.fileno()).st_nlink == 0:
+                # Another replayer finished it between listing and locking
+                return True
+            rows, _ = await asyncio.to_thread(self.spool.read_segment, path)
+            written_rows = self.written_rows.get(path.name, 0)
+            while written_rows < len(rows):
+                batch = rows[written_rows : written_rows + self.batch_rows]
+                if not await self.write_rows(batch):
+                    return False
+                written_rows += len(batch)
+                self.written_rows[path.name] = written_rows
+                self.stats["replayed_rows"] += len(batch)
+            path.unlink()
+            self.written_rows.pop(path.name, None)
+            self.stats["replayed_segments"] += 1
+            log.info(f"Replayed {len(rows)} spooled request logs from {path.name}")
+            return True
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            **self.spool.get_stats(),
+            "replayer_running": self.task is not None and not self.task.done(),
+        }
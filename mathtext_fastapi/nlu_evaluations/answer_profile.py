@@ -0,0 +1,87 @@
+""" Precomputes the facts about an expected answer once, so each request only has to process the student message """
+
+import functools
+
+from mathtext.text_processing import normalize_message_and_answer
+
+from mathtext_fastapi.constants import ANSWER_PROFILE_CACHE_SIZE
+from mathtext_fastapi.nlu_evaluations.planner import classify_expected_answer
+
+
+class AnswerProfile:
+    """The normalized forms, numeric value, and type of an expected answer
+
+    The numeric value is parsed from the raw expected answer, as are_equivalent_numerical_answers does
+
+    >>> profile = AnswerProfile("5,000")
+    >>> profile.normalized_expected_answer, profile.float_value, profile.answer_class
+    ('5000', None, 'integer')
+    >>> AnswerProfile("2.5").float_value
+    2.5
+    >>> profile = AnswerProfile("Yes")
+    >>> profile.normalized_expected_answer, profile.float_value, profile.is_yes_no
+    ('yes', None, True)
+    """
+
+    def __init__(self, expected_answer):
+        self.expected_answer = expected_answer
+        _, self.normalized_expected_answer = normalize_message_and_answer(
+            "", expected_answer
+        )
+        self.compact_expected_answer = self.normalized_expected_answer.replace(" ", "")
+        try:
+            self.float_value = float(expected_answer)
+        except ValueError:
+            self.float_value = None
+        self.answer_class = classify_expected_answer(self.normalized_expected_answer)
+        self.is_yes_no = self.normalized_expected_answer in ["yes", "no"]
+
+    def is_equivalent_number(self, text):
+        """Checks whether a number in text has the same value as the expected answer
+
+        Matches are_equivalent_numerical_answers(text, expected_answer) without parsing the expected answer again
+
+        >>> AnswerProfile("15").is_equivalent_number("15.0")
+        True
+        >>> AnswerProfile("15").is_equivalent_number("I don't know")
+        False
+        """
+        if self.float_value is None:
+            return False
+        try:
+            return float(text) == self.float_value
+        except ValueError:
+            return False
+
+    def __repr__(self):
+        return f"AnswerProfile({self.expected_answer!r})"
+
+
+@functools.lru_cache(maxsize=ANSWER_PROFILE_CACHE_SIZE)
+def get_answer_profile(expected_answer):
+    """Returns the AnswerProfile for an expected answer from a bounded LRU
+
+    >>> get_answer_profile("1/2") is get_answer_profile("1/2")
+    True
+    """
+    return AnswerProfile(expected_answer)
+
+
+def normalize_student_message(student_message):
+    """Normalizes only the student message, the same way normalize_message_and_answer does
+
+    >>> normalize_student_message(" Maybe 5,000 ")
+    'maybe 5000'
+    """
+    normalized_student_message, _ = normalize_message_and_answer(student_message, "")
+    return normalized_student_message
+
+
+def get_answer_profile_stats():
+    cache_info = get_answer_profile.cache_info()
+    return {
+        "hits": cache_info.hits,
+        "misses": cache_info.misses,
+        "size": cache_info.currsize,
+        "max_size": cache_info.maxsize,
+    }
@@ -1,6 +1,7 @@
 """ These functions evaluate a student message for specific types of responses and build a response object to send back to the chatbot """
+import asyncio  # Needed to run async doctests
+
 from mathtext.constants import TOKENS2INT_ERROR_INT
-from mathtext.predict_intent import predict_message_intent
 from mathtext.utils.converters import text2num, text2int, text2float
 from mathtext.utils.checkers import (
     has_profanity,
@@ -14,13 +15,14 @@ from mathtext_fastapi.constants import (
     APPROVED_INTENT_CONFIDENCE_THRESHOLD,
     APPROVED_KEYWORDS,
 )
+from mathtext_fastapi.deadline import has_budget_for_model_stage, record_stage_result
+from mathtext_fastapi.inference import predict_message_intent_in_executor
+from mathtext_fastapi.nlu_evaluations.answer_profile import get_answer_profile
 from mathtext_fastapi.nlu_evaluations.evaluation_utils import (
-    are_equivalent_numerical_answers,
     check_answer_intent_confidence,
     check_if_intent_scored_over_approved_confidence_threshold,
     evaluate_for_exact_answer_match_in_phrase,
     evaluate_for_exact_keyword_match_in_phrase,
-    evaluate_for_exact_match_with_expected_answer,
 )
 from mathtext_fastapi.response_formaters import build_single_event_nlu_response
 
@@ -43,79 +45,80 @@ def check_for_invalid_input(student_message):
     return {}
 
 
-def extract_exact_answer_match(
-    normalized_student_message, normalized_expected_answer, expected_answer
-):
+def extract_exact_answer_match(normalized_student_message, answer_profile):
     """Runs direct comparison of normalized student message and expected answer
 
-    >>> extract_exact_answer_match("true", "true", "True")
+    >>> extract_exact_answer_match("true", get_answer_profile("True"))
     {'type': 'correct_answer', 'data': 'True', 'confidence': 1.0}
-    >>> extract_exact_answer_match("it's 5", "5", "5")
+    >>> extract_exact_answer_match("it's 5", get_answer_profile("5"))
     {}
-    >>> extract_exact_answer_match("false", "true", "True")
+    >>> extract_exact_answer_match("false", get_answer_profile("True"))
     {}
     """
-    result = evaluate_for_exact_match_with_expected_answer(
-        normalized_student_message, normalized_expected_answer
-    )
-    if result:
-        return build_single_event_nlu_response("correct_answer", expected_answer)
+    compact_student_message = normalized_student_message.replace(" ", "")
+    if compact_student_message == answer_profile.compact_expected_answer:
+        return build_single_event_nlu_response(
+            "correct_answer", answer_profile.expected_answer
+        )
     return {}
 
 
-def extract_approved_answer(
+async def extract_approved_answer(
     normalized_student_message,
-    normalized_expected_answer,
-    expected_answer,
+    answer_profile,
     student_message,
+    deadline=None,
 ):
     """Runs evaluation of student message for approved text and numerical expect answers
 
-    >>> extract_approved_answer("yes", "yes", "Yes", "Yes")
+    A wrong answer is only reported if the intent model agrees the message is an answer.  When the deadline leaves no time for the model, the wrong answer is reported as the best result available.
+
+    >>> asyncio.run(extract_approved_answer("yes", get_answer_profile("Yes"), "Yes"))
     {'type': 'correct_answer', 'data': 'Yes', 'confidence': 1.0}
-    >>> extract_approved_answer("b", "a", "B", "A")
+    >>> asyncio.run(extract_approved_answer("b", get_answer_profile("A"), "B"))
     {'type': 'wrong_answer', 'data': 'B', 'confidence': 1.0}
-    >>> extract_approved_answer("g", ">", ">", "G")
+    >>> asyncio.run(extract_approved_answer("g", get_answer_profile(">"), "G"))
     {'type': 'correct_answer', 'data': '>', 'confidence': 1.0}
-    >>> extract_approved_answer("6", "6", "6", "6")
+    >>> asyncio.run(extract_approved_answer("6", get_answer_profile("6"), "6"))
     {'type': 'correct_answer', 'data': '6', 'confidence': 1.0}
     """
     result, is_result_correct = evaluate_for_exact_answer_match_in_phrase(
         normalized_student_message,
-        normalized_expected_answer,
-        expected_answer,
+        answer_profile.normalized_expected_answer,
+        answer_profile.expected_answer,
     )
     if result and is_result_correct:
         return build_single_event_nlu_response("correct_answer", result)
     if result and result != TOKENS2INT_ERROR_INT and is_result_correct == False:
-        intents_results_dict = predict_message_intent(student_message)
+        wrong_answer_response = build_single_event_nlu_response("wrong_answer", result)
+        record_stage_result(deadline, wrong_answer_response)
+        if not has_budget_for_model_stage(deadline):
+            return wrong_answer_response
+        intents_results_dict = await predict_message_intent_in_executor(
+            student_message
+        )
         intents_results = intents_results_dict.get("intents", [])
         is_answer = check_answer_intent_confidence(intents_results)
         if is_answer:
-            return build_single_event_nlu_response(
-                "wrong_answer",
-                result,
-            )
+            return wrong_answer_response
         return intents_results_dict
     return {}
 
 
-def extract_approved_keyword(
-    normalized_student_message, normalized_expected_answer, expected_answer
-):
+def extract_approved_keyword(normalized_student_message, answer_profile):
     """Runs evaluation to extract an approved keyword from a student message
 
-    >>> extract_approved_keyword('menu', '34', '34')
+    >>> extract_approved_keyword('menu', get_answer_profile('34'))
     {'type': 'keyword', 'data': 'menu', 'confidence': 1.0}
-    >>> extract_approved_keyword('menu please', '34', '34')
+    >>> extract_approved_keyword('menu please', get_answer_profile('34'))
     {'type': 'keyword', 'data': 'menu', 'confidence': 1.0}
-    >>> extract_approved_keyword('34', '34', '34')
+    >>> extract_approved_keyword('34', get_answer_profile('34'))
     {}
     """
     result = evaluate_for_exact_keyword_match_in_phrase(
         normalized_student_message,
-        normalized_expected_answer,
-        expected_answer,
+        answer_profile.normalized_expected_answer,
+        answer_profile.expected_answer,
     )
 
     if result and result != TOKENS2INT_ERROR_INT:
@@ -124,63 +127,65 @@ def extract_approved_keyword(
     return {}
 
 
-def extract_special_numbers_with_regex(student_message, normalized_expected_answer):
+def extract_special_numbers_with_regex(student_message, answer_profile):
     """Runs evaluation of student message for decimal, fraction, time, and exponent answers
 
-    >>> extract_special_numbers_with_regex("that's 2 / 3", "2/3")
+    >>> extract_special_numbers_with_regex("that's 2 / 3", get_answer_profile("2/3"))
     {'type': 'correct_answer', 'data': '2/3', 'confidence': 1.0}
-    >>> extract_special_numbers_with_regex("10: 45 PM", "10:30")
+    >>> extract_special_numbers_with_regex("10: 45 PM", get_answer_profile("10:30"))
     {'type': 'wrong_answer', 'data': '10:45', 'confidence': 1.0}
-    >>> extract_special_numbers_with_regex("idk", "10:30")
+    >>> extract_special_numbers_with_regex("idk", get_answer_profile("10:30"))
     {}
     """
-    result = run_regex_evaluations(student_message, normalized_expected_answer)
+    result = run_regex_evaluations(
+        student_message, answer_profile.normalized_expected_answer
+    )
     if result:
         label = "wrong_answer"
-        if result == normalized_expected_answer:
+        if result == answer_profile.normalized_expected_answer:
             label = "correct_answer"
         return build_single_event_nlu_response(label, result)
     return {}
 
 
-def extract_integers_and_floats_with_regex(student_message, expected_answer):
+def extract_integers_and_floats_with_regex(student_message, answer_profile):
     """Runs evaluations to extract numbers or convert number words to numbers
 
-    >>> extract_integers_and_floats_with_regex("that's twenty", 20)
+    >>> extract_integers_and_floats_with_regex("that's twenty", get_answer_profile("20"))
     {'type': 'correct_answer', 'data': '20', 'confidence': 1.0}
-    >>> extract_integers_and_floats_with_regex("785.12", 20)
+    >>> extract_integers_and_floats_with_regex("785.12", get_answer_profile("20"))
     {'type': 'wrong_answer', 'data': '785.12', 'confidence': 1.0}
-    >>> extract_integers_and_floats_with_regex("idk", 20)
+    >>> extract_integers_and_floats_with_regex("idk", get_answer_profile("20"))
     {}
     """
     result = text2float(student_message)
-    answer = check_nlu_number_result_for_correctness(result, expected_answer)
+    answer = check_nlu_number_result_for_correctness(result, answer_profile)
     if answer and result != TOKENS2INT_ERROR_INT:
         return answer
 
     result = text2int(student_message)
-    answer = check_nlu_number_result_for_correctness(result, expected_answer)
+    answer = check_nlu_number_result_for_correctness(result, answer_profile)
     if answer and result != TOKENS2INT_ERROR_INT:
         return answer
     return {}
 
 
-def check_for_yes_answer_in_intents(intents_results, normalized_expected_answer):
+def check_for_yes_answer_in_intents(intents_results, answer_profile):
     """Check if a yes intent in the expected answer is a correct answer
 
-    >>> check_for_yes_answer_in_intents([{'type': 'intent', 'data': 'yes', 'confidence': 0.89}], 'yes')
+    >>> check_for_yes_answer_in_intents([{'type': 'intent', 'data': 'yes', 'confidence': 0.89}], get_answer_profile('yes'))
     {'type': 'correct_answer', 'data': 'yes', 'confidence': 0.89}
-    >>> check_for_yes_answer_in_intents([{'type': 'intent', 'data': 'yes', 'confidence': 0.67}], 'no')
+    >>> check_for_yes_answer_in_intents([{'type': 'intent', 'data': 'yes', 'confidence': 0.67}], get_answer_profile('no'))
     {'type': 'wrong_answer', 'data': 'yes', 'confidence': 0.67}
-    >>> check_for_yes_answer_in_intents([{'type': 'intent', 'data': 'yes', 'confidence': 0.22}], 'yes')
+    >>> check_for_yes_answer_in_intents([{'type': 'intent', 'data': 'yes', 'confidence': 0.22}], get_answer_profile('yes'))
     """
-    if normalized_expected_answer in ["yes", "no"]:
+    if answer_profile.is_yes_no:
         result = check_if_intent_scored_over_approved_confidence_threshold(
             intents_results, "yes"
         )
 
         label = "correct_answer"
-        if normalized_expected_answer == "no" and result:
+        if answer_profile.normalized_expected_answer == "no" and result:
             label = "wrong_answer"
 
         if result:
@@ -218,46 +223,46 @@ def find_highest_confidence_intent_over_threshold(intents_results):
     return {}
 
 
-def extract_number_match_to_expected_answer(
-    normalized_student_message, expected_answer
-):
+def extract_number_match_to_expected_answer(normalized_student_message, answer_profile):
     """Runs evaluation to check for decimals or integers in a student message
 
-    >>> extract_number_match_to_expected_answer("6.5", "55.5")
+    >>> extract_number_match_to_expected_answer("6.5", get_answer_profile("55.5"))
     {'type': 'wrong_answer', 'data': '6.5', 'confidence': 1.0}
-    >>> extract_number_match_to_expected_answer("20", "20")
+    >>> extract_number_match_to_expected_answer("20", get_answer_profile("20"))
     {'type': 'correct_answer', 'data': '20', 'confidence': 1.0}
-    >>> extract_number_match_to_expected_answer("I love math", "100")
+    >>> extract_number_match_to_expected_answer("I love math", get_answer_profile("100"))
     {}
-    >>> extract_number_match_to_expected_answer("that's 6", "6")
+    >>> extract_number_match_to_expected_answer("that's 6", get_answer_profile("6"))
     {}
     """
     result = text2num(normalized_student_message)
 
     if result != TOKENS2INT_ERROR_INT:
-        if expected_answer == str(result) or are_equivalent_numerical_answers(
-            str(result), expected_answer
+        expected_answer = answer_profile.expected_answer
+        if expected_answer == str(result) or answer_profile.is_equivalent_number(
+            str(result)
         ):
             return build_single_event_nlu_response("correct_answer", expected_answer)
         return build_single_event_nlu_response("wrong_answer", str(result))
     return {}
 
 
-def check_nlu_number_result_for_correctness(nlu_eval_result, expected_answer):
+def check_nlu_number_result_for_correctness(nlu_eval_result, answer_profile):
     """Check whether an integer or float result is a correct answer or not
 
-    >>> check_nlu_number_result_for_correctness(100, "100")
+    >>> check_nlu_number_result_for_correctness(100, get_answer_profile("100"))
     {'type': 'correct_answer', 'data': '100', 'confidence': 1.0}
-    >>> check_nlu_number_result_for_correctness(10, "100")
+    >>> check_nlu_number_result_for_correctness(10, get_answer_profile("100"))
     {'type': 'wrong_answer', 'data': '10', 'confidence': 1.0}
-    >>> check_nlu_number_result_for_correctness(None, "20")
+    >>> check_nlu_number_result_for_correctness(None, get_answer_profile("20"))
     {}
     """
     label = "wrong_answer"
     if nlu_eval_result and nlu_eval_result not in [None, 0]:
-        if expected_answer == str(nlu_eval_result) or are_equivalent_numerical_answers(
-            str(nlu_eval_result), expected_answer
-        ):
+        expected_answer = answer_profile.expected_answer
+        if expected_answer == str(
+            nlu_eval_result
+        ) or answer_profile.is_equivalent_number(str(nlu_eval_result)):
             label = "correct_answer"
             nlu_eval_result = expected_answer
         return build_single_event_nlu_response(label, str(nlu_eval_result))
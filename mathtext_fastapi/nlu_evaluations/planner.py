@@ -0,0 +1,127 @@
+""" Plans which rule-based evaluations can produce a result for a student message so the others can be skipped """
+
+import re
+
+from collections import defaultdict
+
+from mathtext.utils.default_values import APPROVED_RESPONSES_BY_TYPE
+
+# Tokens that extract_approved_answer and extract_approved_keyword look up
+ANSWER_TOKENS = frozenset(
+    token
+    for token, response_type in APPROVED_RESPONSES_BY_TYPE.items()
+    if response_type == "answer"
+)
+KEYWORD_TOKENS = frozenset(
+    token
+    for token, response_type in APPROVED_RESPONSES_BY_TYPE.items()
+    if response_type == "keyword"
+)
+
+# \d matches the same Unicode decimal digits that the regex evaluations look for
+DIGIT_PATTERN = re.compile(r"\d")
+
+EXPECTED_ANSWER_PATTERNS = [
+    ("integer", re.compile(r"-?\d+")),
+    ("decimal", re.compile(r"-?\d*\.\d+")),
+    ("fraction", re.compile(r"(\d+ )?\d+/\d+")),
+    ("time", re.compile(r"\d{1,2}:\d{2}")),
+    ("exponent", re.compile(r"-?\d+(\.\d+)?\^-?\d+(\.\d+)?")),
+    ("letter_choice", re.compile(r"[a-d]")),
+    ("yes_no", re.compile(r"yes|no")),
+    ("true_false", re.compile(r"t|f|true|false")),
+    ("comparison_symbol", re.compile(r"[<>=]|<=|>=|g|l|e|gt|lt|gte|lte")),
+]
+
+planner_stats = defaultdict(
+    lambda: {"plans": 0, "approved_answer": 0, "approved_keyword": 0, "special_numbers": 0}
+)
+
+
+def classify_expected_answer(normalized_expected_answer):
+    """Names the type of answer a question expects
+
+    >>> classify_expected_answer("12")
+    'integer'
+    >>> classify_expected_answer("2 1/2")
+    'fraction'
+    >>> classify_expected_answer("10:30")
+    'time'
+    >>> classify_expected_answer("b")
+    'letter_choice'
+    >>> classify_expected_answer(">=")
+    'comparison_symbol'
+    >>> classify_expected_answer("monday")
+    'other'
+    """
+    for answer_class, pattern in EXPECTED_ANSWER_PATTERNS:
+        if pattern.fullmatch(normalized_expected_answer):
+            return answer_class
+    return "other"
+
+
+def classify_message_shape(normalized_student_message, has_digit):
+    """Names the shape of a student message
+
+    >>> classify_message_shape("12", True)
+    'all_digits'
+    >>> classify_message_shape("1/2", True)
+    'single_token_with_digit'
+    >>> classify_message_shape("maybe 12", True)
+    'phrase_with_digit'
+    >>> classify_message_shape("menu", False)
+    'single_token'
+    >>> classify_message_shape("i don't know", False)
+    'phrase'
+    """
+    if normalized_student_message.isdecimal():
+        return "all_digits"
+    is_single_token = len(normalized_student_message.split()) == 1
+    if has_digit:
+        return "single_token_with_digit" if is_single_token else "phrase_with_digit"
+    return "single_token" if is_single_token else "phrase"
+
+
+def plan_text_processing_evaluations(
+    normalized_student_message, answer_profile, student_message
+):
+    """Decides which of the optional rule-based evaluations can return a result
+
+    A stage is only skipped when it provably returns nothing for the message, so the first result, and therefore the response, is the same as running every stage.  The approved answer stage only matches approved answer tokens or the expected answer itself, and the keyword stage only matches keyword tokens.  The regex stage only matches text with a digit in it.  The other stages are cheap and always run.
+
+    The outputs of the stages do not depend on the type of the expected answer (a "B" question still reports "1/2" as a wrong answer, and a numeric question still answers "menu" with the keyword), so the expected answer's class (from its AnswerProfile) is only recorded in the plan and the statistics.
+
+    >>> from mathtext_fastapi.nlu_evaluations.answer_profile import get_answer_profile
+    >>> plan = plan_text_processing_evaluations("12", get_answer_profile("12"), "12")
+    >>> plan["approved_answer"], plan["approved_keyword"], plan["special_numbers"]
+    (True, False, True)
+    >>> plan = plan_text_processing_evaluations("i don't know", get_answer_profile("B"), "I don't know")
+    >>> plan["approved_answer"], plan["approved_keyword"], plan["special_numbers"]
+    (False, False, False)
+    >>> plan_text_processing_evaluations("menu please", get_answer_profile("1/2"), "menu please")
+    {'expected_answer_class': 'fraction', 'message_shape': 'phrase', 'approved_answer': False, 'approved_keyword': True, 'special_numbers': False}
+    """
+    tokens = {
+        token.replace(".", "").replace("*", "")
+        for token in normalized_student_message.split()
+    }
+    has_digit = DIGIT_PATTERN.search(student_message) is not None
+    plan = {
+        "expected_answer_class": answer_profile.answer_class,
+        "message_shape": classify_message_shape(normalized_student_message, has_digit),
+        "approved_answer": answer_profile.normalized_expected_answer in tokens
+        or not tokens.isdisjoint(ANSWER_TOKENS),
+        "approved_keyword": not tokens.isdisjoint(KEYWORD_TOKENS),
+        "special_numbers": has_digit,
+    }
+
+    stats = planner_stats[plan["expected_answer_class"]]
+    stats["plans"] += 1
+    for stage in ["approved_answer", "approved_keyword", "special_numbers"]:
+        stats[stage] += plan[stage]
+    return plan
+
+
+def get_planner_stats():
+    """Counts the plans made and how often each optional stage ran, by expected answer class"""
+    return {answer_class: dict(stats) for answer_class, stats in planner_stats.items()}
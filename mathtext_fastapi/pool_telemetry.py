@@ -0,0 +1,133 @@
+""" Tracks how the request-log database pool is used and recommends a pool size from the observed checkout concurrency """
+
+from sqlalchemy import event
+
+from mathtext_fastapi.constants import (
+    LOG_DB_POOL_HEADROOM,
+    LOG_DB_POOL_MIN_SIZE,
+    LOG_DB_POOL_SHRINK_AFTER_WINDOWS,
+    LOG_DB_POOL_SIZE,
+)
+
+
+class PoolTelemetry:
+    """Counts checkouts, connects, and invalidations of an engine's pool, and times checkout waits and liveness checks
+
+    The recommended pool size is the window's peak concurrency plus headroom.  It grows right away, and shrinks only after shrink_after_windows windows in a row needed fewer connections
+
+    >>> telemetry = PoolTelemetry(min_size=1, max_size=8, headroom=1, shrink_after_windows=2)
+    >>> telemetry.checked_out = 3; telemetry.peak_checked_out = 3
+    >>> telemetry.recommend_pool_size(current_size=2)
+    4
+    >>> telemetry.checked_out = 0; telemetry.end_window()
+    >>> telemetry.recommend_pool_size(current_size=4), telemetry.recommend_pool_size(current_size=4)
+    (4, 1)
+    """
+
+    def __init__(
+        self,
+        min_size=LOG_DB_POOL_MIN_SIZE,
+        max_size=LOG_DB_POOL_SIZE,
+        headroom=LOG_DB_POOL_HEADROOM,
+        shrink_after_windows=LOG_DB_POOL_SHRINK_AFTER_WINDOWS,
+    ):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.headroom = headroom
+        self.shrink_after_windows = shrink_after_windows
+        self.checked_out = 0
+        # Most connections checked out at once since the window started
+        self.peak_checked_out = 0
+        self.windows_below_size = 0
+        self.total_checkout_wait_seconds = 0
+        self.checkout_waits = 0
+        self.stats = {
+            "checkouts": 0,
+            "connects": 0,
+            "invalidations": 0,
+            "last_checkout_wait_ms": None,
+            "max_checkout_wait_ms": 0,
+            "liveness_checks": 0,
+            "failed_liveness_checks": 0,
+            "last_liveness_check_ms": None,
+            "resizes": 0,
+        }
+
+    def attach(self, engine):
+        """Listens to the pool events of an AsyncEngine"""
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, "connect", self.on_connect)
+        event.listen(sync_engine, "checkout", self.on_checkout)
+        event.listen(sync_engine, "checkin", self.on_checkin)
+        event.listen(sync_engine, "invalidate", self.on_invalidate)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        self.stats["connects"] += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.stats["checkouts"] += 1
+        self.checked_out += 1
+        self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        self.checked_out = max(0, self.checked_out - 1)
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        self.stats["invalidations"] += 1
+
+    def record_checkout_wait(self, wait_seconds):
+        wait_ms = round(wait_seconds * 1000, 3)
+        self.total_checkout_wait_seconds += wait_seconds
+        self.checkout_waits += 1
+        self.stats["last_checkout_wait_ms"] = wait_ms
+        self.stats["max_checkout_wait_ms"] = max(
+            self.stats["max_checkout_wait_ms"], wait_ms
+        )
+
+    def record_liveness_check(self, check_seconds, is_alive):
+        self.stats["liveness_checks"] += 1
+        self.stats["last_liveness_check_ms"] = round(check_seconds * 1000, 3)
+        if not is_alive:
+            self.stats["failed_liveness_checks"] += 1
+
+    def end_window(self):
+        self.peak_checked_out = self.checked_out
+
+    def recommend_pool_size(self, current_size):
+        """The pool size for the next window, from this window's peak concurrency"""
+        needed_size = min(
+            self.max_size, max(self.min_size, self.peak_checked_out + self.headroom)
+        )
+        if needed_size > current_size:
+            self.windows_below_size = 0
+            return needed_size
+        if needed_size == current_size:
+            self.windows_below_size = 0
+            return current_size
+        self.windows_below_size += 1
+        if self.windows_below_size < self.shrink_after_windows:
+            return current_size
+        self.windows_below_size = 0
+        return needed_size
+
+    def get_stats(self, pool=None):
+        mean_checkout_wait_ms = None
+        if self.checkout_waits:
+            mean_checkout_wait_ms = round(
+                self.total_checkout_wait_seconds / self.checkout_waits * 1000, 3
+            )
+        pool_stats = {}
+        if pool is not None:
+            pool_stats = {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                # Negative until the pool has opened pool_size connections
+                "overflow": max(0, pool.overflow()),
+            }
+        return {
+            **self.stats,
+            **pool_stats,
+            "peak_checked_out": self.peak_checked_out,
+            "mean_checkout_wait_ms": mean_checkout_wait_ms,
+        }
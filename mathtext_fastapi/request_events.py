@@ -0,0 +1,151 @@
+""" Sampled, fixed-schema log records for the NLU request path, formatted only when a handler emits them
+
+Each request draws one sampling decision from its endpoint's rate when its payload is parsed, and every event of that request (including the evaluation it starts) follows that decision.  A record holds only the fields of its event's schema, so a payload is never stringified, and the message is built from the fields when a handler formats it.
+"""
+
+import random
+import time
+
+from contextvars import ContextVar
+from logging import INFO, getLogger
+
+from mathtext_fastapi.constants import (
+    LOG_EVENT_DEFAULT_SAMPLE_RATE,
+    LOG_EVENT_SAMPLE_RATES,
+)
+
+log = getLogger(__name__)
+
+# The fields of each event, in the order they are formatted
+REQUEST_EVENT_FIELDS = {
+    "request_received": ["message_id", "message_length"],
+    "batch_request_received": ["batch_size"],
+    "message_parsed": ["message_text", "expected_answer"],
+    "batch_planned": ["batch_size", "unique_evaluations"],
+    "evaluation_started": ["message_text", "expected_answer"],
+}
+
+
+def parse_sample_rates(sample_rates):
+    """Reads comma-separated endpoint=rate pairs
+
+    >>> parse_sample_rates("/v2/nlu=0.1, /v2/nlu/batch=1")
+    {'/v2/nlu': 0.1, '/v2/nlu/batch': 1.0}
+    >>> parse_sample_rates("")
+    {}
+    """
+    rates = {}
+    for pair in sample_rates.split(","):
+        if pair.strip():
+            endpoint, rate = pair.split("=")
+            rates[endpoint.strip()] = float(rate)
+    return rates
+
+
+class RequestEvent:
+    """A log message whose text is built from its fields when it is formatted
+
+    >>> str(RequestEvent("message_parsed", "/v2/nlu", {"message_text": "maybe 8", "extra": "ignored"}))
+    "message_parsed endpoint='/v2/nlu' message_text='maybe 8' expected_answer=None"
+    """
+
+    __slots__ = ["event", "endpoint", "fields"]
+
+    def __init__(self, event, endpoint, fields):
+        self.event = event
+        self.endpoint = endpoint
+        self.fields = fields
+
+    def to_dict(self):
+        """The record as a flat dict with the event's fixed schema, for structured handlers"""
+        record = {"event": self.event, "endpoint": self.endpoint}
+        for field in REQUEST_EVENT_FIELDS[self.event]:
+            record[field] = self.fields.get(field)
+        return record
+
+    def __str__(self):
+        record = self.to_dict()
+        event = record.pop("event")
+        return " ".join([event] + [f"{field}={value!r}" for field, value in record.items()])
+
+
+class RequestEventLogger:
+    """Logs request events at INFO for the sampled requests and counts the time spent doing so
+
+    >>> logger = getLogger("request_events_doctest")
+    >>> logger.setLevel(INFO)
+    >>> request_events = RequestEventLogger(logger, sample_rates={"/v2/nlu": 0.0})
+    >>> request_events.start_request("/v2/nlu")
+    >>> request_events.log_event("message_parsed", message_text="maybe 8", expected_answer="8")
+    >>> logger.setLevel("WARNING")
+    >>> request_events.log_event("message_parsed", message_text="maybe 8", expected_answer="8")
+    >>> stats = request_events.get_stats()
+    >>> stats["requests"], stats["events"], stats["sampled_out"], stats["disabled"]
+    (1, 2, 1, 1)
+    """
+
+    def __init__(
+        self,
+        logger,
+        sample_rates=parse_sample_rates(LOG_EVENT_SAMPLE_RATES),
+        default_sample_rate=LOG_EVENT_DEFAULT_SAMPLE_RATE,
+    ):
+        self.logger = logger
+        self.sample_rates = sample_rates
+        self.default_sample_rate = default_sample_rate
+        # The (endpoint, is_sampled) decision of the request being handled
+        self.request_sampling = ContextVar("request_sampling", default=None)
+        self.logging_seconds = 0
+        self.stats = {
+            "requests": 0,
+            "events": 0,
+            "emitted": 0,
+            "sampled_out": 0,
+            "disabled": 0,
+        }
+
+    def is_sampled(self, endpoint):
+        return random.random() < self.sample_rates.get(endpoint, self.default_sample_rate)
+
+    def start_request(self, endpoint):
+        """Draws the sampling decision for the events of the current request"""
+        start = time.perf_counter()
+        self.request_sampling.set((endpoint, self.is_sampled(endpoint)))
+        self.stats["requests"] += 1
+        self.logging_seconds += time.perf_counter() - start
+
+    def log_event(self, event, **fields):
+        start = time.perf_counter()
+        self.stats["events"] += 1
+        request_sampling = self.request_sampling.get()
+        if not self.logger.isEnabledFor(INFO):
+            self.stats["disabled"] += 1
+        elif request_sampling is None:
+            # Outside a request, such as an evaluation during warmup
+            self.emit(RequestEvent(event, None, fields))
+        elif not request_sampling[1]:
+            self.stats["sampled_out"] += 1
+        else:
+            self.emit(RequestEvent(event, request_sampling[0], fields))
+        self.logging_seconds += time.perf_counter() - start
+
+    def emit(self, request_event):
+        self.stats["emitted"] += 1
+        self.logger.info("%s", request_event, extra={"request_event": request_event})
+
+    def get_stats(self):
+        mean_logging_us_per_request = None
+        if self.stats["requests"]:
+            mean_logging_us_per_request = round(
+                self.logging_seconds / self.stats["requests"] * 1e6, 3
+            )
+        return {
+            **self.stats,
+            "logging_seconds": round(self.logging_seconds, 6),
+            "mean_logging_us_per_request": mean_logging_us_per_request,
+            "sample_rates": self.sample_rates,
+            "default_sample_rate": self.default_sample_rate,
+        }
+
+
+request_events = RequestEventLogger(log)
@@ -1,10 +1,13 @@
 import datetime as dt
+import re
 from collections.abc import Mapping
 from dateutil.parser import isoparse
 from json import JSONDecodeError
 from logging import getLogger
 
 from mathtext_fastapi.constants import ERROR_RESPONSE_DICT
+from mathtext_fastapi.json_responses import read_json_body
+from mathtext_fastapi.request_events import request_events
 
 log = getLogger(__name__)
 
@@ -19,6 +22,68 @@ PAYLOAD_VALUE_TYPES = {
     'message_updated_at': str,
     }
 
+PAYLOAD_DATETIME_FIELDS = ['message_inserted_at', 'message_updated_at']
+
+# The timestamp shape Turn.io sends, such as 2023-04-06T10:08:23.745072Z
+# re.ASCII keeps \d to 0-9, because isoparse rejects other Unicode digits
+ISO_DATETIME_PATTERN = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:[.,]\d+)?(?:Z|[+-](\d{2}):?(\d{2}))?',
+    re.ASCII,
+)
+
+
+def is_iso_datetime(value):
+    """ Checks a timestamp with a precompiled pattern, and with isoparse for the other ISO-8601 forms and edge cases
+
+    >>> is_iso_datetime('2023-04-06T10:08:23.745072Z'), is_iso_datetime('2023-02-30T10:08:23Z')
+    (True, False)
+    >>> is_iso_datetime('20230406'), is_iso_datetime('@event.message._vnd.v1.chat.inserted_at')
+    (True, False)
+    >>> is_iso_datetime('٢٠٢٣-٠٤-٠٦T١٠:٠٨:٢٣Z')
+    False
+    """
+    match = ISO_DATETIME_PATTERN.fullmatch(value)
+    if match:
+        *date_and_time, offset_hours, offset_minutes = match.groups()
+        if int(offset_hours or 0) < 24 and int(offset_minutes or 0) < 60:
+            try:
+                dt.datetime(*map(int, date_and_time))
+                return True
+            except ValueError:
+                pass
+    try:
+        isoparse(value)
+    except (ValueError, OverflowError):
+        return False
+    return True
+
+
+def find_payload_errors(payload_object):
+    """ Validates every field of the message data in one pass and returns a list of structured errors
+
+    Each field is read once, and each timestamp is parsed once
+
+    >>> find_payload_errors({'author_id': '+5555555', 'author_type': 'OWNER', 'contact_uuid': '3246-43ad-faf7qw-zsdhg-dgGdg', 'message_body': 'thirty one', 'message_direction': 'inbound', 'message_id': 'SDFGGwafada-DFASHA4aDGA', 'message_inserted_at': '2022-07-05T04:00:34.03352Z', 'message_updated_at': '2023-04-06T10:08:23.745072Z'})
+    []
+    >>> find_payload_errors({'author_id': 5, 'author_type': 'OWNER', 'contact_uuid': 'x', 'message_body': 'x', 'message_direction': 'inbound', 'message_id': 'x', 'message_inserted_at': 'yesterday'})
+    [{'field': 'author_id', 'error': 'expected str, got int'}, {'field': 'message_inserted_at', 'error': 'not an ISO-8601 datetime'}, {'field': 'message_updated_at', 'error': 'missing'}]
+    """
+    if not isinstance(payload_object, Mapping):
+        return [{'field': None, 'error': f'expected an object, got {type(payload_object).__name__}'}]
+    errors = []
+    for field, value_type in PAYLOAD_VALUE_TYPES.items():
+        value = payload_object.get(field)
+        if value is None:
+            errors.append({'field': field, 'error': 'missing'})
+        elif not isinstance(value, value_type):
+            errors.append({
+                'field': field,
+                'error': f'expected {value_type.__name__}, got {type(value).__name__}',
+            })
+        elif field in PAYLOAD_DATETIME_FIELDS and not is_iso_datetime(value):
+            errors.append({'field': field, 'error': 'not an ISO-8601 datetime'})
+    return errors
+
 
 def payload_is_valid(payload_object):
     """
@@ -28,84 +93,71 @@ def payload_is_valid(payload_object):
     >>> payload_is_valid({"author_id": "@event.message._vnd.v1.chat.owner", "author_type": "@event.message._vnd.v1.author.type", "contact_uuid": "@event.message._vnd.v1.chat.contact_uuid", "message_body": "@event.message.text.body", "message_direction": "@event.message._vnd.v1.direction", "message_id": "@event.message.id", "message_inserted_at": "@event.message._vnd.v1.chat.inserted_at", "message_updated_at": "@event.message._vnd.v1.chat.updated_at"})
     False
     """
-    try:
-        isinstance(
-            isoparse(payload_object.get('message_inserted_at', '')),
-            dt.datetime
-        )
-        isinstance(
-            isoparse(payload_object.get('message_updated_at', '')),
-            dt.datetime
-        )
-    except ValueError:
-        return False
-    return (
-        isinstance(payload_object, Mapping) and
-        isinstance(payload_object.get('author_id'), str) and
-        isinstance(payload_object.get('author_type'), str) and
-        isinstance(payload_object.get('contact_uuid'), str) and
-        isinstance(payload_object.get('message_body'), str) and
-        isinstance(payload_object.get('message_direction'), str) and
-        isinstance(payload_object.get('message_id'), str) and
-        isinstance(payload_object.get('message_inserted_at'), str) and
-        isinstance(payload_object.get('message_updated_at'), str)
-    )
-
-
-def log_payload_errors(payload_object):
-    errors = []
-    try:
-        assert isinstance(payload_object, Mapping)
-    except Exception as e:
-        log.error(f'Invalid HTTP request payload object: {e}')
-        errors.append(e)
-    for k, typ in PAYLOAD_VALUE_TYPES.items():
-        try:
-            assert isinstance(payload_object.get(k), typ)
-        except Exception as e:
-            log.error(f'Invalid HTTP request payload object: {e}')
-            errors.append(e)
-    try:
-        assert isinstance(
-            dt.datetime.fromisoformat(
-                payload_object.get('message_inserted_at')
-            ),
-            dt.datetime
-        )
-    except Exception as e:
-        log.error(f'Invalid HTTP request payload object: {e}')
-        errors.append(e)
-    try:
-        isinstance(
-            dt.datetime.fromisoformat(
-                payload_object.get('message_updated_at')
-            ),
-            dt.datetime
-        )
-    except Exception as e:
-        log.error(f'Invalid HTTP request payload object: {e}')
-        errors.append(e)
-    return errors
+    return not find_payload_errors(payload_object)
+
+
+def validate_message_dict(message_dict):
+    """ Returns the message data if it is valid or the error response if it is not """
+    errors = find_payload_errors(message_dict)
+    if errors:
+        log.error(f'Invalid HTTP request payload object: {errors}')
+        return ERROR_RESPONSE_DICT
+    return message_dict
 
 
 async def parse_nlu_api_request_for_message(request):
     """ Extracts the message data from a request sent to the /nlu endpoint """
     try:
-        payload = await request.json()
+        payload = await read_json_body(request)
     except JSONDecodeError as e:
         log.info(f'JSONDecodeError: {e}')
         return ERROR_RESPONSE_DICT
     
     message_dict = payload.get('message_data')
-    log.info(f'Request json: {payload}')
 
     if not message_dict:
         message_dict = payload.get('message', {})
 
-    if not payload_is_valid(message_dict):
-        log_payload_errors(message_dict)
+    request_events.start_request(request.url.path)
+    if isinstance(message_dict, Mapping):
+        request_events.log_event(
+            'request_received',
+            message_id=message_dict.get('message_id'),
+            message_length=len(str(message_dict.get('message_body', ''))),
+        )
+
+    return validate_message_dict(message_dict)
+
+
+async def parse_nlu_api_batch_request_for_messages(request):
+    """ Extracts the list of message data from a request sent to the /nlu/batch endpoint
+
+    Invalid items are replaced by the error response so that results keep the request order
+    """
+    try:
+        payload = await read_json_body(request)
+    except JSONDecodeError as e:
+        log.info(f'JSONDecodeError: {e}')
         return ERROR_RESPONSE_DICT
-    return message_dict
+
+    message_dicts = payload.get('message_data') if isinstance(payload, Mapping) else None
+
+    if not isinstance(message_dicts, list):
+        log.error('Invalid HTTP batch request payload: message_data must be a list')
+        return ERROR_RESPONSE_DICT
+
+    request_events.start_request(request.url.path)
+    request_events.log_event('batch_request_received', batch_size=len(message_dicts))
+
+    return [validate_message_dict(message_dict) for message_dict in message_dicts]
 
 def truncate_long_message_text(message_text):
-    return message_text[0:100]
\ No newline at end of file
+    return message_text[0:100]
+
+
+def get_message_text_and_expected_answer(message_dict):
+    """Extracts the (truncated) student message and the expected answer from the message data"""
+    message_text = str(message_dict.get("message_body", ""))
+    message_text = truncate_long_message_text(message_text)
+    expected_answer = str(message_dict.get("expected_answer", ""))
+    return message_text, expected_answer
@@ -0,0 +1,182 @@
+""" Serves precomputed v2 NLU responses for the most common (message, expected answer) pairs from a memory-mapped lookup file
+
+File layout (little-endian):
+- header: magic b"MTRT", format version (uint32), metadata length (uint32)
+- metadata: JSON with the fingerprint and description of the pipeline the table was built with
+- index: one (hash uint64, offset uint32, length uint32) record per entry, sorted by hash
+- data: one JSON [message, expected_answer, response] per entry, at the offsets in the index
+"""
+
+import hashlib
+import json
+import mmap
+import struct
+
+from logging import getLogger
+from pathlib import Path
+
+from mathtext_fastapi.constants import RESPONSE_TABLE_PATH
+from mathtext_fastapi.fingerprint import PIPELINE_FINGERPRINT, describe_pipeline
+
+log = getLogger(__name__)
+
+MAGIC = b"MTRT"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sII")
+INDEX_ENTRY = struct.Struct("<QII")
+
+
+def build_response_table_metadata():
+    """Describes the pipeline that the current code would build a table with
+
+    A table with a different fingerprint is stale and is not loaded.  The description is kept for people inspecting the file.
+    """
+    return {"fingerprint": PIPELINE_FINGERPRINT, "pipeline": describe_pipeline()}
+
+
+def hash_message_and_answer(message_text, expected_answer):
+    """A 64-bit hash of the exact message and expected answer
+
+    >>> hash_message_and_answer("maybe 5", "5") == hash_message_and_answer("maybe 5", "5")
+    True
+    >>> hash_message_and_answer("maybe 5", "5") == hash_message_and_answer("Maybe 5", "5")
+    False
+    """
+    key = json.dumps([message_text, expected_answer]).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def write_response_table(path, entries, metadata=None):
+    """Writes (message, expected_answer, response) entries to a table file
+
+    Returns the number of entries written
+    """
+    metadata = {**(metadata or build_response_table_metadata()), "entries": 0}
+    index = []
+    data = bytearray()
+    seen = set()
+    for message_text, expected_answer, response in entries:
+        if (message_text, expected_answer) in seen:
+            continue
+        seen.add((message_text, expected_answer))
+        entry = json.dumps([message_text, expected_answer, response]).encode("utf-8")
+        index.append(
+            (hash_message_and_answer(message_text, expected_answer), len(data), len(entry))
+        )
+        data += entry
+    index.sort()
+    metadata["entries"] = len(index)
+
+    metadata_bytes = json.dumps(metadata, sort_keys=True).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(metadata_bytes)))
+        f.write(metadata_bytes)
+        for entry_hash, offset, length in index:
+            f.write(INDEX_ENTRY.pack(entry_hash, offset, length))
+        f.write(data)
+    return len(index)
+
+
+class ResponseTable:
+    """Looks up precomputed responses in a table file without reading it into memory
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "table.bin")
+    >>> write_response_table(path, [("maybe 5", "5", {"type": "correct_answer", "data": "5", "confidence": 1.0})])
+    1
+    >>> table = ResponseTable(path)
+    >>> table.lookup("maybe 5", "5")
+    {'type': 'correct_answer', 'data': '5', 'confidence': 1.0}
+    >>> table.lookup("maybe 6", "5") is None
+    True
+    >>> write_response_table(path, [], metadata={"fingerprint": "000000000000"})
+    0
+    >>> ResponseTable(path).get_stats()["rejected_reason"]
+    'stale table (built for pipeline 000000000000)'
+    """
+
+    def __init__(self, path=RESPONSE_TABLE_PATH):
+        self.path = Path(path)
+        self.buffer = None
+        self.entries = 0
+        self.index_start = 0
+        self.data_start = 0
+        self.rejected_reason = None
+        self.stats = {"hits": 0, "misses": 0}
+        self.open()
+
+    def open(self):
+        if not self.path.is_file() or self.path.stat().st_size < HEADER.size:
+            self.rejected_reason = "no table file"
+            return
+        with open(self.path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, metadata_length = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            self.rejected_reason = "unknown file format"
+            buffer.close()
+            return
+        metadata = json.loads(buffer[HEADER.size : HEADER.size + metadata_length])
+        entries = metadata["entries"]
+        if metadata.get("fingerprint") != PIPELINE_FINGERPRINT:
+            self.rejected_reason = (
+                f"stale table (built for pipeline {metadata.get('fingerprint')})"
+            )
+            log.warning(f"Ignoring response table {self.path}: {self.rejected_reason}")
+            buffer.close()
+            return
+
+        self.buffer = buffer
+        self.entries = entries
+        self.index_start = HEADER.size + metadata_length
+        self.data_start = self.index_start + entries * INDEX_ENTRY.size
+        log.info(f"Loaded response table {self.path} with {entries} entries")
+
+    def find_first_index_entry(self, entry_hash):
+        """Binary search for the first index entry with entry_hash (or a larger hash)"""
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            middle_hash, _, _ = INDEX_ENTRY.unpack_from(
+                self.buffer, self.index_start + middle * INDEX_ENTRY.size
+            )
+            if middle_hash < entry_hash:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, message_text, expected_answer):
+        """Returns a copy of the precomputed response, or None if the pair is not in the table"""
+        if self.buffer is None:
+            return None
+        entry_hash = hash_message_and_answer(message_text, expected_answer)
+        position = self.find_first_index_entry(entry_hash)
+        while position < self.entries:
+            found_hash, offset, length = INDEX_ENTRY.unpack_from(
+                self.buffer, self.index_start + position * INDEX_ENTRY.size
+            )
+            if found_hash != entry_hash:
+                break
+            start = self.data_start + offset
+            entry_message, entry_answer, response = json.loads(
+                self.buffer[start : start + length]
+            )
+            # Different pairs can share a 64-bit hash, so the stored pair is compared too
+            if entry_message == message_text and entry_answer == expected_answer:
+                self.stats["hits"] += 1
+                return response
+            position += 1
+        self.stats["misses"] += 1
+        return None
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "loaded": self.buffer is not None,
+            "entries": self.entries,
+            "rejected_reason": self.rejected_reason,
+        }
+
+
+response_table = ResponseTable()
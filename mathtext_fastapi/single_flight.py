@@ -0,0 +1,79 @@
+""" Shares one in-flight evaluation between identical requests that arrive while it is running """
+
+import asyncio
+
+from collections import defaultdict
+
+
+def lasts_at_least_as_long(leader_deadline, deadline):
+    """Checks whether an evaluation started under leader_deadline has as much time as a caller with deadline
+
+    A missing deadline has no time limit
+
+    >>> from mathtext_fastapi.deadline import Deadline
+    >>> lasts_at_least_as_long(Deadline(5000), Deadline(100)), lasts_at_least_as_long(Deadline(100), Deadline(5000))
+    (True, False)
+    >>> lasts_at_least_as_long(None, Deadline(100)), lasts_at_least_as_long(Deadline(5000), None)
+    (True, False)
+    """
+    if leader_deadline is None:
+        return True
+    if deadline is None:
+        return False
+    return leader_deadline.expires_at >= deadline.expires_at
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single evaluation
+
+    Keys are the exact (endpoint, message, expected answer) inputs.  The responses echo the raw student message and expected answer, so two messages that only normalize to the same text cannot share a result.
+
+    >>> async def slow_double(x):
+    ...     await asyncio.sleep(0.01)
+    ...     return 2 * x
+    >>> flight = SingleFlight()
+    >>> async def burst():
+    ...     return await asyncio.gather(*[flight.run(("v2", 4), slow_double, 4) for _ in range(3)])
+    >>> asyncio.run(burst())
+    [8, 8, 8]
+    >>> flight.get_stats()
+    {'v2': {'evaluations': 1, 'hits': 2, 'shorter_deadline_misses': 0}}
+    """
+
+    def __init__(self):
+        # key -> (task, deadline of the caller that started it)
+        self.in_flight = {}
+        self.stats = defaultdict(
+            lambda: {"evaluations": 0, "hits": 0, "shorter_deadline_misses": 0}
+        )
+
+    async def run(self, key, coroutine_function, *args, deadline=None):
+        """Awaits the running evaluation for key, or starts one with coroutine_function(*args)
+
+        The first element of the key names the endpoint that the statistics are reported under.  Each caller is shielded from the others, so a caller that times out does not cancel the evaluation for the rest.
+
+        A caller only joins an evaluation whose deadline is at least as late as its own, because an evaluation started with less time may skip stages and return a degraded response.  Otherwise it starts its own evaluation, which later callers join.
+        """
+        endpoint_stats = self.stats[key[0]]
+        task, leader_deadline = self.in_flight.get(key, (None, None))
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            if lasts_at_least_as_long(leader_deadline, deadline):
+                endpoint_stats["hits"] += 1
+                return await asyncio.shield(task)
+            endpoint_stats["shorter_deadline_misses"] += 1
+
+        task = asyncio.ensure_future(coroutine_function(*args))
+        self.in_flight[key] = (task, deadline)
+        task.add_done_callback(lambda done_task: self.forget(key, done_task))
+        endpoint_stats["evaluations"] += 1
+        return await asyncio.shield(task)
+
+    def forget(self, key, task):
+        if self.in_flight.get(key, (None, None))[0] is task:
+            del self.in_flight[key]
+
+    def get_stats(self):
+        return {endpoint: dict(stats) for endpoint, stats in self.stats.items()}
+
+
+evaluation_single_flight = SingleFlight()
@@ -1,53 +1,198 @@
 import asyncio
-from asyncpg.exceptions import ConnectionDoesNotExistError
+import json
+import math
+import random
+import time
+from asyncpg.exceptions import (
+    ConnectionDoesNotExistError,
+    PostgresConnectionError,
+    TooManyConnectionsError,
+)
 from collections import deque
-from datetime import datetime, timezone
 from logging import getLogger
-from typing import Deque
+from typing import Deque, Optional
 
-from mathtext_fastapi.constants import SUPABASE_URL
-from sqlalchemy import Column, Integer
+from mathtext_fastapi.constants import (
+    LOG_DB_LIVENESS_INTERVAL_SECONDS,
+    LOG_DB_POOL_MAX_OVERFLOW_RATIO,
+    LOG_DB_POOL_RESIZE_INTERVAL_SECONDS,
+    LOG_DB_POOL_SIZE,
+    LOG_FLUSH_MAX_AGE_SECONDS,
+    LOG_QUEUE_MAX_ROWS,
+    LOG_QUEUE_OVERFLOW_POLICY,
+    LOG_REQUEST_FIELDS,
+    LOG_SIDECAR_DB_POOL_SIZE,
+    LOG_SPOOL_ENABLED,
+    LOG_WRITE_BACKOFF_BASE_MS,
+    LOG_WRITE_BACKOFF_MAX_MS,
+    LOG_WRITE_RETRY_BUDGET_SECONDS,
+    LOG_WRITE_RETRY_LIMIT,
+    LOGGING_MODE,
+    SUPABASE_URL,
+)
+from mathtext_fastapi.log_sidecar import SidecarLogClient
+from mathtext_fastapi.log_spool import LogSpool, LogSpoolReplayer
+from mathtext_fastapi.pool_telemetry import PoolTelemetry
+from sqlalchemy import Column, Integer, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.future import select
-from sqlalchemy.orm import sessionmaker
 
 
-async def pre_ping_function(conn):
-    await conn.execute("SELECT 1")
+log = getLogger(__name__)
 
+# Created on first use, so workers in sidecar mode never open database connections
+async_engine = None
+db_pool_size = LOG_DB_POOL_SIZE
+pool_telemetry = PoolTelemetry()
+
+
+def compute_max_overflow(pool_size, max_overflow_ratio=LOG_DB_POOL_MAX_OVERFLOW_RATIO):
+    """The connections a pool of pool_size may open beyond its size
+
+    >>> compute_max_overflow(20, 0.5), compute_max_overflow(3, 0.5), compute_max_overflow(4, 0)
+    (10, 2, 0)
+    """
+    return math.ceil(pool_size * max_overflow_ratio)
+
+
+def get_async_engine():
+    """The request-log engine, created with the current db_pool_size and an overflow that scales with it
+
+    Pooled connections are checked by the PoolMaintainer's background liveness check instead of a SELECT 1 on every checkout, unless LOG_DB_LIVENESS_INTERVAL_SECONDS is 0
+    """
+    global async_engine
+    if async_engine is None:
+        async_engine = create_async_engine(
+            SUPABASE_URL,
+            pool_size=db_pool_size,
+            max_overflow=compute_max_overflow(db_pool_size),
+            pool_timeout=30,
+            pool_pre_ping=LOG_DB_LIVENESS_INTERVAL_SECONDS <= 0,
+            pool_recycle=1800,
+        )
+        pool_telemetry.attach(async_engine)
+    return async_engine
+
+
+async def dispose_async_engine():
+    global async_engine
+    if async_engine is not None:
+        await async_engine.dispose()
+        async_engine = None
 
-log = getLogger(__name__)
-async_engine = create_async_engine(
-    SUPABASE_URL, pool_size=20, pool_timeout=30, pool_pre_ping=True, pool_recycle=1800
-)
-async_session = sessionmaker(
-    bind=async_engine, autocommit=False, autoflush=False, class_=AsyncSession
-)
 
-# Just used for seeing how many connections are in the pool
-pool = async_session().get_bind().pool
 Base = declarative_base()
 
 # Database logging will happen when the batch reaches this value
 BATCH_SIZE = 30
 
 
+OVERFLOW_POLICIES = ["drop_oldest", "sample"]
+
+
 class RequestBatch:
-    """Manages a double-ended queue (d e que) that stores request objects and the nlu evaluation results"""
+    """Manages a double-ended queue (d e que) that stores the log records of requests and their nlu evaluation results
+
+    The queue holds at most max_rows rows, so a database outage cannot grow worker memory without limit.  Past that, the overflow policy decides which rows are dropped:
+    - drop_oldest: the oldest rows are dropped, so the newest max_rows are kept
+    - sample: each new row replaces a random row with a probability that keeps a uniform sample of all the rows offered since the queue filled up
+
+    >>> batch = RequestBatch(max_rows=3)
+    >>> batch.add_requests([1, 2, 3, 4, 5])
+    >>> list(batch.requests), batch.dropped_rows
+    ([3, 4, 5], 2)
+    >>> batch.return_requests([0])
+    >>> list(batch.requests), batch.dropped_rows
+    ([3, 4, 5], 3)
+    """
+
+    def __init__(
+        self, max_rows=LOG_QUEUE_MAX_ROWS, overflow_policy=LOG_QUEUE_OVERFLOW_POLICY
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown overflow policy {overflow_policy!r}, expected one of {OVERFLOW_POLICIES}"
+            )
+        self.requests: Deque["RequestLogRecord"] = deque()
+        self.oldest_request_at: Optional[float] = None
+        self.max_rows = max_rows
+        self.overflow_policy = overflow_policy
+        self.dropped_rows = 0
+        # Rows offered since the queue filled up, for sampling
+        self.overflow_rows_seen = 0
+
+    def add_request(self, request: "RequestLogRecord"):
+        self.add_requests([request])
+
+    def add_requests(self, requests: list):
+        if requests and not self.requests:
+            self.oldest_request_at = time.monotonic()
+        for request in requests:
+            if len(self.requests) < self.max_rows:
+                self.overflow_rows_seen = 0
+                self.requests.append(request)
+            elif self.overflow_policy == "drop_oldest":
+                self.requests.popleft()
+                self.requests.append(request)
+                self.dropped_rows += 1
+            else:
+                self.sample_request(request)
 
-    def __init__(self):
-        self.requests: Deque[dict] = deque()
+    def sample_request(self, request: "RequestLogRecord"):
+        """Reservoir sampling: keeps request with probability max_rows / rows seen since the queue filled up"""
+        self.overflow_rows_seen += 1
+        self.dropped_rows += 1
+        position = random.randrange(self.max_rows + self.overflow_rows_seen)
+        if position < self.max_rows:
+            self.requests[position] = request
 
-    def add_request(self, request: dict):
-        self.requests.append(request)
+    def return_requests(self, requests: list):
+        """Puts rows that could not be written back at the front of the queue
+
+        They are older than anything still queued, so they are the first rows the overflow policy drops
+        """
+        free_rows = self.max_rows - len(self.requests)
+        if free_rows <= 0:
+            self.dropped_rows += len(requests)
+            return
+        if len(requests) > free_rows:
+            if self.overflow_policy == "drop_oldest":
+                kept_requests = requests[len(requests) - free_rows :]
+            else:
+                kept_requests = random.sample(requests, free_rows)
+            self.dropped_rows += len(requests) - free_rows
+            requests = kept_requests
+        self.requests.extendleft(reversed(requests))
+        if self.oldest_request_at is None:
+            self.oldest_request_at = time.monotonic()
 
     def is_full(self) -> bool:
         return len(self.requests) >= BATCH_SIZE
 
+    def oldest_request_age(self) -> Optional[float]:
+        """Seconds since the oldest waiting request was added, or None if the batch is empty"""
+        if not self.requests:
+            return None
+        return time.monotonic() - self.oldest_request_at
+
+    def take_requests(self) -> list:
+        requests = list(self.requests)
+        self.empty_requests()
+        return requests
+
     def empty_requests(self):
         self.requests.clear()
+        self.oldest_request_at = None
+
+    def get_stats(self):
+        return {
+            "queued_rows": len(self.requests),
+            "max_rows": self.max_rows,
+            "overflow_policy": self.overflow_policy,
+            "dropped_rows": self.dropped_rows,
+        }
 
 
 request_batch = RequestBatch()
@@ -65,59 +210,526 @@ class Message(Base):
     request_object = Column(JSONB)
 
 
-async def log_batch(batch, retry_attempts=0):
-    """Bulk uploads a set of request/response entries to the database"""
-    async with async_session() as session:
-        for request in batch:
-            # Add the request data to the db session
-            log_entry = Message(
-                nlu_response=request["nlu_response"],
-                request_object=request["request_object"],
+# Column order of the rows that encode_log_rows builds for COPY
+MESSAGE_COPY_COLUMNS = ["nlu_response", "request_object"]
+
+# Fields of the NLU response kept in the request log
+LOGGED_NLU_RESPONSE_FIELDS = ["type", "data", "confidence", "degraded"]
+
+# Request fields that are never logged
+UNLOGGED_REQUEST_FIELDS = ["author_id"]
+
+
+def parse_logged_request_fields(request_fields):
+    """Splits a comma-separated field list, or returns None for "*" (every field)
+
+    >>> parse_logged_request_fields("message_body, expected_answer")
+    ['message_body', 'expected_answer']
+    >>> parse_logged_request_fields("*") is None
+    True
+    """
+    if request_fields.strip() == "*":
+        return None
+    return [field.strip() for field in request_fields.split(",") if field.strip()]
+
+
+LOGGED_REQUEST_FIELDS = parse_logged_request_fields(LOG_REQUEST_FIELDS)
+
+
+def compact_json(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+class RequestLogRecord:
+    """One logged request, kept in the queue as compact JSON text instead of the request and response dicts
+
+    Only the configured request fields and the type, data, and confidence of the NLU response are kept.  They are serialized once, when the record is built, and sent to COPY as they are (asyncpg takes jsonb values as JSON text).
+
+    >>> record = RequestLogRecord.from_request(
+    ...     {"author_id": "+5555555", "message_body": "menu", "expected_answer": "8", "_vnd": {"v1": {}}},
+    ...     {"type": "keyword", "data": "menu", "confidence": 1.0, "matched_by": "keyword"},
+    ... )
+    >>> record.to_row()
+    ('{"type":"keyword","data":"menu","confidence":1.0}', '{"message_body":"menu","expected_answer":"8"}')
+    >>> RequestLogRecord.from_request({"author_id": "+5555555", "message_body": "8"}, {}, request_fields=None).request_object
+    '{"message_body":"8"}'
+    """
+
+    __slots__ = ("nlu_response", "request_object")
+
+    def __init__(self, nlu_response, request_object):
+        self.nlu_response = nlu_response
+        self.request_object = request_object
+
+    @classmethod
+    def from_request(cls, message_data, nlu_response, request_fields=LOGGED_REQUEST_FIELDS):
+        if request_fields is None:
+            request_object = {
+                field: value
+                for field, value in message_data.items()
+                if field not in UNLOGGED_REQUEST_FIELDS
+            }
+        else:
+            request_object = {
+                field: message_data[field]
+                for field in request_fields
+                if field in message_data and field not in UNLOGGED_REQUEST_FIELDS
+            }
+        logged_nlu_response = {
+            field: nlu_response[field]
+            for field in LOGGED_NLU_RESPONSE_FIELDS
+            if field in nlu_response
+        }
+        return cls(compact_json(logged_nlu_response), compact_json(request_object))
+
+    def to_row(self):
+        return (self.nlu_response, self.request_object)
+
+
+def encode_log_rows(batch):
+    """The (nlu_response, request_object) rows of a batch of RequestLogRecords, for COPY"""
+    return [record.to_row() for record in batch]
+
+
+async def copy_rows_to_message_table(rows):
+    """Inserts the rows with a single COPY over a raw asyncpg connection from the pool"""
+    start = time.perf_counter()
+    async with get_async_engine().connect() as connection:
+        pool_telemetry.record_checkout_wait(time.perf_counter() - start)
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(
+            Message.__tablename__, records=rows, columns=MESSAGE_COPY_COLUMNS
+        )
+
+
+# Errors from a lost or unavailable connection, which a later attempt on a new connection can get past
+RETRYABLE_LOG_WRITE_ERRORS = (
+    ConnectionDoesNotExistError,
+    PostgresConnectionError,
+    TooManyConnectionsError,
+    OSError,
+    PoolTimeoutError,
+)
+
+
+def compute_backoff_seconds(retry_number, base_ms, max_ms):
+    """A random delay of up to base_ms * 2 ** retry_number, capped at max_ms ("full jitter")
+
+    >>> 0 <= compute_backoff_seconds(3, base_ms=100, max_ms=5000) <= 0.8
+    True
+    >>> compute_backoff_seconds(30, base_ms=100, max_ms=5000) <= 5
+    True
+    """
+    return random.uniform(0, min(max_ms, base_ms * 2**retry_number)) / 1000
+
+
+class LogWriter:
+    """Writes encoded request-log rows to the database, one write at a time, and owns the retry policy
+
+    Each attempt takes a new connection from the pool and returns it before the backoff delay, so a struggling database sees one waiting writer per worker instead of several batches holding connections.  Writes are serialized per event loop, so the flusher and the spool replayer never write at the same time.
+    """
+
+    def __init__(
+        self,
+        write_rows=None,
+        retry_limit=LOG_WRITE_RETRY_LIMIT,
+        backoff_base_ms=LOG_WRITE_BACKOFF_BASE_MS,
+        backoff_max_ms=LOG_WRITE_BACKOFF_MAX_MS,
+        retry_budget_seconds=LOG_WRITE_RETRY_BUDGET_SECONDS,
+    ):
+        self.write_rows = write_rows or copy_rows_to_message_table
+        self.retry_limit = retry_limit
+        self.backoff_base_ms = backoff_base_ms
+        self.backoff_max_ms = backoff_max_ms
+        self.retry_budget_seconds = retry_budget_seconds
+        self.locks = {}
+        self.stats = {
+            "writes": 0,
+            "failed_writes": 0,
+            "retries": 0,
+            "retry_seconds": 0,
+            "exhausted_retry_budgets": 0,
+        }
+
+    def get_lock(self):
+        """One lock per event loop, since an asyncio.Lock cannot be shared across loops"""
+        loop = asyncio.get_running_loop()
+        if loop not in self.locks:
+            self.locks = {loop: asyncio.Lock()}
+        return self.locks[loop]
+
+    async def write(self, rows):
+        """Returns False if the rows could not be written"""
+        async with self.get_lock():
+            return await self.write_with_retries(rows)
+
+    async def write_with_retries(self, rows):
+        retry_seconds = 0
+        for retry_number in range(self.retry_limit + 1):
+            try:
+                await self.write_rows(rows)
+                self.stats["writes"] += 1
+                return True
+            except RETRYABLE_LOG_WRITE_ERRORS as e:
+                log.warning(f"Request log write failed, attempt {retry_number + 1} --- {e}")
+            except Exception as e:
+                log.error(f"Request log write failed --- {e}")
+                break
+            if retry_number == self.retry_limit:
+                log.error("Retry attempts for logging failed")
+                break
+            delay = compute_backoff_seconds(
+                retry_number, self.backoff_base_ms, self.backoff_max_ms
+            )
+            if retry_seconds + delay > self.retry_budget_seconds:
+                self.stats["exhausted_retry_budgets"] += 1
+                log.error("Retry budget for logging is used up")
+                break
+            self.stats["retries"] += 1
+            start = time.perf_counter()
+            await asyncio.sleep(delay)
+            slept_seconds = time.perf_counter() - start
+            retry_seconds += slept_seconds
+            self.stats["retry_seconds"] += slept_seconds
+        self.stats["failed_writes"] += 1
+        return False
+
+    def get_stats(self):
+        return {**self.stats, "retry_seconds": round(self.stats["retry_seconds"], 3)}
+
+
+log_writer = LogWriter()
+
+# Where the worker's rows go: the database, or the logging sidecar in sidecar mode
+request_log_writer = SidecarLogClient() if LOGGING_MODE == "sidecar" else log_writer
+
+
+def configure_sidecar_process():
+    """Makes this process the logging sidecar, which writes to the database itself with a small pool"""
+    global request_log_writer, db_pool_size
+    request_log_writer = log_writer
+    db_pool_size = LOG_SIDECAR_DB_POOL_SIZE
+    pool_telemetry.max_size = LOG_SIDECAR_DB_POOL_SIZE
+
+
+class PoolMaintainer:
+    """Checks pooled connections in the background and resizes the pool from the observed concurrency
+
+    Every liveness_interval_seconds, a SELECT 1 runs on a pooled connection, so requests never pay for a ping on checkout.  If it fails, the pool is disposed and the next write opens new connections.  Every resize_interval_seconds, the pool is recreated with the size PoolTelemetry recommends.  Both hold the writer's lock while they dispose the pool, so no write is using it when it is replaced.  Nothing runs until the engine has been created, so workers in sidecar mode never connect.
+    """
+
+    def __init__(
+        self,
+        telemetry,
+        liveness_interval_seconds=LOG_DB_LIVENESS_INTERVAL_SECONDS,
+        resize_interval_seconds=LOG_DB_POOL_RESIZE_INTERVAL_SECONDS,
+    ):
+        self.telemetry = telemetry
+        self.liveness_interval_seconds = liveness_interval_seconds
+        self.resize_interval_seconds = resize_interval_seconds
+        self.tasks = []
+
+    def start(self):
+        if self.liveness_interval_seconds > 0:
+            self.tasks.append(
+                asyncio.create_task(
+                    self.repeat(self.check_liveness, self.liveness_interval_seconds)
+                )
+            )
+        if self.resize_interval_seconds > 0:
+            self.tasks.append(
+                asyncio.create_task(
+                    self.repeat(self.resize_pool, self.resize_interval_seconds)
+                )
             )
-            session.add(log_entry)
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def repeat(self, function, interval_seconds):
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                await function()
+            except Exception as e:
+                log.error(f"Database pool maintenance failed --- {e}")
+
+    async def check_liveness(self):
+        if async_engine is None:
+            return
+        start = time.perf_counter()
         try:
-            # Commit the changes to the db and close the async session
-            await session.commit()
-        except ConnectionDoesNotExistError as e:
-            log.error(f"Experienced a connection does not exist error --- {e}")
-            retry_limit = 3
-            if retry_attempts < retry_limit:
-                await log_batch(batch, retry_attempts + 1)
-            else:
-                log.error(f"Retry attempts for logging failed --- {e}")
-                # Add the data back to the batch to preserve it
-                request_batch.requests.extend(batch)
+            async with async_engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+            is_alive = True
         except Exception as e:
-            log.error(f"Error during log_batch --- {e}")
-            # Undo changes to the database session
-            await session.rollback()
-            # Add the data back to preserve it
-            request_batch.requests.extend(batch)
-        finally:
-            log.info(f"Triggered finally statement")
-            await session.close()
+            log.warning(f"Database liveness check failed, disposing the pool --- {e}")
+            is_alive = False
+        self.telemetry.record_liveness_check(time.perf_counter() - start, is_alive)
+        if not is_alive:
+            async with log_writer.get_lock():
+                await dispose_async_engine()
+
+    async def resize_pool(self):
+        global db_pool_size
+        new_pool_size = self.telemetry.recommend_pool_size(db_pool_size)
+        self.telemetry.end_window()
+        if new_pool_size == db_pool_size:
+            return
+        async with log_writer.get_lock():
+            log.info(f"Resizing the database pool from {db_pool_size} to {new_pool_size}")
+            db_pool_size = new_pool_size
+            await dispose_async_engine()
+        self.telemetry.stats["resizes"] += 1
+
+
+pool_maintainer = PoolMaintainer(pool_telemetry)
+
+
+def get_pool_stats():
+    pool = async_engine.sync_engine.pool if async_engine is not None else None
+    return {
+        "engine_created": async_engine is not None,
+        "target_size": db_pool_size,
+        "max_overflow": compute_max_overflow(db_pool_size),
+        "pre_ping_on_checkout": LOG_DB_LIVENESS_INTERVAL_SECONDS <= 0,
+        **pool_telemetry.get_stats(pool),
+    }
+
+
+async def write_log_rows(rows):
+    """Returns False if the rows could not be written"""
+    return await request_log_writer.write(rows)
+
+
+async def log_batch(batch):
+    """Bulk uploads a set of request/response entries to the database, or hands them to the logging sidecar
+
+    Returns False if the entries could not be written
+    """
+    return await write_log_rows(encode_log_rows(batch))
+
+
+class RequestLogFlusher:
+    """Writes the request batch to the database from one supervised background task
+
+    The batch is written when it is full or when its oldest row has waited max_age_seconds.  After a failed write, the rows are appended to the local spool (or go back in the queue if there is no spool or it is full), and the flusher waits max_age_seconds before trying again, however full the queue gets.  Without a running flusher (for example, before the app starts), a full batch is written by a tracked task instead.
+    """
 
+    def __init__(self, batch, max_age_seconds=LOG_FLUSH_MAX_AGE_SECONDS, spool=None):
+        self.batch = batch
+        self.max_age_seconds = max_age_seconds
+        self.spool = spool
+        self.task = None
+        self.wake_up = None
+        self.stopping = False
+        self.retry_at = 0
+        self.flush_tasks = set()
+        self.total_flush_seconds = 0
+        self.stats = {
+            "size_flushes": 0,
+            "age_flushes": 0,
+            "drain_flushes": 0,
+            "failed_flushes": 0,
+            "spooled_flushes": 0,
+            "restarts": 0,
+            "last_flush_latency_ms": None,
+            "max_flush_latency_ms": 0,
+        }
 
-async def prepare_message_data_for_logging(message_data, nlu_response):
-    """Builds objects for each table and logs them to the database
+    def is_running(self):
+        return (
+            self.task is not None
+            and not self.task.done()
+            and self.task.get_loop() is asyncio.get_running_loop()
+        )
+
+    def start(self):
+        self.stopping = False
+        self.wake_up = asyncio.Event()
+        self.task = asyncio.create_task(self.supervise())
+
+    async def supervise(self):
+        """Restarts the flush loop if it fails unexpectedly"""
+        while not self.stopping:
+            try:
+                await self.run()
+            except Exception as e:
+                self.stats["restarts"] += 1
+                log.error(f"Request log flusher failed, restarting --- {e}")
+                await asyncio.sleep(1)
+
+    async def run(self):
+        while not self.stopping:
+            retry_in = self.retry_at - time.monotonic()
+            age = self.batch.oldest_request_age()
+            if retry_in > 0:
+                timeout = retry_in
+            elif age is None:
+                timeout = None
+            else:
+                timeout = max(0, self.max_age_seconds - age)
+            await self.wait_for_wake_up(timeout)
+            if self.stopping:
+                return
+            if self.retry_at > time.monotonic():
+                continue
+
+            age = self.batch.oldest_request_age()
+            if self.batch.is_full():
+                is_written = await self.flush("size")
+            elif age is not None and age >= self.max_age_seconds:
+                is_written = await self.flush("age")
+            else:
+                continue
+            if not is_written:
+                self.retry_at = time.monotonic() + self.max_age_seconds
+
+    async def wait_for_wake_up(self, timeout):
+        try:
+            await asyncio.wait_for(self.wake_up.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wake_up.clear()
+
+    def notify(self, new_requests=1):
+        """Called after requests are added to the batch"""
+        if self.is_running():
+            # The first rows start the max-age timer and a full batch is written right away
+            if len(self.batch.requests) == new_requests or self.batch.is_full():
+                self.wake_up.set()
+        elif self.batch.is_full():
+            flush_task = asyncio.create_task(self.flush("size"))
+            self.flush_tasks.add(flush_task)
+            flush_task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush(self, trigger):
+        requests = self.batch.take_requests()
+        if not requests:
+            return True
+        self.stats[f"{trigger}_flushes"] += 1
+        start = time.perf_counter()
+        is_written = await log_batch(requests)
+        self.record_flush_latency(time.perf_counter() - start)
+        if not is_written:
+            self.stats["failed_flushes"] += 1
+            if await self.spool_requests(requests):
+                self.stats["spooled_flushes"] += 1
+            else:
+                self.batch.return_requests(requests)
+        return is_written
+
+    async def spool_requests(self, requests):
+        if self.spool is None:
+            return False
+        return await asyncio.to_thread(self.spool.append, encode_log_rows(requests))
+
+    def record_flush_latency(self, flush_seconds):
+        flush_latency_ms = round(flush_seconds * 1000, 3)
+        self.total_flush_seconds += flush_seconds
+        self.stats["last_flush_latency_ms"] = flush_latency_ms
+        self.stats["max_flush_latency_ms"] = max(
+            self.stats["max_flush_latency_ms"], flush_latency_ms
+        )
+
+    async def drain(self):
+        """Stops the flusher after its current write and writes what is left, for worker shutdown
+
+        Rows that still cannot be written are spooled, if there is a spool, or reported in the log
+        """
+        self.stopping = True
+        if self.is_running():
+            self.wake_up.set()
+            await self.task
+        if self.flush_tasks:
+            await asyncio.gather(*self.flush_tasks, return_exceptions=True)
+        await self.flush("drain")
+        if self.spool is not None:
+            await asyncio.to_thread(self.spool.rotate)
+        if self.batch.requests:
+            log.error(
+                f"{len(self.batch.requests)} request logs were not written before shutdown"
+            )
+
+    def get_stats(self):
+        flushes = sum(
+            self.stats[f"{trigger}_flushes"] for trigger in ["size", "age", "drain"]
+        )
+        mean_flush_latency_ms = None
+        if flushes:
+            mean_flush_latency_ms = round(self.total_flush_seconds / flushes * 1000, 3)
+        return {
+            **self.stats,
+            **self.batch.get_stats(),
+            "mean_flush_latency_ms": mean_flush_latency_ms,
+            "flusher_running": self.task is not None and not self.task.done(),
+        }
+
+
+def prepare_message_data_for_logging(message_data, nlu_response):
+    """Builds a compact log record for the request and queues it to be logged to the database
+
+    It only queues the record, so the endpoints call it directly rather than in a task.  The phone number (author_id) is never logged
 
     Input:
     - message_data: an object with the full message data from Turn.io/Whatsapp
     """
-    # Remove phone number from logging
-    del message_data["author_id"]
-
     try:
-        message_data = {"nlu_response": nlu_response, "request_object": message_data}
-    except AttributeError as e:
+        record = RequestLogRecord.from_request(message_data, nlu_response)
+    except (AttributeError, TypeError, ValueError) as e:
         log.error(
             f"Build message_data object for Supabase failed: {message_data} / {e}"
         )
         return False
 
-    request_batch.add_request(message_data)
-    if request_batch.is_full():
-        batch = request_batch.requests.copy()
-        request_batch.empty_requests()
-        asyncio.create_task(log_batch(batch))
-    # print("Current number of connections:", pool.checkedin())
+    request_batch.add_request(record)
+    request_log_flusher.notify()
+
+
+log_spool = LogSpool() if LOG_SPOOL_ENABLED else None
+request_log_flusher = RequestLogFlusher(request_batch, spool=log_spool)
+log_spool_replayer = (
+    LogSpoolReplayer(log_spool, write_log_rows) if log_spool else None
+)
+
+
+def start_request_logging():
+    """Starts the background flusher, spool replayer, and pool maintenance of the worker (or of the sidecar)"""
+    request_log_flusher.start()
+    if request_log_writer is log_writer:
+        pool_maintainer.start()
+    if log_spool_replayer is not None:
+        log_spool_replayer.start()
+
+
+async def drain_request_logging():
+    """Writes or spools the waiting request logs before the worker exits"""
+    if log_spool_replayer is not None:
+        await log_spool_replayer.stop()
+    await pool_maintainer.stop()
+    await request_log_flusher.drain()
+
+
+def get_request_logging_stats():
+    spool_stats = {"enabled": False}
+    if log_spool_replayer is not None:
+        spool_stats = {"enabled": True, **log_spool_replayer.get_stats()}
+    return {
+        **request_log_flusher.get_stats(),
+        "mode": LOGGING_MODE,
+        "writer": request_log_writer.get_stats(),
+        "pool": get_pool_stats(),
+        "spool": spool_stats,
+    }
+
+
+async def warm_up_request_logging():
+    """Opens the first database connection of the pool, or the connection to the logging sidecar"""
+    if request_log_writer is log_writer:
+        async with get_async_engine().connect() as connection:
+            await connection.execute(text("SELECT 1"))
+    elif not await request_log_writer.write([]):
+        raise ConnectionError("the logging sidecar is unreachable")
@@ -6,17 +6,20 @@ import sentry_sdk
 from logging import getLogger
 
 from mathtext.constants import TOKENS2INT_ERROR_INT
-from mathtext.predict_intent import predict_message_intent
 from mathtext.utils.checkers import (
     has_profanity,
 )
-from mathtext.text_processing import (
-    normalize_message_and_answer,
-)
 
+from mathtext_fastapi.cache import get_or_create_cache_entry
 from mathtext_fastapi.constants import (
     APPROVED_INTENT_CONFIDENCE_THRESHOLD,
 )
+from mathtext_fastapi.deadline import has_budget_for_model_stage, record_stage_result
+from mathtext_fastapi.inference import predict_message_intent_in_executor
+from mathtext_fastapi.nlu_evaluations.answer_profile import (
+    get_answer_profile,
+    normalize_student_message,
+)
 from mathtext_fastapi.nlu_evaluations.evaluation_utils import (
     evaluate_for_exact_keyword_match_in_phrase,
     check_answer_intent_confidence,
@@ -32,14 +35,19 @@ from mathtext_fastapi.nlu_evaluations.evaluations import (
     extract_special_numbers_with_regex,
     find_highest_confidence_intent_over_threshold,
 )
+from mathtext_fastapi.nlu_evaluations.planner import plan_text_processing_evaluations
+from mathtext_fastapi.request_events import request_events
 from mathtext_fastapi.response_formaters import build_single_event_nlu_response
 
 log = getLogger(__name__)
 
 
-async def run_keyword_and_intent_evaluations(text):
+@get_or_create_cache_entry("nlu_intent_recognition")
+async def run_keyword_and_intent_evaluations(text, deadline=None):
     """Evaluates a student message to check the message's intent through an approved keyword or intent
 
+    When the deadline leaves too little time for the intent model, the message is reported as out of scope and the response is marked degraded
+
     >>> asyncio.run(run_keyword_and_intent_evaluations("fuck"))
     {'type': 'intent', 'data': 'profanity', 'confidence': 1.0}
     >>> asyncio.run(run_keyword_and_intent_evaluations("menu"))
@@ -55,7 +63,12 @@ async def run_keyword_and_intent_evaluations(text):
     result = evaluate_for_exact_keyword_match_in_phrase(text, "", "")
     if result and result != TOKENS2INT_ERROR_INT:
         return build_single_event_nlu_response("keyword", result)
-    result = predict_message_intent(text)
+
+    if not has_budget_for_model_stage(deadline):
+        return deadline.mark_response(
+            build_single_event_nlu_response("out_of_scope", text, 0.0)
+        )
+    result = await predict_message_intent_in_executor(text)
     if (
         result
         and result != TOKENS2INT_ERROR_INT
@@ -68,12 +81,16 @@ async def run_keyword_and_intent_evaluations(text):
     return build_single_event_nlu_response("out_of_scope", text, 0.0)
 
 
-def run_text_processing_evaluations(
+async def run_text_processing_evaluations(
     normalized_student_message,
-    normalized_expected_answer,
-    expected_answer,
+    answer_profile,
     student_message,
+    deadline=None,
 ):
+    """Runs the rule-based evaluations in order and returns the first result
+
+    The rule stages are cheap and are not cut short by the deadline.  The deadline only decides whether the approved answer evaluation can still confirm a wrong answer with the intent model.  Stages that the planner shows cannot match the message are skipped.
+    """
     # Evaluate 1 - Check for invalid input
     result = check_for_invalid_input(student_message)
     if result:
@@ -81,50 +98,51 @@ def run_text_processing_evaluations(
 
     # Evaluation 2 - Check for exact match
     with sentry_sdk.start_span(description="V2 Comparison Evaluation"):
-        result = extract_exact_answer_match(
-            normalized_student_message,
-            normalized_expected_answer,
-            expected_answer,
-        )
+        result = extract_exact_answer_match(normalized_student_message, answer_profile)
         if result:
             return result
 
+    plan = plan_text_processing_evaluations(
+        normalized_student_message, answer_profile, student_message
+    )
+
     # Evaluation 3 - Check for pre-defined answers and common misspellings
     with sentry_sdk.start_span(description="V2 Text Evaluation"):
         intents_results = {}
-        result = extract_approved_answer(
-            normalized_student_message,
-            normalized_expected_answer,
-            expected_answer,
-            student_message,
-        )
+        if plan["approved_answer"]:
+            result = await extract_approved_answer(
+                normalized_student_message,
+                answer_profile,
+                student_message,
+                deadline,
+            )
 
-        if result and not result.get("intents", {}):
-            return result
+            if result and not result.get("intents", {}):
+                return result
 
-        if result.get("intents", {}):
-            intents_results = result
+            if result.get("intents", {}):
+                intents_results = result
 
-        result = extract_approved_keyword(
-            normalized_student_message,
-            normalized_expected_answer,
-            expected_answer,
-        )
-        if result:
-            return result
+        if plan["approved_keyword"]:
+            result = extract_approved_keyword(
+                normalized_student_message, answer_profile
+            )
+            if result:
+                return result
 
     # Evaluation 4 - Check for fraction, decimal, time, and exponent answers
-    with sentry_sdk.start_span(description="V2 Regex Number Evaluation"):
-        result = extract_special_numbers_with_regex(
-            student_message, normalized_expected_answer
-        )
-        if result:
-            return result
+    if plan["special_numbers"]:
+        with sentry_sdk.start_span(description="V2 Regex Number Evaluation"):
+            result = extract_special_numbers_with_regex(
+                student_message, answer_profile
+            )
+            if result:
+                return result
 
     # Evaluation 5 - Check for exact int or float number
     with sentry_sdk.start_span(description="V2 Exact Number Evaluation"):
         result = extract_number_match_to_expected_answer(
-            normalized_student_message, expected_answer
+            normalized_student_message, answer_profile
         )
         if result:
             return result
@@ -133,58 +151,80 @@ def run_text_processing_evaluations(
     return {}
 
 
-async def v2_evaluate_message_with_nlu(student_message, expected_answer):
-    """Process a student's message using NLU functions and send the result"""
-    with sentry_sdk.start_transaction(op="task", name="V2 NLU Evaluation"):
-        log.info(f"Starting evaluate message: {student_message}")
+async def run_v2_evaluation_stages(student_message, expected_answer, deadline=None):
+    """Runs the rule-based and model evaluations in order and returns the first result
 
-        result = ""
-        (
-            normalized_student_message,
-            normalized_expected_answer,
-        ) = normalize_message_and_answer(student_message, expected_answer)
+    Each result is recorded on the deadline as soon as a stage produces it, so a timeout returns it instead of the timeout response
+    """
+    result = ""
+    normalized_student_message = normalize_student_message(student_message)
+    answer_profile = get_answer_profile(expected_answer)
 
-        intents_results = []
-        is_answer = None
+    intents_results = []
+    is_answer = None
 
-        if len(student_message) < 50:
-            result = run_text_processing_evaluations(
-                normalized_student_message,
-                normalized_expected_answer,
-                expected_answer,
-                student_message,
-            )
-            if result and not result.get("intents", ""):
-                return result
-            if result and result.get("intents", ""):
-                intents_results = result.get("intents", [])
-
-        with sentry_sdk.start_span(description="V2 Model Evaluation"):
-            # Evaluation 6 - Classify intent with multilabel logistic regression model
-            if not intents_results:
-                intents_result_dict = predict_message_intent(student_message)
-                intents_results = intents_result_dict.get("intents", [])
-                is_answer = check_answer_intent_confidence(intents_results)
-
-        if is_answer:
-            # Evaluation 7 - Extract integers/floats with regex
-            with sentry_sdk.start_span(description="V2 Number Extraction"):
-                result = extract_integers_and_floats_with_regex(
-                    student_message, expected_answer
-                )
-                if result:
-                    return result
-
-        # Evaluation 8 - Final check for "yes" answer
-        result = check_for_yes_answer_in_intents(
-            intents_results, normalized_expected_answer
+    if len(student_message) < 50:
+        result = await run_text_processing_evaluations(
+            normalized_student_message,
+            answer_profile,
+            student_message,
+            deadline,
         )
-        if result:
-            return result
+        if result and not result.get("intents", ""):
+            return record_stage_result(deadline, result)
+        if result and result.get("intents", ""):
+            intents_results = result.get("intents", [])
+
+    with sentry_sdk.start_span(description="V2 Model Evaluation"):
+        # Evaluation 6 - Classify intent with multilabel logistic regression model
+        if not intents_results and has_budget_for_model_stage(deadline):
+            intents_result_dict = await predict_message_intent_in_executor(
+                student_message
+            )
+            intents_results = intents_result_dict.get("intents", [])
+            is_answer = check_answer_intent_confidence(intents_results)
+
+    if is_answer:
+        # Evaluation 7 - Extract integers/floats with regex
+        with sentry_sdk.start_span(description="V2 Number Extraction"):
+            result = extract_integers_and_floats_with_regex(
+                student_message, answer_profile
+            )
+            if result:
+                return record_stage_result(deadline, result)
 
-        # Evaluation 9 - Extract approved intents
-        result = find_highest_confidence_intent_over_threshold(intents_results)
-        if result:
-            return result
+    # Evaluation 8 - Final check for "yes" answer
+    result = check_for_yes_answer_in_intents(
+        intents_results, answer_profile
+    )
+    if result:
+        return record_stage_result(deadline, result)
+
+    # Evaluation 9 - Extract approved intents
+    result = find_highest_confidence_intent_over_threshold(intents_results)
+    if result:
+        return record_stage_result(deadline, result)
+
+    return record_stage_result(
+        deadline, build_single_event_nlu_response("out_of_scope", student_message, 0.0)
+    )
 
-    return build_single_event_nlu_response("out_of_scope", student_message, 0.0)
+
+@get_or_create_cache_entry("v2_nlu")
+async def v2_evaluate_message_with_nlu(student_message, expected_answer, deadline=None):
+    """Process a student's message using NLU functions and send the result
+
+    With a deadline, stages that no longer fit in the time budget are skipped and the response is marked degraded
+    """
+    with sentry_sdk.start_transaction(op="task", name="V2 NLU Evaluation"):
+        request_events.log_event(
+            "evaluation_started",
+            message_text=student_message,
+            expected_answer=expected_answer,
+        )
+        nlu_response = await run_v2_evaluation_stages(
+            student_message, expected_answer, deadline
+        )
+    if deadline is not None:
+        return deadline.mark_response(nlu_response)
+    return nlu_response
@@ -0,0 +1,82 @@
+""" Warms up a worker before it reports ready so the first student requests do not pay for lazy model loading and first-call setup """
+
+import asyncio
+import time
+
+from logging import getLogger
+
+from mathtext_fastapi.supabase_logging_async import warm_up_request_logging
+from mathtext_fastapi.v2_nlu import (
+    run_keyword_and_intent_evaluations,
+    v2_evaluate_message_with_nlu,
+)
+
+log = getLogger(__name__)
+
+# Covers the keyword, text, regex, number, and model stages of the pipeline
+WARMUP_MESSAGES = [
+    ("8", "8"),
+    ("maybe 2000", "2000"),
+    ("twenty", "20"),
+    ("1/2", "1/2"),
+    ("10:45", "10:30"),
+    ("2^3", "2^3"),
+    ("yes", "Yes"),
+    ("b", "A"),
+    ("menu", "8"),
+    ("I want to change topics", "8"),
+]
+
+warmup_state = {
+    "ready": False,
+    "duration_seconds": None,
+    "errors": [],
+}
+
+
+async def warm_up_evaluations():
+    """Runs the canned messages through both evaluation pipelines, concurrently so the model's batched path is exercised too
+
+    The undecorated evaluations are called, so a warm response cache cannot answer the canned messages for the model and warmup does not write them to the shared cache
+    """
+    await asyncio.gather(
+        *[
+            v2_evaluate_message_with_nlu.__wrapped__(message, expected_answer)
+            for message, expected_answer in WARMUP_MESSAGES
+        ],
+        *[
+            run_keyword_and_intent_evaluations.__wrapped__(message)
+            for message, _ in WARMUP_MESSAGES
+        ],
+    )
+
+
+async def warm_up_database():
+    """Opens the first connection of the logging pool, or to the logging sidecar"""
+    await warm_up_request_logging()
+
+
+async def run_warmup():
+    """Warms up the worker and records whether it is ready to serve
+
+    The worker is only ready if the evaluations succeed.  A database failure is recorded but does not block readiness, because request logging already recovers from an unavailable database.
+    """
+    warmup_state.update(ready=False, duration_seconds=None, errors=[])
+    start = time.perf_counter()
+    try:
+        await warm_up_evaluations()
+    except Exception as e:
+        log.error(f"Evaluation warmup failed: {e}")
+        warmup_state["errors"].append(f"evaluations: {e}")
+        warmup_state["duration_seconds"] = round(time.perf_counter() - start, 3)
+        return
+
+    try:
+        await warm_up_database()
+    except Exception as e:
+        log.error(f"Database warmup failed: {e}")
+        warmup_state["errors"].append(f"database: {e}")
+
+    warmup_state["duration_seconds"] = round(time.perf_counter() - start, 3)
+    warmup_state["ready"] = True
+    log.info(f"Warmup finished in {warmup_state['duration_seconds']} seconds")
@@ -0,0 +1,90 @@
+"""Measures intent model throughput and tail latency for several micro-batch sizes
+
+Requests arrive concurrently at a fixed rate, like a classroom burst, and each one awaits its own prediction.
+
+Run with the same model environment variables as the API:
+`python -m scripts.benchmark_intent_batching --rate 200 --duration 10`
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from mathtext_fastapi.inference import (
+    IntentMicroBatcher,
+    load_intent_recognizer_model,
+    shutdown_inference_executor,
+)
+
+SAMPLE_MESSAGES = [
+    "I want to change topics",
+    "I need an explanation",
+    "maybe 2000",
+    "yes",
+    "stop",
+    "let me choose something else",
+    "I don't know",
+    "twenty five",
+    "can I take a break",
+    "that's 2 / 3",
+]
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32]
+
+
+async def timed_prediction(batcher, message, latencies):
+    start = time.perf_counter()
+    await batcher.predict(message)
+    latencies.append(time.perf_counter() - start)
+
+
+async def run_load(batcher, rate, duration):
+    """Sends `rate` requests per second for `duration` seconds and returns the latencies"""
+    latencies = []
+    tasks = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        message = random.choice(SAMPLE_MESSAGES)
+        tasks.append(asyncio.create_task(timed_prediction(batcher, message, latencies)))
+        await asyncio.sleep(random.expovariate(rate))
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def main(rate, duration, window_ms, batch_sizes):
+    load_intent_recognizer_model()
+    print(
+        f"{'batch_size':>10} {'requests':>9} {'req/s':>8} {'p50_ms':>8} {'p99_ms':>8} {'batches':>8}"
+    )
+    for batch_size in batch_sizes:
+        batcher = IntentMicroBatcher(window_ms=window_ms, max_batch_size=batch_size)
+        start = time.perf_counter()
+        latencies = await run_load(batcher, rate, duration)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{batch_size:>10} "
+            f"{len(latencies):>9} "
+            f"{len(latencies) / elapsed:>8.1f} "
+            f"{statistics.median(latencies) * 1000:>8.1f} "
+            f"{percentile(latencies, 99) * 1000:>8.1f} "
+            f"{batcher.stats['batches']:>8}"
+        )
+    shutdown_inference_executor()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rate", type=float, default=100, help="requests per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per run")
+    parser.add_argument("--window-ms", type=float, default=5)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    args = parser.parse_args()
+    asyncio.run(main(args.rate, args.duration, args.window_ms, args.batch_sizes))
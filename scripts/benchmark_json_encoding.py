@@ -0,0 +1,97 @@
+"""Measures the per-request JSON overhead of the NLU endpoints with the stdlib codec and with orjson
+
+Each request decodes a Turn.io payload and builds the response object for one NLU response: `json.loads` and `JSONResponse` as the endpoints used to, then `orjson.loads` and the pre-encoded responses they use now.
+
+`python -m scripts.benchmark_json_encoding --requests 100000`
+"""
+
+import argparse
+import json
+import time
+
+import orjson
+
+from fastapi.responses import JSONResponse
+
+from mathtext_fastapi.constants import ERROR_RESPONSE_DICT
+from mathtext_fastapi.json_responses import build_nlu_json_response
+
+SAMPLE_RESPONSES = {
+    "keyword": {"type": "keyword", "data": "menu", "confidence": 1.0},
+    "error": ERROR_RESPONSE_DICT,
+    "correct_answer": {"type": "correct_answer", "data": "8", "confidence": 1.0},
+    "intents": {
+        "type": "intents",
+        "data": "change_topic",
+        "confidence": 0.84,
+        "intents": [
+            {"type": "intent", "data": "change_topic", "confidence": 0.84},
+            {"type": "intent", "data": "next_lesson", "confidence": 0.1},
+            {"type": "intent", "data": "hint", "confidence": 0.02},
+        ],
+    },
+}
+
+
+def build_sample_body():
+    """A request body shaped like the ones Turn.io sends, with the _vnd envelope
+
+    >>> json.loads(build_sample_body())["message_data"]["message_body"]
+    'maybe 8'
+    """
+    message_data = {
+        "author_id": "+15555555555",
+        "author_type": "OWNER",
+        "contact_uuid": "43qy76ga-4hjk-24nj-sfd7-k4ljl46j0ds09",
+        "message_body": "maybe 8",
+        "expected_answer": "8",
+        "message_direction": "inbound",
+        "message_id": "4kl209sd0-a7b8-2hj3-8563-3hu4a89b32",
+        "message_inserted_at": "2023-01-10T02:37:28.477940Z",
+        "message_updated_at": "2023-01-10T02:37:28.487319Z",
+        "_vnd": {
+            "v1": {
+                "author": {"id": "+15555555555", "name": "Student", "type": "OWNER"},
+                "chat": {"owner": "+15555555555", "state": "OPEN", "unread_count": 0},
+                "direction": "inbound",
+                "labels": [],
+            }
+        },
+    }
+    return json.dumps({"message_data": message_data}).encode("utf-8")
+
+
+def encode_with_stdlib(body, nlu_response):
+    json.loads(body)
+    return JSONResponse(content=nlu_response).body
+
+
+def encode_with_orjson(body, nlu_response):
+    orjson.loads(body)
+    return build_nlu_json_response(nlu_response).body
+
+
+def measure_microseconds_per_request(function, body, nlu_response, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        function(body, nlu_response)
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main(requests):
+    body = build_sample_body()
+    print(f"{requests} requests, {len(body)} byte request body")
+    print(f"{'response':>15} {'stdlib':>9} {'orjson':>9}")
+    for name, nlu_response in SAMPLE_RESPONSES.items():
+        stdlib_us, orjson_us = [
+            measure_microseconds_per_request(function, body, nlu_response, requests)
+            for function in [encode_with_stdlib, encode_with_orjson]
+        ]
+        print(f"{name:>15} {stdlib_us:8.2f}us {orjson_us:8.2f}us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100000)
+    args = parser.parse_args()
+    main(args.requests)
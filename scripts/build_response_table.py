@@ -0,0 +1,127 @@
+"""Builds the precomputed response table from the most common (message, expected answer) pairs in the logs
+
+Pairs are counted in the Supabase `message` table, or in a JSONL export with one logged request per line.  The top pairs are evaluated with the current pipeline and written to RESPONSE_TABLE_PATH with the pipeline fingerprint, so the API ignores the table once mathtext, the model, or the intent settings change.
+
+Run with the same model and database environment variables as the API:
+`python -m scripts.build_response_table --top-k 5000`
+`python -m scripts.build_response_table --jsonl message_export.jsonl`
+"""
+
+import argparse
+import asyncio
+import json
+
+from collections import Counter
+from collections.abc import Mapping
+
+from sqlalchemy import text
+
+from mathtext_fastapi.cache import is_cacheable_response
+from mathtext_fastapi.constants import RESPONSE_TABLE_PATH
+from mathtext_fastapi.request_validators import get_message_text_and_expected_answer
+from mathtext_fastapi.response_table import write_response_table
+from mathtext_fastapi.v2_nlu import run_v2_evaluation_stages
+
+TOP_PAIRS_QUERY = text(
+    """
+    SELECT request_object->>'message_body' AS message_body,
+           request_object->>'expected_answer' AS expected_answer,
+           count(*) AS requests
+    FROM message
+    WHERE request_object ? 'message_body'
+    GROUP BY 1, 2
+    ORDER BY requests DESC
+    LIMIT :limit
+    """
+)
+
+
+def extract_message_dict(record):
+    """Finds the message data in a logged row, a request body, or bare message data
+
+    >>> extract_message_dict({"request_object": {"message_body": "8", "expected_answer": "8"}})
+    {'message_body': '8', 'expected_answer': '8'}
+    >>> extract_message_dict({"message_data": {"message_body": "8"}})
+    {'message_body': '8'}
+    >>> extract_message_dict({"nlu_response": {}}) is None
+    True
+    """
+    for field in ["request_object", "message_data"]:
+        if field in record:
+            record = record[field]
+            break
+    if isinstance(record, str):
+        record = json.loads(record)
+    if isinstance(record, Mapping) and "message_body" in record:
+        return record
+    return None
+
+
+def count_pairs_in_jsonl(path):
+    pair_counts = Counter()
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            message_dict = extract_message_dict(json.loads(line))
+            if message_dict is not None:
+                pair_counts[get_message_text_and_expected_answer(message_dict)] += 1
+    return pair_counts
+
+
+async def count_pairs_in_database(limit):
+    # Imported here so a JSONL build does not need database settings
+    from mathtext_fastapi.supabase_logging_async import (
+        dispose_async_engine,
+        get_async_engine,
+    )
+
+    pair_counts = Counter()
+    async with get_async_engine().connect() as connection:
+        result = await connection.execute(TOP_PAIRS_QUERY, {"limit": limit})
+        for message_body, expected_answer, requests in result:
+            message_dict = {
+                "message_body": message_body or "",
+                "expected_answer": expected_answer or "",
+            }
+            pair_counts[get_message_text_and_expected_answer(message_dict)] += requests
+    await dispose_async_engine()
+    return pair_counts
+
+
+async def evaluate_top_pairs(pair_counts, top_k):
+    """Runs the top pairs through the v2 pipeline and keeps the complete responses"""
+    entries = []
+    covered_requests = 0
+    for (message_text, expected_answer), requests in pair_counts.most_common(top_k):
+        response = await run_v2_evaluation_stages(message_text, expected_answer)
+        if is_cacheable_response(response):
+            entries.append((message_text, expected_answer, response))
+            covered_requests += requests
+    return entries, covered_requests
+
+
+async def main(jsonl_path, top_k, output_path):
+    if jsonl_path:
+        pair_counts = count_pairs_in_jsonl(jsonl_path)
+    else:
+        pair_counts = await count_pairs_in_database(top_k)
+    entries, covered_requests = await evaluate_top_pairs(pair_counts, top_k)
+    written = write_response_table(output_path, entries)
+    total_requests = sum(pair_counts.values())
+    print(
+        f"Wrote {written} responses to {output_path}, "
+        f"covering {covered_requests} of {total_requests} counted requests"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--jsonl",
+        help="JSONL export of logged requests (defaults to the Supabase message table)",
+    )
+    parser.add_argument("--top-k", type=int, default=5000)
+    parser.add_argument("--output", default=RESPONSE_TABLE_PATH)
+    args = parser.parse_args()
+    asyncio.run(main(args.jsonl, args.top_k, args.output))
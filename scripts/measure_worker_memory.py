@@ -0,0 +1,91 @@
+"""Reports RSS and PSS for the gunicorn master and each worker (Linux only)
+
+RSS counts shared pages once per process, so it overstates the total.  PSS splits each shared page between the processes that map it, so the PSS column adds up to the real footprint.  The logging sidecar is not a worker and does not load the model, so it is left out.  With PRELOAD_MODEL=true, the workers' shared memory should hold the model weights, and their private memory should be well below the model size.
+
+Usage:
+`python -m scripts.measure_worker_memory [master_pid]`
+"""
+
+import sys
+
+from pathlib import Path
+
+FIELDS = ["Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty"]
+
+
+def read_memory_kb(pid):
+    """Reads the memory totals of a process from /proc/<pid>/smaps_rollup"""
+    memory = {}
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+        name, _, value = line.partition(":")
+        if name in FIELDS:
+            memory[name] = int(value.split()[0])
+    return memory
+
+
+def is_gunicorn_process(pid):
+    """Checks for a python process that runs gunicorn (skipping wrappers like `timeout gunicorn`)"""
+    try:
+        executable = Path(f"/proc/{pid}/exe").resolve().name
+        cmdline = Path(f"/proc/{pid}/cmdline").read_bytes()
+    except OSError:
+        return False
+    return executable.startswith("python") and b"gunicorn" in cmdline
+
+
+def find_gunicorn_master():
+    for proc in Path("/proc").iterdir():
+        if not proc.name.isdigit() or not is_gunicorn_process(proc.name):
+            continue
+        try:
+            ppid = int((proc / "stat").read_text().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if not is_gunicorn_process(ppid):
+            return int(proc.name)
+    return None
+
+
+def is_log_sidecar(pid):
+    """Checks for the logging sidecar, which the master also starts when LOGGING_MODE=sidecar"""
+    try:
+        cmdline = Path(f"/proc/{pid}/cmdline").read_bytes()
+    except OSError:
+        return False
+    return b"mathtext_fastapi.log_sidecar" in cmdline
+
+
+def find_children(pid):
+    children = Path(f"/proc/{pid}/task/{pid}/children").read_text().split()
+    return [int(child) for child in children]
+
+
+def main(master_pid=None):
+    master_pid = master_pid or find_gunicorn_master()
+    if master_pid is None:
+        print("No running gunicorn master found")
+        return
+
+    processes = [("master", master_pid)] + [
+        ("worker", pid)
+        for pid in find_children(master_pid)
+        if not is_log_sidecar(pid)
+    ]
+    print(f"{'process':>8} {'pid':>8} " + " ".join(f"{f + '_MB':>17}" for f in FIELDS))
+    totals = dict.fromkeys(FIELDS, 0)
+    for role, pid in processes:
+        memory = read_memory_kb(pid)
+        for field in FIELDS:
+            totals[field] += memory.get(field, 0)
+        print(
+            f"{role:>8} {pid:>8} "
+            + " ".join(f"{memory.get(f, 0) / 1024:>17.1f}" for f in FIELDS)
+        )
+    print(
+        f"{'total':>8} {'':>8} "
+        + " ".join(f"{totals[f] / 1024:>17.1f}" for f in FIELDS)
+    )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -1,3 +1,6 @@
+import json
+
+
 def add_message_text_to_sample_object(student_message, expected_answer):
     """
     Builds a sample request object using an example of a student answer
@@ -31,3 +34,13 @@ def simulate_api_call(client, student_message, expected_answer):
     message_data = add_message_text_to_sample_object(student_message, expected_answer)
     response = client.post("/v2/nlu", data=message_data)
     return response
+
+
+def simulate_batch_api_call(client, message_pairs):
+    """Sends a list of (student_message, expected_answer) pairs to the batch endpoint"""
+    message_data = [
+        json.loads(add_message_text_to_sample_object(*pair))["message_data"]
+        for pair in message_pairs
+    ]
+    response = client.post("/v2/nlu/batch", json={"message_data": message_data})
+    return response
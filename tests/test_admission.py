@@ -0,0 +1,31 @@
+from fastapi.testclient import TestClient
+from tests.simulate_api_call import simulate_api_call
+import app
+
+client = TestClient(app.app)
+
+
+def test_request_is_admitted_under_the_limit():
+    accepted = client.get("/metrics").json()["admission"]["accepted"]
+    response = simulate_api_call(client, "10", "10")
+    assert response.status_code == 200
+    assert response.json()["type"] == "correct_answer"
+    assert client.get("/metrics").json()["admission"]["accepted"] == accepted + 1
+
+
+def test_request_is_shed_when_the_queue_is_full(monkeypatch):
+    monkeypatch.setattr(app.nlu_admission_controller, "max_in_flight", 0)
+    monkeypatch.setattr(app.nlu_admission_controller, "max_queue", 0)
+    shed = client.get("/metrics").json()["admission"]["shed"]
+    response = simulate_api_call(client, "10", "10")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"]
+    assert response.json()["type"] == "timeout"
+    assert client.get("/metrics").json()["admission"]["shed"] == shed + 1
+
+
+def test_other_endpoints_are_not_admission_controlled(monkeypatch):
+    monkeypatch.setattr(app.nlu_admission_controller, "max_in_flight", 0)
+    monkeypatch.setattr(app.nlu_admission_controller, "max_queue", 0)
+    response = client.get("/keywords")
+    assert response.status_code == 200
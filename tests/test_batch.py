@@ -0,0 +1,62 @@
+from fastapi.testclient import TestClient
+from tests.simulate_api_call import simulate_api_call, simulate_batch_api_call
+import app
+
+client = TestClient(app.app)
+
+
+def test_batch_returns_responses_in_request_order():
+    message_pairs = [("10", "10"), ("menu", "374"), ("10", "15")]
+    response = simulate_batch_api_call(client, message_pairs)
+    assert response.status_code == 200
+    assert [(r["type"], r["data"]) for r in response.json()] == [
+        ("correct_answer", "10"),
+        ("keyword", "menu"),
+        ("wrong_answer", "10"),
+    ]
+
+
+def test_batch_matches_single_message_endpoint():
+    message_pairs = [("maybe 2000", "2000"), ("I want to change topics", "374")]
+    response = simulate_batch_api_call(client, message_pairs)
+    assert response.status_code == 200
+    for pair, batch_response in zip(message_pairs, response.json()):
+        single_response = simulate_api_call(client, *pair).json()
+        assert batch_response["type"] == single_response["type"]
+        assert batch_response["data"] == single_response["data"]
+
+
+def test_batch_repeats_result_for_duplicate_messages():
+    response = simulate_batch_api_call(client, [("twenty", "20")] * 3)
+    assert response.status_code == 200
+    assert len(response.json()) == 3
+    assert all(r["type"] == "correct_answer" for r in response.json())
+    assert all(r["data"] == "20" for r in response.json())
+
+
+def test_batch_marks_invalid_items_as_errors():
+    message_data = [{"message_body": "10", "expected_answer": "10"}]
+    response = client.post("/v2/nlu/batch", json={"message_data": message_data})
+    assert response.status_code == 200
+    assert response.json()[0]["type"] == "error"
+
+
+def test_batch_rejects_non_list_payload():
+    message_data = {"message_body": "10"}
+    response = client.post("/v2/nlu/batch", json={"message_data": message_data})
+    assert response.status_code == 200
+    assert response.json()["type"] == "error"
+
+
+def test_batch_over_the_size_limit_is_rejected(monkeypatch):
+    monkeypatch.setattr(app, "NLU_BATCH_MAX_SIZE", 2)
+    evaluated = []
+
+    async def record_evaluation(*args):
+        evaluated.append(args)
+
+    monkeypatch.setattr(app, "run_v2_nlu_evaluation", record_evaluation)
+    response = simulate_batch_api_call(client, [("10", "10"), ("11", "11"), ("12", "12")])
+    assert response.status_code == 413
+    assert response.json()["type"] == "error"
+    assert evaluated == []
@@ -0,0 +1,96 @@
+import asyncio
+import uuid
+
+import fakeredis
+
+from fastapi.testclient import TestClient
+from tests.simulate_api_call import simulate_api_call
+import app
+
+from mathtext_fastapi.cache import (
+    CircuitBreaker,
+    RedisResponseCache,
+    redis_response_cache,
+    response_lru,
+)
+
+client = TestClient(app.app)
+
+
+def test_writes_are_pipelined_in_one_batch():
+    cache = RedisResponseCache(client_factory=fakeredis.FakeAsyncRedis)
+
+    async def write_then_read():
+        for i in range(10):
+            cache.set_later(f"key:{i}", f"value:{i}")
+        await cache.writer_task
+        return [await cache.get(f"key:{i}") for i in range(10)]
+
+    values = asyncio.run(write_then_read())
+    assert values == [f"value:{i}".encode() for i in range(10)]
+    stats = cache.get_stats()
+    assert stats["writes"] == 10
+    assert stats["write_batches"] == 1
+    assert stats["hits"] == 10
+
+
+def test_breaker_stops_lookups_after_repeated_failures():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    cache = RedisResponseCache(
+        client_factory=lambda: fakeredis.FakeAsyncRedis(server=server),
+        breaker=CircuitBreaker(failure_threshold=3, cool_down_seconds=60),
+    )
+
+    async def look_up_repeatedly():
+        return [await cache.get("key") for _ in range(5)]
+
+    assert asyncio.run(look_up_repeatedly()) == [None] * 5
+    stats = cache.get_stats()
+    assert stats["errors"] == 3
+    assert stats["breaker"]["state"] == "open"
+    assert stats["breaker"]["short_circuited"] == 2
+
+
+def test_v2_response_is_served_from_redis(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redis_response_cache,
+        "client_factory",
+        lambda: fakeredis.FakeAsyncRedis(server=server),
+    )
+    monkeypatch.setattr(redis_response_cache, "clients", {})
+    monkeypatch.setattr(redis_response_cache, "breaker", CircuitBreaker())
+    message = f"maybe 9 {uuid.uuid4().hex}"
+
+    # One event loop for both requests, so the queued write and the lookup share a Redis client
+    with TestClient(app.app) as loop_client:
+        first_response = simulate_api_call(loop_client, message, "9")
+        loop_client.portal.call(redis_response_cache.drain)
+        response_lru.clear()
+        hits = redis_response_cache.get_stats()["hits"]
+        second_response = simulate_api_call(loop_client, message, "9")
+
+    assert second_response.json() == first_response.json()
+    assert redis_response_cache.get_stats()["hits"] == hits + 1
+
+
+def test_client_of_a_finished_event_loop_is_closed():
+    closed_clients = []
+
+    class ClosingFakeRedis(fakeredis.FakeAsyncRedis):
+        async def aclose(self, *args, **kwargs):
+            closed_clients.append(self)
+            await super().aclose(*args, **kwargs)
+
+    cache = RedisResponseCache(client_factory=ClosingFakeRedis)
+
+    async def use_client():
+        client = cache.get_client()
+        await asyncio.sleep(0)
+        return client
+
+    first_client = asyncio.run(use_client())
+    second_client = asyncio.run(use_client())
+    assert closed_clients == [first_client]
+    assert list(cache.clients.values()) == [second_client]
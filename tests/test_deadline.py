@@ -0,0 +1,82 @@
+import asyncio
+import time
+import uuid
+
+from fastapi import Request
+from fastapi.testclient import TestClient
+from tests.simulate_api_call import add_message_text_to_sample_object
+import app
+from mathtext_fastapi.deadline import (
+    ARRIVAL_TIME_SCOPE_KEY,
+    Deadline,
+    build_deadline_for_request,
+)
+from mathtext_fastapi.v2_nlu import run_v2_evaluation_stages
+
+client = TestClient(app.app)
+
+# Shorter than MODEL_STAGE_MIN_BUDGET_MS, so only the rule stages can run
+SHORT_TIMEOUT_HEADERS = {"X-Request-Timeout-Ms": "100"}
+
+
+def test_rule_stage_answer_is_returned_with_short_deadline():
+    message_data = add_message_text_to_sample_object("10", "10")
+    response = client.post(
+        "/v2/nlu", content=message_data, headers=SHORT_TIMEOUT_HEADERS
+    )
+    assert response.status_code == 200
+    assert response.json()["type"] == "correct_answer"
+    assert response.json()["data"] == "10"
+    assert "degraded" not in response.json()
+
+
+def test_model_stage_is_skipped_with_short_deadline():
+    message_data = add_message_text_to_sample_object("I want to change topics", "10")
+    response = client.post(
+        "/v2/nlu", content=message_data, headers=SHORT_TIMEOUT_HEADERS
+    )
+    assert response.status_code == 200
+    assert response.json()["type"] == "out_of_scope"
+    assert response.json()["degraded"] is True
+
+
+def test_stage_result_is_kept_for_a_timeout():
+    deadline = Deadline(1000)
+    result = asyncio.run(run_v2_evaluation_stages("menu", "10", deadline))
+    assert result["type"] == "keyword"
+    assert deadline.timeout_response() == {**result, "degraded": True}
+
+
+def test_invalid_timeout_header_is_ignored():
+    message_data = add_message_text_to_sample_object("10", "15")
+    headers = {"X-Request-Timeout-Ms": "soon"}
+    response = client.post("/v2/nlu", content=message_data, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["type"] == "wrong_answer"
+    assert "degraded" not in response.json()
+
+
+def test_full_deadline_does_not_share_an_evaluation_started_with_a_short_deadline():
+    # A message that has not been evaluated yet, so the response cache cannot answer it
+    message_text = f"I want to change topics {uuid.uuid4().hex}"
+
+    async def short_then_full_deadline():
+        return await asyncio.gather(
+            app.run_v2_nlu_evaluation(message_text, "10", Deadline(100)),
+            app.run_v2_nlu_evaluation(message_text, "10", Deadline()),
+        )
+
+    short_response, full_response = asyncio.run(short_then_full_deadline())
+    assert short_response["degraded"] is True
+    assert "degraded" not in full_response
+
+
+def test_deadline_counts_the_time_spent_waiting_for_admission():
+    # A request that arrived 800ms ago, for example before waiting in the admission queue
+    scope = {
+        "type": "http",
+        "headers": [(b"x-request-timeout-ms", b"1000")],
+        ARRIVAL_TIME_SCOPE_KEY: time.monotonic() - 0.8,
+    }
+    deadline = build_deadline_for_request(Request(scope))
+    assert deadline.remaining_ms() <= 200
@@ -0,0 +1,57 @@
+import asyncio
+
+from mathtext_fastapi.log_sidecar import LogSidecarServer, SidecarLogClient
+from mathtext_fastapi.supabase_logging_async import RequestBatch, RequestLogFlusher
+
+
+def build_sidecar(socket_path):
+    batch = RequestBatch()
+    return batch, LogSidecarServer(batch, RequestLogFlusher(batch), str(socket_path))
+
+
+def test_client_hands_rows_to_the_sidecar_queue(tmp_path):
+    batch, server = build_sidecar(tmp_path / "sidecar.sock")
+    client = SidecarLogClient(str(tmp_path / "sidecar.sock"))
+
+    async def send_rows():
+        await server.start()
+        is_sent = [
+            await client.write([('{"type":"keyword"}', '{"message_body":"menu"}')]),
+            await client.write([("{}", "{}"), ("{}", "{}")]),
+        ]
+        await server.stop()
+        return is_sent
+
+    assert asyncio.run(send_rows()) == [True, True]
+    assert [record.to_row() for record in batch.requests] == [
+        ('{"type":"keyword"}', '{"message_body":"menu"}'),
+        ("{}", "{}"),
+        ("{}", "{}"),
+    ]
+    assert client.get_stats()["connects"] == 1
+    assert server.stats["received_rows"] == 3
+
+
+def test_client_reports_an_unreachable_sidecar(tmp_path):
+    client = SidecarLogClient(str(tmp_path / "missing.sock"))
+
+    assert not asyncio.run(client.write([("{}", "{}")]))
+    assert client.get_stats()["failed_sends"] == 1
+
+
+def test_client_reconnects_after_a_sidecar_restart(tmp_path):
+    batch, server = build_sidecar(tmp_path / "sidecar.sock")
+    client = SidecarLogClient(str(tmp_path / "sidecar.sock"))
+
+    async def restart_between_sends():
+        await server.start()
+        await client.write([("{}", "{}")])
+        await server.stop()
+        await server.start()
+        is_sent = await client.write([("{}", "{}")])
+        await server.stop()
+        return is_sent
+
+    assert asyncio.run(restart_between_sends())
+    assert len(batch.requests) == 2
+    assert client.get_stats()["connects"] == 2
@@ -0,0 +1,82 @@
+import asyncio
+
+from mathtext_fastapi import supabase_logging_async
+from mathtext_fastapi.log_spool import LogSpool, LogSpoolReplayer
+from mathtext_fastapi.supabase_logging_async import (
+    RequestBatch,
+    RequestLogFlusher,
+    RequestLogRecord,
+)
+
+
+def build_rows(count, start=0):
+    return [(f'{{"id": {i}}}', '{"message_body": "8"}') for i in range(start, start + count)]
+
+
+def record_written_rows():
+    written_rows = []
+
+    async def write_rows(rows):
+        written_rows.extend(rows)
+        return True
+
+    return written_rows, write_rows
+
+
+def test_replayer_writes_spooled_rows_and_deletes_segments(tmp_path):
+    spool = LogSpool(tmp_path, segment_bytes=200)
+    for i in range(0, 20, 5):
+        spool.append(build_rows(5, start=i))
+    written_rows, write_rows = record_written_rows()
+    replayer = LogSpoolReplayer(spool, write_rows, batch_rows=7)
+
+    asyncio.run(replayer.replay())
+    assert written_rows == build_rows(20)
+    assert spool.list_segments() == []
+    assert replayer.get_stats()["replayed_rows"] == 20
+
+
+def test_damaged_segment_end_is_discarded(tmp_path):
+    spool = LogSpool(tmp_path)
+    spool.append(build_rows(2))
+    spool.append(build_rows(2, start=2))
+    spool.rotate()
+    (segment_path,) = spool.list_segments()
+    # A crash in the middle of the second record
+    segment_path.write_bytes(segment_path.read_bytes()[:-3])
+    written_rows, write_rows = record_written_rows()
+
+    asyncio.run(LogSpoolReplayer(spool, write_rows).replay_segment(segment_path))
+    assert written_rows == build_rows(2)
+    assert spool.get_stats()["damaged_bytes"] > 0
+
+
+def test_segment_being_written_by_another_worker_is_skipped(tmp_path):
+    other_worker_spool = LogSpool(tmp_path)
+    other_worker_spool.append(build_rows(3))
+    spool = LogSpool(tmp_path)
+    written_rows, write_rows = record_written_rows()
+
+    asyncio.run(LogSpoolReplayer(spool, write_rows).replay())
+    assert written_rows == []
+    other_worker_spool.rotate()
+    asyncio.run(LogSpoolReplayer(spool, write_rows).replay())
+    assert written_rows == build_rows(3)
+
+
+def test_failed_flush_is_spooled(tmp_path, monkeypatch):
+    async def fail_log_batch(batch):
+        return False
+
+    monkeypatch.setattr(supabase_logging_async, "log_batch", fail_log_batch)
+    spool = LogSpool(tmp_path)
+    batch = RequestBatch()
+    flusher = RequestLogFlusher(batch, spool=spool)
+    batch.add_request(RequestLogRecord.from_request({}, {"type": "keyword"}))
+
+    asyncio.run(flusher.drain())
+    assert len(batch.requests) == 0
+    assert flusher.get_stats()["spooled_flushes"] == 1
+    assert spool.read_segment(spool.list_segments()[0])[0] == [
+        ('{"type":"keyword"}', "{}")
+    ]
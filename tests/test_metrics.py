@@ -0,0 +1,47 @@
+import uuid
+
+from fastapi.testclient import TestClient
+from tests.simulate_api_call import simulate_api_call
+import app
+
+client = TestClient(app.app)
+
+
+def test_metrics_report_inference_executor():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    stats = response.json()["inference_executor"]
+    assert stats["max_workers"] >= 1
+    assert stats["queue_depth"] >= 0
+
+
+def test_metrics_count_model_calls():
+    submitted = client.get("/metrics").json()["inference_executor"]["submitted"]
+    # A message that has not been evaluated yet, so the response cache cannot answer it
+    simulate_api_call(client, f"I want to change topics {uuid.uuid4().hex}", "374")
+    stats = client.get("/metrics").json()["inference_executor"]
+    assert stats["submitted"] > submitted
+    assert stats["in_flight"] == 0
+
+
+def test_metrics_report_single_flight_evaluations():
+    simulate_api_call(client, "10", "10")
+    stats = client.get("/metrics").json()["single_flight"]
+    assert stats["v2_nlu"]["evaluations"] >= 1
+    assert stats["v2_nlu"]["hits"] >= 0
+
+
+def test_metrics_report_planner_stages():
+    simulate_api_call(client, "I don't know", "B")
+    stats = client.get("/metrics").json()["planner"]["letter_choice"]
+    assert stats["plans"] >= 1
+    assert stats["special_numbers"] < stats["plans"]
+
+
+def test_metrics_report_response_cache_hits():
+    simulate_api_call(client, "maybe 7", "7")
+    hits = client.get("/metrics").json()["response_cache"]["memory"]["hits"]
+    simulate_api_call(client, "maybe 7", "7")
+    stats = client.get("/metrics").json()["response_cache"]
+    assert stats["memory"]["hits"] == hits + 1
+    assert stats["memory"]["size"] >= 1
@@ -0,0 +1,49 @@
+import asyncio
+import json
+import time
+
+from fastapi.testclient import TestClient
+import app
+
+
+def test_ready_after_warmup():
+    # Entering the client runs the lifespan startup, which starts the warmup
+    with TestClient(app.app) as client:
+        for _ in range(100):
+            response = client.get("/ready")
+            if response.status_code == 200:
+                break
+            time.sleep(0.1)
+        assert response.status_code == 200
+        assert response.json()["ready"] is True
+        assert response.json()["duration_seconds"] >= 0
+
+
+def test_liveness_does_not_wait_for_warmup():
+    with TestClient(app.app) as client:
+        response = client.get("/keywords")
+        assert response.status_code == 200
+
+
+def test_warmup_runs_the_model_when_the_cache_holds_the_canned_messages(monkeypatch):
+    from mathtext_fastapi import cache, v2_nlu, warmup
+
+    for message, expected_answer in warmup.WARMUP_MESSAGES:
+        cached_response = json.dumps({"type": "out_of_scope", "data": message, "confidence": 0.0})
+        cache.response_lru.set(cache.create_hash_key("v2_nlu", [message, expected_answer]), cached_response)
+        cache.response_lru.set(cache.create_hash_key("nlu_intent_recognition", [message]), cached_response)
+
+    model_calls = []
+    predict_message_intent = v2_nlu.predict_message_intent_in_executor
+
+    async def count_model_calls(text):
+        model_calls.append(text)
+        return await predict_message_intent(text)
+
+    monkeypatch.setattr(v2_nlu, "predict_message_intent_in_executor", count_model_calls)
+    try:
+        asyncio.run(warmup.warm_up_evaluations())
+    finally:
+        # The placeholder responses must not answer other tests
+        cache.response_lru.clear()
+    assert "I want to change topics" in model_calls
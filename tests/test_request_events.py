@@ -0,0 +1,33 @@
+import logging
+
+from fastapi.testclient import TestClient
+from tests.simulate_api_call import simulate_api_call
+import app
+from mathtext_fastapi.request_events import request_events
+
+client = TestClient(app.app)
+
+
+def test_request_events_log_fixed_fields_without_the_payload(caplog):
+    with caplog.at_level(logging.INFO, logger="mathtext_fastapi.request_events"):
+        simulate_api_call(client, "maybe 8", "8")
+    records = [record.request_event.to_dict() for record in caplog.records if hasattr(record, "request_event")]
+    assert {"event": "message_parsed", "endpoint": "/v2/nlu", "message_text": "maybe 8", "expected_answer": "8"} in records
+    assert "author_id" not in caplog.text
+    assert "_vnd" not in caplog.text
+
+
+def test_request_events_are_sampled_per_endpoint(caplog, monkeypatch):
+    monkeypatch.setitem(request_events.sample_rates, "/v2/nlu", 0.0)
+    sampled_out = request_events.get_stats()["sampled_out"]
+    with caplog.at_level(logging.INFO, logger="mathtext_fastapi.request_events"):
+        simulate_api_call(client, "maybe 8", "8")
+    assert not [record for record in caplog.records if hasattr(record, "request_event")]
+    assert request_events.get_stats()["sampled_out"] > sampled_out
+
+
+def test_metrics_report_request_event_logging_time():
+    simulate_api_call(client, "maybe 9", "9")
+    stats = client.get("/metrics").json()["request_events"]
+    assert stats["requests"] >= 1
+    assert stats["mean_logging_us_per_request"] >= 0
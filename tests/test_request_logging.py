@@ -0,0 +1,213 @@
+import asyncio
+
+from mathtext_fastapi import supabase_logging_async
+from mathtext_fastapi.pool_telemetry import PoolTelemetry
+from mathtext_fastapi.supabase_logging_async import (
+    BATCH_SIZE,
+    LogWriter,
+    PoolMaintainer,
+    RequestBatch,
+    RequestLogFlusher,
+)
+
+
+def record_log_batches(monkeypatch, succeed=True):
+    logged_batches = []
+
+    async def fake_log_batch(batch):
+        logged_batches.append(batch)
+        return succeed
+
+    monkeypatch.setattr(supabase_logging_async, "log_batch", fake_log_batch)
+    return logged_batches
+
+
+def test_flusher_writes_a_partial_batch_after_max_age(monkeypatch):
+    logged_batches = record_log_batches(monkeypatch)
+    batch = RequestBatch()
+    flusher = RequestLogFlusher(batch, max_age_seconds=0.05)
+
+    async def add_one_request():
+        flusher.start()
+        batch.add_request({"message": 1})
+        flusher.notify()
+        await asyncio.sleep(0.2)
+        await flusher.drain()
+
+    asyncio.run(add_one_request())
+    assert logged_batches == [[{"message": 1}]]
+    assert flusher.get_stats()["age_flushes"] == 1
+
+
+def test_flusher_writes_a_full_batch_right_away(monkeypatch):
+    logged_batches = record_log_batches(monkeypatch)
+    batch = RequestBatch()
+    flusher = RequestLogFlusher(batch, max_age_seconds=60)
+
+    async def fill_batch():
+        flusher.start()
+        for i in range(BATCH_SIZE):
+            batch.add_request({"message": i})
+            flusher.notify()
+        await asyncio.sleep(0.05)
+        await flusher.drain()
+
+    asyncio.run(fill_batch())
+    assert [len(logged_batch) for logged_batch in logged_batches] == [BATCH_SIZE]
+    assert flusher.get_stats()["size_flushes"] == 1
+
+
+def test_drain_writes_waiting_requests(monkeypatch):
+    logged_batches = record_log_batches(monkeypatch)
+    batch = RequestBatch()
+    flusher = RequestLogFlusher(batch, max_age_seconds=60)
+
+    async def add_then_shut_down():
+        flusher.start()
+        batch.add_request({"message": 1})
+        flusher.notify()
+        await flusher.drain()
+
+    asyncio.run(add_then_shut_down())
+    assert logged_batches == [[{"message": 1}]]
+    stats = flusher.get_stats()
+    assert stats["drain_flushes"] == 1
+    assert stats["queued_rows"] == 0
+    assert not stats["flusher_running"]
+
+
+def test_sampled_queue_stays_bounded():
+    batch = RequestBatch(max_rows=100, overflow_policy="sample")
+    batch.add_requests([{"message": i} for i in range(1000)])
+    stats = batch.get_stats()
+    assert stats["queued_rows"] == 100
+    assert stats["dropped_rows"] == 900
+    # A uniform sample keeps rows from after the queue filled up
+    assert any(request["message"] >= 100 for request in batch.requests)
+
+
+def test_failed_flush_keeps_rows_and_waits_before_retrying(monkeypatch):
+    logged_batches = record_log_batches(monkeypatch, succeed=False)
+    batch = RequestBatch(max_rows=BATCH_SIZE * 2)
+    flusher = RequestLogFlusher(batch, max_age_seconds=60)
+
+    async def fill_queue_during_outage():
+        flusher.start()
+        for i in range(BATCH_SIZE * 3):
+            batch.add_request({"message": i})
+            flusher.notify()
+            await asyncio.sleep(0)
+        flusher.stopping = True
+        flusher.wake_up.set()
+        await flusher.task
+
+    asyncio.run(fill_queue_during_outage())
+    assert len(logged_batches) == 1
+    stats = flusher.get_stats()
+    assert stats["failed_flushes"] == 1
+    assert stats["queued_rows"] == BATCH_SIZE * 2
+    assert stats["dropped_rows"] == BATCH_SIZE
+    assert batch.requests[-1] == {"message": BATCH_SIZE * 3 - 1}
+
+
+def fail_then_succeed(failures, error):
+    calls = []
+
+    async def write_rows(rows):
+        calls.append(rows)
+        if len(calls) <= failures:
+            raise error
+
+    return calls, write_rows
+
+
+def test_writer_retries_lost_connections_with_backoff():
+    calls, write_rows = fail_then_succeed(2, ConnectionRefusedError("db is down"))
+    writer = LogWriter(write_rows, retry_limit=3, backoff_base_ms=1)
+
+    assert asyncio.run(writer.write([("{}", "{}")]))
+    assert len(calls) == 3
+    stats = writer.get_stats()
+    assert stats["retries"] == 2
+    assert stats["writes"] == 1
+    assert stats["failed_writes"] == 0
+
+
+def test_writer_does_not_retry_other_errors():
+    calls, write_rows = fail_then_succeed(1, ValueError("bad row"))
+    writer = LogWriter(write_rows, backoff_base_ms=1)
+
+    assert not asyncio.run(writer.write([("{}", "{}")]))
+    assert len(calls) == 1
+    assert writer.get_stats()["failed_writes"] == 1
+
+
+def test_writer_stops_when_the_retry_budget_is_used_up():
+    calls, write_rows = fail_then_succeed(10, ConnectionRefusedError("db is down"))
+    writer = LogWriter(
+        write_rows,
+        retry_limit=10,
+        backoff_base_ms=1000,
+        backoff_max_ms=1000,
+        retry_budget_seconds=0,
+    )
+
+    assert not asyncio.run(writer.write([("{}", "{}")]))
+    assert len(calls) == 1
+    assert writer.get_stats()["exhausted_retry_budgets"] == 1
+
+
+def test_idle_pool_shrinks_after_several_intervals(monkeypatch):
+    monkeypatch.setattr(supabase_logging_async, "db_pool_size", 5)
+    telemetry = PoolTelemetry(min_size=1, max_size=5, headroom=1, shrink_after_windows=2)
+    maintainer = PoolMaintainer(telemetry)
+
+    async def resize_twice():
+        await maintainer.resize_pool()
+        first_size = supabase_logging_async.db_pool_size
+        await maintainer.resize_pool()
+        return first_size, supabase_logging_async.db_pool_size
+
+    assert asyncio.run(resize_twice()) == (5, 1)
+    assert telemetry.stats["resizes"] == 1
+
+
+def test_pool_maintenance_does_not_create_the_engine(monkeypatch):
+    monkeypatch.setattr(supabase_logging_async, "async_engine", None)
+    telemetry = PoolTelemetry()
+
+    asyncio.run(PoolMaintainer(telemetry).check_liveness())
+    assert supabase_logging_async.async_engine is None
+    assert telemetry.stats["liveness_checks"] == 0
+
+
+def test_failed_liveness_check_disposes_the_pool_under_the_writer_lock(monkeypatch):
+    class UnreachableEngine:
+        def connect(self):
+            raise OSError("connection refused")
+
+    lock_held_on_dispose = []
+
+    async def fake_dispose_async_engine():
+        lock_held_on_dispose.append(supabase_logging_async.log_writer.get_lock().locked())
+
+    monkeypatch.setattr(supabase_logging_async, "async_engine", UnreachableEngine())
+    monkeypatch.setattr(
+        supabase_logging_async, "dispose_async_engine", fake_dispose_async_engine
+    )
+    telemetry = PoolTelemetry()
+
+    asyncio.run(PoolMaintainer(telemetry).check_liveness())
+    assert lock_held_on_dispose == [True]
+    assert telemetry.stats["failed_liveness_checks"] == 1
+
+
+def test_pool_overflow_scales_with_the_resized_pool(monkeypatch):
+    monkeypatch.setattr(supabase_logging_async, "async_engine", None)
+    monkeypatch.setattr(supabase_logging_async, "db_pool_size", 4)
+    pool = supabase_logging_async.get_async_engine().sync_engine.pool
+    try:
+        assert pool.size() == 4
+        assert pool._max_overflow == 2
+    finally:
+        asyncio.run(supabase_logging_async.dispose_async_engine())
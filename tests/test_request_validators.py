@@ -0,0 +1,16 @@
+import json
+
+from fastapi.testclient import TestClient
+from tests.simulate_api_call import add_message_text_to_sample_object
+import app
+
+client = TestClient(app.app)
+
+
+def test_timestamp_with_non_ascii_digits_is_rejected():
+    payload = json.loads(add_message_text_to_sample_object("10", "10"))
+    # 2023-04-06T10:08:23Z in Arabic-Indic digits, which isoparse rejects
+    payload["message_data"]["message_inserted_at"] = "٢٠٢٣-٠٤-٠٦T١٠:٠٨:٢٣Z"
+    response = client.post("/v2/nlu", json=payload)
+    assert response.status_code == 200
+    assert response.json()["type"] == "error"
@@ -0,0 +1,37 @@
+from fastapi.testclient import TestClient
+from tests.simulate_api_call import simulate_api_call
+import app
+
+from mathtext_fastapi.response_table import ResponseTable, write_response_table
+
+client = TestClient(app.app)
+
+TABLE_RESPONSE = {"type": "correct_answer", "data": "42", "confidence": 1.0}
+
+
+def test_v2_nlu_answers_from_the_response_table(tmp_path, monkeypatch):
+    path = tmp_path / "response_table.bin"
+    write_response_table(path, [("the table answer", "42", TABLE_RESPONSE)])
+    monkeypatch.setattr(app, "response_table", ResponseTable(path))
+
+    response = simulate_api_call(client, "the table answer", "42")
+
+    assert response.json() == TABLE_RESPONSE
+    stats = client.get("/metrics").json()["response_table"]
+    assert stats["loaded"]
+    assert stats["hits"] == 1
+
+
+def test_stale_response_table_is_rejected(tmp_path, monkeypatch):
+    path = tmp_path / "response_table.bin"
+    write_response_table(
+        path,
+        [("the table answer", "42", TABLE_RESPONSE)],
+        metadata={"fingerprint": "000000000000"},
+    )
+    monkeypatch.setattr(app, "response_table", ResponseTable(path))
+
+    response = simulate_api_call(client, "the table answer", "42")
+
+    assert response.json() != TABLE_RESPONSE
+    assert not client.get("/metrics").json()["response_table"]["loaded"]